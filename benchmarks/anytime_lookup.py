@@ -0,0 +1,107 @@
+"""Latency of anytime lookups against full lookups.
+
+Indexes the demo images without a triangle budget, then looks up the
+composites, every indexed image and affine transformed copies of some of
+them. Each query runs once as a full lookup and once with query_anytime at
+every --confidence. For each setting the script prints the median and worst
+latency from the keypoints on, the share of fragments read, and how many
+queries ranked the same top K as the full lookup. It exits with status 1
+when an anytime lookup that reached its confidence got a different top K.
+
+    $ python benchmarks/anytime_lookup.py --top 1 --confidence 0.9 0.99 0.999
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES  # noqa: E402
+from suite import affine_variant  # noqa: E402
+from transformation_invariant_image_search.anytime import chunk_slices, query_anytime, shuffled  # noqa: E402
+from transformation_invariant_image_search.keypoints import compute_keypoints  # noqa: E402
+from transformation_invariant_image_search.phash import hash_triangles, triangles_from_keypoints  # noqa: E402
+from transformation_invariant_image_search.storage import DiskStorage  # noqa: E402
+
+
+INDEXED = ['cat1.png', 'cat5.png', 'mona.jpg', 'van_gogh.jpg']
+QUERIES = INDEXED + ['cat_original.png', 'monaComposite.jpg', '8cats.png']
+VARIANTS = [('mona.jpg', 20, 0.8, 0.0), ('van_gogh.jpg', -35, 1.2, 0.2)]
+
+
+def triangles_of(img, max_triangles):
+    return triangles_from_keypoints(compute_keypoints(img), max_triangles=max_triangles)
+
+
+def full_lookup(storage, img, args):
+    return storage.query(hash_triangles(img, triangles_of(img, args.max_triangles))), 1.0, 1.0
+
+
+def anytime_lookup(storage, img, args, min_confidence):
+    triangles = triangles_of(img, args.max_triangles)
+    triangles = triangles[shuffled(len(triangles))]
+    chunks = (hash_triangles(img, triangles[s]) for s in chunk_slices(len(triangles)))
+    count, read, settled = query_anytime(storage, chunks, 3 * len(triangles), top=args.top, min_confidence=min_confidence)
+    return count, read / (3 * len(triangles)) if len(triangles) else 1.0, settled
+
+
+def top_k(count, k):
+    return [image for image, _ in count.most_common(k)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=1)
+    parser.add_argument('--confidence', type=float, nargs='+', default=[0.9, 0.99, 0.999])
+    parser.add_argument('--max-triangles', type=int, help='triangle budget of the index and the queries')
+    args = parser.parse_args()
+
+    queries = [(name, cv2.imread(os.path.join(IMAGES, name))) for name in QUERIES]
+    for name, angle, scale, shear in VARIANTS:
+        img = affine_variant(cv2.imread(os.path.join(IMAGES, name)), angle, scale, shear)
+        queries.append((f'{name} {angle:+d}deg', img))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as path:
+        storage = DiskStorage(path)
+        for name in INDEXED:
+            img = cv2.imread(os.path.join(IMAGES, name))
+            storage.add_fragments(name, hash_triangles(img, triangles_of(img, args.max_triangles)))
+        storage.flush()
+
+        modes = [('full', 1.0, lambda img: full_lookup(storage, img, args))]
+        modes += [(f'anytime {c}', c, lambda img, c=c: anytime_lookup(storage, img, args, c)) for c in args.confidence]
+
+        expected = {}
+        print(f'{"mode":<14} {"p50":>7} {"max":>7} {"read":>6} {"same top":>9}')
+        for mode, min_confidence, lookup in modes:
+            seconds, shares, same = [], [], 0
+            for label, img in queries:
+                t = time.perf_counter()
+                count, share, settled = lookup(img)
+                seconds.append(time.perf_counter() - t)
+                shares.append(share)
+
+                ranked = top_k(count, args.top)
+                expected.setdefault(label, ranked)
+                same += ranked == expected[label]
+                if ranked != expected[label] and settled >= min_confidence:
+                    print(f'  {label}: top {args.top} {ranked} settled with {settled:.4f}, full {expected[label]}')
+                    failed = True
+
+            print(f'{mode:<14} {np.median(seconds):6.2f}s {max(seconds):6.2f}s {np.mean(shares):6.0%} '
+                  f'{same:>4}/{len(queries)}')
+
+        storage.close()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
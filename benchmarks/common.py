@@ -0,0 +1,57 @@
+"""Helpers shared by the benchmarks: the demo images and scratch storages.
+
+The scripts put the repository on sys.path before importing this module.
+"""
+import os
+
+import cv2
+
+from transformation_invariant_image_search.keypoints import compute_keypoints
+from transformation_invariant_image_search.phash import fragment_vertices, hash_triangles, triangles_from_keypoints
+from transformation_invariant_image_search.pyramid import hash_triangles_pyramid, working_image
+from transformation_invariant_image_search.storage import DiskStorage, RedisStorage
+
+
+IMAGES = os.path.join(os.path.dirname(__file__), '..', 'fullEndToEndDemo', 'inputImages')
+
+
+def features(name, max_triangles):
+    """Hashes and fragment vertices of the demo image `name`."""
+    return image_features(cv2.imread(os.path.join(IMAGES, name)), max_triangles)
+
+
+def image_features(img, max_triangles, working_size=None):
+    """Hashes and fragment vertices of `img`, from the pyramid of its working size with `working_size`."""
+    if not working_size:
+        triangles = triangles_from_keypoints(compute_keypoints(img), max_triangles=max_triangles)
+        return hash_triangles(img, triangles), fragment_vertices(triangles)
+
+    work, scale = working_image(img, working_size)
+    triangles = triangles_from_keypoints(compute_keypoints(work), max_triangles=max_triangles) / scale
+    return hash_triangles_pyramid(img, triangles), fragment_vertices(triangles)
+
+
+def connector(url=None):
+    """A function opening a new connection to the redis database at `url`, or to one fakeredis server without one."""
+    if url is None:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        return lambda: fakeredis.FakeStrictRedis(server=server)
+
+    import redis
+    return lambda: redis.StrictRedis.from_url(url)
+
+
+def connect(url=None):
+    """A connection to the redis database at `url`, or to a new fakeredis server without one."""
+    return connector(url)()
+
+
+def scratch_storage(path, fake=False, url=None):
+    """A DiskStorage in the directory `path`, or a RedisStorage on fakeredis or on the emptied database at `url`."""
+    if not (fake or url):
+        return DiskStorage(path)
+
+    r = connect(None if fake else url)
+    r.flushdb()
+    return RedisStorage(r)
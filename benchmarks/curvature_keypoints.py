@@ -0,0 +1,139 @@
+"""Speed and keypoint overlap of local_maxima_of_curvature_batch against the spline version.
+
+For every demo image the contours of compute_keypoints are found once, then
+their maxima of curvature are computed both by fitting splines to each
+contour, local_maxima_of_curvature, and for all contours at once,
+local_maxima_of_curvature_batch. The contour centroids, which both modes
+share, are left out.
+
+The script prints the time of each mode, the number of spline and batch
+keypoints, and for every --radius the share of spline keypoints with a batch
+keypoint within that many pixels (recall) and the share of batch keypoints
+with a spline keypoint within it (precision).
+
+Then, end to end, it indexes cat1 to cat8, mona and van_gogh with each mode
+and looks up the queries of triangle_budget.py: the time of finding the
+keypoints and triangles and hashing every image, the fragments indexed, the
+share of queries whose first result is one they show (top-1) and the mean
+share of their images among their top results (recall). Triangles are capped
+with --max-triangles to keep it to a minute or two.
+
+    $ python benchmarks/curvature_keypoints.py --sigma 2 --min-curvature 0.05 --radius 2 3 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, scratch_storage  # noqa: E402
+from transformation_invariant_image_search import curvature  # noqa: E402
+from transformation_invariant_image_search.keypoints import (  # noqa: E402
+    GAUSS_WIDTH, compute_keypoints, keypoint_contours, recolour_blue)
+from transformation_invariant_image_search.phash import hash_triangles, triangles_from_keypoints  # noqa: E402
+from triangle_budget import INDEXED, QUERIES  # noqa: E402
+
+
+def spline_maxima(contours):
+    points = [np.empty((0, 2))]
+    for cnt in contours:
+        points.append(np.stack(curvature.local_maxima_of_curvature(cnt.reshape(-1, 2)), axis=1))
+    return np.concatenate(points)
+
+
+def within(points, others, radius):
+    """Share of `points` with one of `others` within `radius` pixels."""
+    if not len(points) or not len(others):
+        return float(not len(points))
+
+    from scipy.spatial import cKDTree
+    return np.mean(cKDTree(others).query(points)[0] <= radius)
+
+
+def end_to_end(images, fast, max_triangles):
+    """Seconds of hashing `images`, fragments indexed, top-1 and recall of the queries with one mode."""
+    t = time.perf_counter()
+    hashes = {}
+    for name, img in images.items():
+        keypoints = compute_keypoints(img, fast=fast)
+        hashes[name] = hash_triangles(img, triangles_from_keypoints(keypoints, max_triangles=max_triangles))
+    seconds = time.perf_counter() - t
+
+    with tempfile.TemporaryDirectory() as path:
+        storage = scratch_storage(path)
+        for name in INDEXED:
+            storage.add_fragments(name, hashes[name])
+        storage.flush()
+
+        top1, recall = 0, 0
+        for query, expected in QUERIES.items():
+            ranked = storage.query(hashes[query]).most_common()
+            top1 += bool(ranked) and ranked[0][0] in expected
+            recall += len([image for image, _ in ranked[:len(expected)] if image in expected]) / len(expected)
+        storage.close()
+
+    return seconds, sum(len(hashes[name]) for name in INDEXED), top1 / len(QUERIES), recall / len(QUERIES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sigma', type=float, default=2.0, help='smoothing of the batch mode, in points')
+    parser.add_argument('--min-curvature', type=float, default=curvature.MIN_CURVATURE,
+                        help='smallest curvature of a batch maximum')
+    parser.add_argument('--radius', type=float, nargs='+', default=[2, 3, 5])
+    parser.add_argument('--max-triangles', type=int, default=5000, help='triangle budget of the end to end lookups')
+    parser.add_argument('--quality', type=int, default=30, help='JPEG quality of the recompressed mona query')
+    args = parser.parse_args()
+
+    # scipy warns about the smoothing of the splines of some contours
+    warnings.simplefilter('ignore')
+
+    # the spline mode imports scipy on its first call
+    spline_maxima([np.array([[0, 0], [9, 0], [9, 9], [0, 9]])])
+
+    header = ''.join(f' {f"<={r:g}px":>13}' for r in args.radius)
+    print(f'{"image":<18} {"spline":>8} {"batch":>8} {"keypoints":>11}{header}')
+    totals = np.zeros(2)
+    recalls, precisions = [], []
+    for name in sorted(os.listdir(IMAGES)):
+        img = cv2.imread(os.path.join(IMAGES, name))
+        contours = keypoint_contours(recolour_blue(img, GAUSS_WIDTH))
+
+        t = time.perf_counter()
+        expected = spline_maxima(contours)
+        spline = time.perf_counter() - t
+
+        t = time.perf_counter()
+        points = np.stack(curvature.local_maxima_of_curvature_batch(
+            contours, sigma=args.sigma, min_curvature=args.min_curvature), axis=1)
+        batch = time.perf_counter() - t
+        totals += spline, batch
+
+        recalls.append([within(expected, points, r) for r in args.radius])
+        precisions.append([within(points, expected, r) for r in args.radius])
+        shares = ''.join(f' {recall:6.1%}/{precision:6.1%}' for recall, precision in zip(recalls[-1], precisions[-1]))
+        print(f'{name:<18} {spline:7.3f}s {batch:7.3f}s {len(expected):>5}/{len(points):<5}{shares}')
+
+    shares = ''.join(f' {recall:6.1%}/{precision:6.1%}'
+                     for recall, precision in zip(np.mean(recalls, axis=0), np.mean(precisions, axis=0)))
+    print(f'{"total/mean":<18} {totals[0]:7.3f}s {totals[1]:7.3f}s {"":11}{shares}')
+
+    images = {name: cv2.imread(os.path.join(IMAGES, name)) for name in INDEXED + list(QUERIES)[:2]}
+    images['mona.jpg jpeg'] = cv2.imdecode(
+        cv2.imencode('.jpg', images['mona.jpg'], [cv2.IMWRITE_JPEG_QUALITY, args.quality])[1], cv2.IMREAD_COLOR)
+
+    # end to end the batch mode runs with the defaults of compute_keypoints
+    print(f'\n{"end to end":<18} {"seconds":>8} {"fragments":>10} {"top-1":>6} {"recall":>7}')
+    for label, fast in (('spline', False), ('batch', True)):
+        seconds, fragments, top1, recall = end_to_end(images, fast, args.max_triangles)
+        print(f'{label:<18} {seconds:7.1f}s {fragments:>10} {top1:6.0%} {recall:7.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Speed of deleting large images from an index that is being looked up.
+
+Indexes the demo images with --max-triangles (the default gives 100k+
+fragments for the larger ones), then deletes them one at a time while a
+thread keeps looking up the composites over its own connection. For every
+image it prints the fragments removed, the time of the insert and of the
+delete, the round trips of the delete and the keys left, then compacts the
+index. It exits with status 1 if a lookup failed, a deleted image still
+matched or keys of the deleted images are left. The index lives in
+fakeredis, whose commands are much slower than a real server's, --url uses a
+real redis server (its database is flushed).
+
+    $ python benchmarks/delete_images.py --max-triangles 50000
+    $ python benchmarks/delete_images.py --url redis://localhost:6379/15
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import connector, features  # noqa: E402
+from transformation_invariant_image_search.storage import RedisStorage  # noqa: E402
+
+
+INDEXED = ['mona.jpg', 'van_gogh.jpg', 'cat1.png', 'cat2.png', 'cat3.png']
+QUERIES = ['monaComposite.jpg', 'cat_original.png']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-triangles', type=int, default=50000)
+    parser.add_argument('--url', help='redis url of a scratch database, defaults to fakeredis')
+    args = parser.parse_args()
+
+    connect = connector(args.url)
+    storage = RedisStorage(connect())
+    storage.r.flushdb()
+
+    inserted = {}
+    for name in INDEXED:
+        hashes, vertices = features(name, args.max_triangles)
+        t = time.perf_counter()
+        storage.add_fragments(name, hashes, vertices)
+        inserted[name] = time.perf_counter() - t
+    queries = [features(name, args.max_triangles)[0] for name in QUERIES]
+
+    deleted = set()
+    errors = []
+    lookups = 0
+    stop = threading.Event()
+    other = RedisStorage(connect())
+
+    def look_up():
+        nonlocal lookups
+        while not stop.is_set():
+            for hashes in queries:
+                try:
+                    other.query(hashes)
+                    lookups += 1
+                except Exception as e:
+                    errors.append(repr(e))
+
+    reader = threading.Thread(target=look_up, daemon=True)
+    reader.start()
+
+    failed = False
+    print(f'{"image":<14} {"fragments":>10} {"insert":>8} {"delete":>8} {"round trips":>12} {"keys left":>10}')
+    for name in INDEXED:
+        trips = storage.round_trips
+        t = time.perf_counter()
+        n = storage.delete(name)
+        seconds = time.perf_counter() - t
+        deleted.add(name)
+        print(f'{name:<14} {n:>10} {inserted[name]:7.2f}s {seconds:7.2f}s {storage.round_trips - trips:>12} '
+              f'{storage.r.dbsize():>10}')
+
+        found = [image for hashes in queries for image in storage.query(hashes) if image in deleted]
+        if found:
+            print(f'  deleted images still match: {sorted(set(found))}')
+            failed = True
+
+    stop.set()
+    reader.join()
+    other.close()
+    print(f'\n{lookups} lookups during the deletes, {len(errors)} failed')
+    for error in sorted(set(errors)):
+        print(f'  {error}')
+
+    left = [key for key in storage.r.scan_iter() if key != b'image:next']
+    if left:
+        print(f'{len(left)} keys left after deleting every image, e.g. {left[:3]}')
+        failed = True
+
+    t = time.perf_counter()
+    postings, fragments, reclaimed = storage.compact()
+    print(f'compact: {postings} postings and {fragments} fragments removed in {time.perf_counter() - t:.2f}s'
+          + (f', {reclaimed / 2 ** 20:.1f} MB reclaimed' if reclaimed is not None else ''))
+    storage.close()
+
+    if failed or errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
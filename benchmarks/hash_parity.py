@@ -0,0 +1,146 @@
+"""Parity and speed of the batched hash_triangles against the hashing it replaced.
+
+The reference is hash_triangles as it was before hashing was batched, one
+cv2.warpAffine, cv2.resize, grayscale conversion and cv2.dct per fragment of
+the colour image, with only the progress bars dropped and the packed hashes
+reordered by triangle first. The batched version converts to grayscale first,
+samples all the fragments of a batch with one cv2.remap and resizes and
+transforms them with matrix products, so the rounding differs and a share of
+the hashes differ in a few bits. An index hashed by the reference, which is
+what migrate converts, has to be re-indexed to match all its fragments
+exactly.
+
+For every demo image the script prints the triangles per second of both
+paths, the share of hashes that are equal and the share within 2 and 4 bits.
+It exits with status 1 if, over all images, fewer than --min-equal of the
+hashes are equal or fewer than --min-near are within 4 bits.
+
+    $ python benchmarks/hash_parity.py --max-triangles 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES  # noqa: E402
+from transformation_invariant_image_search.keypoints import compute_keypoints  # noqa: E402
+from transformation_invariant_image_search.mih import hamming_distance  # noqa: E402
+from transformation_invariant_image_search.phash import hash_triangles, pack_hashes, triangles_from_keypoints  # noqa: E402,E501
+
+
+NAMES = ['cat1.png', 'cat_original.png', 'mona.jpg', 'monaComposite.jpg', 'van_gogh.jpg', '8cats.png']
+
+# measured on the demo images with 2000 triangles each: 87.5% equal (84% to 92%
+# per image), 99.9% within 2 bits, all within 4 bits
+MIN_EQUAL = 0.85
+MIN_NEAR = 0.999
+
+
+def reference_hashes(img, triangles):
+    """Packed hashes of the fragments of the triangles, computed by the code before hashing was batched."""
+    n = len(triangles)
+    triangles = np.asarray(triangles)
+
+    # basically the return value
+    hash_size = 8
+    hash_img_size = 32, 32
+    low_freq_dct = np.empty((3, n, hash_size, hash_size))
+
+    # size of the target image for affine transform
+    size = width, height = int(60 * 0.86), 60
+
+    # helper matrices
+    empty_n_identity33 = np.empty((n, 3, 3))
+    empty_n_identity33[:, :] = np.identity(3)
+
+    target_points = empty_n_identity33.copy()
+    target_points[:, :2, 0] = width / 2, height
+    target_points[:, :2, 1] = width, 0
+
+    input_points = empty_n_identity33.copy()
+    transpose_m = empty_n_identity33
+
+    # rotate triangles 3 times, one for each edge of the triangle
+    rotations = (0, 1, 2), (1, 2, 0), (2, 0, 1)
+
+    for i, rotation in enumerate(rotations):
+        p = triangles[:, rotation, :]
+
+        p0 = p[:, 0]
+        p1 = p[:, 1] - p0
+        p2 = p[:, 2] - p0
+
+        # if p1 is to the right of p2, then switch
+        _ = np.cross(p1, p2 - p1) > 0
+        p1[_], p2[_] = p2[_], p1[_]
+
+        # calc_transformation_matrix
+        transpose_m[:, :2, 2] = -p0
+        input_points[:, :2, 0] = p1
+        input_points[:, :2, 1] = p2
+
+        input_points_inverse = np.linalg.inv(input_points)
+        transform = target_points @ input_points_inverse @ transpose_m
+        transform = transform[:, :2, :]
+
+        for k in range(n):
+            image = cv2.warpAffine(img, transform[k], size)
+
+            # calculate dct for perceptual hash
+            image = cv2.resize(image, hash_img_size)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            dct = cv2.dct(image.astype(float))
+            low_freq_dct[i, k] = dct[:hash_size, :hash_size]
+
+    # calculate perceptual hash for every triangle
+    low_freq_dct = low_freq_dct.reshape(3 * n, hash_size, hash_size)
+    low_freq_dct[:, 0, 0] = 0
+    mean = np.mean(low_freq_dct, axis=(1, 2))
+    hashes = low_freq_dct > mean[:, None, None]
+
+    # rotation first there, triangle first in hash_triangles
+    return pack_hashes(hashes).reshape(3, n).T.ravel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-triangles', type=int, default=2000)
+    parser.add_argument('--min-equal', type=float, default=MIN_EQUAL, help='smallest share of equal hashes')
+    parser.add_argument('--min-near', type=float, default=MIN_NEAR, help='smallest share of hashes within 4 bits')
+    args = parser.parse_args()
+
+    distances = []
+    print(f'{"image":<18} {"triangles":>9} {"reference/s":>12} {"batched/s":>10} {"equal":>7} {"<=2":>7} {"<=4":>7}')
+    for name in NAMES:
+        img = cv2.imread(os.path.join(IMAGES, name))
+        triangles = triangles_from_keypoints(compute_keypoints(img), max_triangles=args.max_triangles)
+
+        t = time.perf_counter()
+        expected = reference_hashes(img, triangles)
+        reference = time.perf_counter() - t
+
+        t = time.perf_counter()
+        hashes = hash_triangles(img, triangles)
+        batched = time.perf_counter() - t
+
+        d = hamming_distance(hashes, expected)
+        distances.append(d)
+        print(f'{name:<18} {len(triangles):>9} {len(triangles) / reference:12.0f} {len(triangles) / batched:10.0f} '
+              f'{np.mean(d == 0):7.1%} {np.mean(d <= 2):7.1%} {np.mean(d <= 4):7.1%}')
+
+    d = np.concatenate(distances)
+    equal, near = np.mean(d == 0), np.mean(d <= 4)
+    print(f'\nall: {equal:.1%} equal (at least {args.min_equal:.0%}), '
+          f'{near:.1%} within 4 bits (at least {args.min_near:.1%})')
+
+    if equal < args.min_equal or near < args.min_near:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
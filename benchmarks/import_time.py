@@ -0,0 +1,62 @@
+"""Regression check of the start up time of the command line.
+
+Imports a module of the package in a fresh interpreter with
+`python -X importtime` and prints the slowest imports. Exits with status 1
+when the import takes longer than --budget milliseconds or loads one of the
+heavy dependencies, which main.py only imports on the paths that need them.
+The time is the sum over every module, best of --repeat runs.
+
+    $ python benchmarks/import_time.py
+    $ python benchmarks/import_time.py --module transformation_invariant_image_search.pool --budget 400 --allow numpy cv2
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+HEAVY = ['numpy', 'cv2', 'scipy', 'sklearn', 'redis', 'tqdm']
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_times(module):
+    """[(self us, cumulative us, depth, name)] of every module imported by `module`."""
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, stderr=subprocess.PIPE, text=True, check=True).stderr
+    return [(int(m[1]), int(m[2]), len(m[3]) // 2, m[4]) for m in LINE.finditer(out)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='transformation_invariant_image_search.main')
+    parser.add_argument('--budget', type=float, default=100, metavar='MS', help='largest total import time')
+    parser.add_argument('--allow', nargs='*', default=[], metavar='NAME', help='heavy modules the module may import')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest top level imports to print')
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    best = min(runs, key=lambda times: sum(t[0] for t in times))
+    total = sum(t[0] for t in best) / 1000
+
+    print(f'{"cumulative":>12} module')
+    for _, cumulative, _, name in sorted((t for t in best if t[2] <= 1), key=lambda t: -t[1])[:args.top]:
+        print(f'{cumulative / 1000:10.1f}ms {name}')
+    print(f'\nimport {args.module}: {total:.1f}ms, budget {args.budget:.0f}ms')
+
+    failed = total > args.budget
+    heavy = sorted({name.split('.')[0] for _, _, _, name in best} & set(HEAVY) - set(args.allow))
+    if heavy:
+        print('heavy modules imported:', ' '.join(heavy))
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
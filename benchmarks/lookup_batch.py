@@ -0,0 +1,92 @@
+"""Throughput of batched lookups against lookups one image at a time.
+
+Indexes some of the demo images, then looks up all of them, a second upload
+of each, a recompressed and a rotated copy with LookupService.lookup_many, --batch images at a time, and prints
+the queries per second, the time spent in the storage and the distinct
+fragment hashes read. A batch of 1 is the plain lookup. The index lives in a
+temporary DiskStorage, --fake uses a RedisStorage on fakeredis instead and
+also prints the redis round trips. Exits with status 1 if a batch ranks any
+query differently from the lookups one at a time.
+
+    $ python benchmarks/lookup_batch.py --batch 1 8 32
+    $ python benchmarks/lookup_batch.py --fake --radius 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, scratch_storage  # noqa: E402
+from transformation_invariant_image_search import metrics  # noqa: E402
+from transformation_invariant_image_search.pool import HashPool  # noqa: E402
+from transformation_invariant_image_search.server import LookupService  # noqa: E402
+
+
+INDEXED = ['cat1.png', 'cat2.png', 'cat3.png', 'mona.jpg', 'van_gogh.jpg']
+QUERIES = INDEXED + ['cat4.png', 'cat_original.png', 'monaComposite.jpg', '8cats.png']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--max-triangles', type=int, default=2000)
+    parser.add_argument('--radius', type=int, default=0)
+    parser.add_argument('--fake', action='store_true', help='index into fakeredis instead of a temporary directory')
+    args = parser.parse_args()
+
+    queries = []
+    for name in QUERIES:
+        img = cv2.imread(os.path.join(IMAGES, name))
+        recompressed = cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 80])[1], cv2.IMREAD_COLOR)
+        queries += [img, img.copy(), recompressed, cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)]
+
+    with tempfile.TemporaryDirectory() as path, HashPool() as pool:
+        storage = scratch_storage(path, fake=args.fake)
+        service = LookupService(storage, pool, radius=args.radius, max_triangles=args.max_triangles)
+        for name, hashes in zip(INDEXED, service.hashes_many([cv2.imread(os.path.join(IMAGES, n)) for n in INDEXED])):
+            storage.add_fragments(name, hashes)
+        storage.flush()
+
+        hashes = service.hashes_many(queries)
+        print(f'{len(queries)} queries, {sum(map(len, hashes))} fragments, '
+              f'{sum(len(np.unique(h)) for h in hashes)} distinct per query, '
+              f'{len(np.unique(np.concatenate(hashes)))} distinct in all\n')
+
+        print(f'{"batch":>5} {"queries/s":>10} {"wall":>8} {"storage":>8} {"hashes read":>12} {"round trips":>12}')
+        expected = None
+        failed = False
+        for size in args.batch:
+            record = metrics.Record()
+            trips = getattr(storage, 'round_trips', 0)
+            results = []
+            t = time.perf_counter()
+            with metrics.collect(record):
+                for i in range(0, len(queries), size):
+                    results += service.lookup_many(queries[i:i + size])
+            wall = time.perf_counter() - t
+
+            read = sum(len(np.unique(np.concatenate(hashes[i:i + size]))) for i in range(0, len(queries), size))
+            trips = f'{storage.round_trips - trips:>12}' if args.fake else f'{"":>12}'
+            print(f'{size:>5} {len(queries) / wall:10.2f} {wall:7.2f}s {record.seconds["storage"]:7.3f}s {read:>12} {trips}')
+
+            ranked = [count.most_common() for count in results]
+            if expected is None:
+                expected = ranked
+            elif ranked != expected:
+                print(f'batch {size} ranks differently from batch {args.batch[0]}')
+                failed = True
+
+        storage.close()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
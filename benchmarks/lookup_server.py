@@ -0,0 +1,103 @@
+"""Latency of the lookup server at several levels of concurrency.
+
+Indexes the demo images into a temporary DiskStorage, starts the server in
+process and has N clients send lookups back to back, then prints the p50 and
+p99 latency and the throughput for each N. For comparison it also times one
+`main.py lookup` run, which pays the interpreter start, the imports and the
+worker pool on every query.
+
+    $ python benchmarks/lookup_server.py --concurrency 1 2 4 8 --requests 8
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, features  # noqa: E402
+from transformation_invariant_image_search.pool import HashPool  # noqa: E402
+from transformation_invariant_image_search.server import HashBatcher, LookupService, make_server  # noqa: E402
+from transformation_invariant_image_search.storage import DiskStorage  # noqa: E402
+
+
+INDEXED = ['cat1.png', 'cat2.png', 'cat3.png', 'mona.jpg', 'van_gogh.jpg']
+QUERIES = ['cat_original.png', 'monaComposite.jpg', 'cat4.png']
+
+
+def build_index(path, max_triangles):
+    storage = DiskStorage(path)
+    for name in INDEXED:
+        storage.add_fragments(name, features(name, max_triangles)[0])
+    storage.flush()
+    return storage
+
+
+def post(url, data):
+    t = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+        response.read()
+    return time.perf_counter() - t
+
+
+def run(url, queries, concurrency, requests):
+    jobs = [queries[i % len(queries)] for i in range(concurrency * requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as clients:
+        latencies = np.array(list(clients.map(lambda data: post(url, data), jobs)))
+    wall = time.perf_counter() - start
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), len(jobs) / wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--requests', type=int, default=8, help='requests per client')
+    parser.add_argument('--max-triangles', type=int, default=5000)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        storage = build_index(path, args.max_triangles)
+        queries = []
+        for name in QUERIES:
+            with open(os.path.join(IMAGES, name), 'rb') as f:
+                queries.append(f.read())
+
+        t = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-m', 'transformation_invariant_image_search.main', 'lookup', '--storage', path,
+             '--max-triangles', str(args.max_triangles), os.path.join(IMAGES, QUERIES[0])],
+            check=True, stdout=subprocess.DEVNULL, cwd=os.path.join(os.path.dirname(__file__), '..'))
+        print(f'main.py lookup, one image: {time.perf_counter() - t:.3f}s')
+
+        with HashPool(args.processes) as pool:
+            batcher = HashBatcher(pool)
+            service = LookupService(storage, batcher, max_triangles=args.max_triangles)
+            server = make_server(service, '127.0.0.1:0', quiet=True)
+            url = f'http://127.0.0.1:{server.server_address[1]}/lookup'
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            # warm up
+            post(url, queries[0])
+
+            print(f'{"clients":>8} {"p50":>8} {"p99":>8} {"req/s":>8} {"rounds":>8}')
+            for concurrency in args.concurrency:
+                rounds = batcher.rounds
+                p50, p99, throughput = run(url, queries, concurrency, args.requests)
+                print(f'{concurrency:8d} {p50:8.3f} {p99:8.3f} {throughput:8.2f} {batcher.rounds - rounds:8d}')
+
+            server.shutdown()
+            server.server_close()
+            batcher.close()
+
+
+if __name__ == '__main__':
+    main()
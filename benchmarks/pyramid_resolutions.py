@@ -0,0 +1,59 @@
+"""Feature time and matching across input resolutions, with and without --working-size.
+
+Indexes mona.jpg and van_gogh.jpg at their own size, then looks up mona.jpg
+rescaled to several sizes. Prints the time to compute the hashes of the query
+and the votes for the right and the wrong image. Each mode gets its own
+index, an index only matches queries hashed with the same setting.
+
+    $ python benchmarks/pyramid_resolutions.py --working-size 1024
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, image_features  # noqa: E402
+from transformation_invariant_image_search.storage import DiskStorage  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--working-size', type=int, default=1024)
+    parser.add_argument('--max-triangles', type=int, default=20000)
+    parser.add_argument('--factors', type=float, nargs='+', default=[0.5, 1, 2, 4, 6])
+    args = parser.parse_args()
+
+    mona = cv2.imread(os.path.join(IMAGES, 'mona.jpg'))
+    other = cv2.imread(os.path.join(IMAGES, 'van_gogh.jpg'))
+
+    print(f'{"mode":<8} {"size":>10} {"MP":>5} {"time":>7} {"right":>7} {"wrong":>6}')
+    for mode, working_size in [('plain', None), ('pyramid', args.working_size)]:
+        with tempfile.TemporaryDirectory() as directory:
+            storage = DiskStorage(directory)
+            storage.add_fragments('mona', image_features(mona, args.max_triangles, working_size)[0])
+            storage.add_fragments('other', image_features(other, args.max_triangles, working_size)[0])
+            storage.flush()
+
+            for factor in args.factors:
+                interpolation = cv2.INTER_CUBIC if factor > 1 else cv2.INTER_AREA
+                img = cv2.resize(mona, None, fx=factor, fy=factor, interpolation=interpolation)
+
+                t = time.perf_counter()
+                hashes = image_features(img, args.max_triangles, working_size)[0]
+                elapsed = time.perf_counter() - t
+
+                count = storage.query(hashes)
+                height, width = img.shape[:2]
+                print(f'{mode:<8} {f"{width}x{height}":>10} {width * height / 1e6:5.1f} {elapsed:6.2f}s '
+                      f'{count["mona"]:7d} {count["other"]:6d}')
+
+            storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Recall and latency of lookups with a hamming radius against exact matches.
+
+Indexes some of the demo images, plus --filler images of random hashes so
+the index is not trivially small, then looks up near duplicates of the
+indexed images: a JPEG recompression at --quality and a copy resampled by
+--scale. For every --radius it prints the mean time of a lookup, the votes
+of the right image as a share of the fragments of the query (the fragment
+recall), that recall relative to exact matches (radius 0), the most votes of
+a wrong demo image and the share of queries the right image ranks first in.
+
+Every lookup is also compared with a brute force count over all the pairs of
+query and indexed hashes. Exits with status 1 if any vote differs, that is
+if the multi-index search misses a stored hash within the radius.
+
+    $ python benchmarks/radius_recall.py --radius 0 1 2 3 4
+    $ python benchmarks/radius_recall.py --fake --filler 100
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, image_features, scratch_storage  # noqa: E402
+from transformation_invariant_image_search.mih import hamming_distance  # noqa: E402
+
+
+INDEXED = ['cat1.png', 'cat2.png', 'cat3.png', 'mona.jpg', 'van_gogh.jpg']
+
+
+def near_duplicates(img, quality, scale):
+    """(label, image) of the copies of `img` looked up."""
+    recompressed = cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1], cv2.IMREAD_COLOR)
+    resampled = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return [(f'jpeg {quality}', recompressed), (f'scale {scale:g}', resampled)]
+
+
+def exact_votes(hashes, indexed, radius, batch_size=256):
+    """Counter of the votes of `hashes` for each image of `indexed`, comparing every pair of hashes."""
+    unique, counts = np.unique(hashes, return_counts=True)
+    votes = Counter()
+    for name, stored in indexed.items():
+        stored = np.unique(stored)
+        near = np.zeros(len(unique), dtype=bool)
+        for i in range(0, len(stored), batch_size):
+            near |= (hamming_distance(unique[:, None], stored[None, i:i + batch_size]) <= radius).any(axis=1)
+        if near.any():
+            votes[name] = int(counts[near].sum())
+    return votes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--radius', type=int, nargs='+', default=[0, 1, 2, 3, 4])
+    parser.add_argument('--max-triangles', type=int, default=2000)
+    parser.add_argument('--filler', type=int, default=50, help='images of random hashes added to the index')
+    parser.add_argument('--quality', type=int, default=70)
+    parser.add_argument('--scale', type=float, default=0.9)
+    parser.add_argument('--fake', action='store_true', help='index into fakeredis instead of a temporary directory')
+    args = parser.parse_args()
+
+    indexed, queries = {}, []
+    for name in INDEXED:
+        img = cv2.imread(os.path.join(IMAGES, name))
+        indexed[name] = image_features(img, args.max_triangles)[0]
+        queries += [(name, label, image_features(copy, args.max_triangles)[0])
+                    for label, copy in near_duplicates(img, args.quality, args.scale)]
+
+    rng = np.random.default_rng(0)
+    fragments = 3 * args.max_triangles
+    failed = False
+
+    with tempfile.TemporaryDirectory() as path:
+        storage = scratch_storage(path, fake=args.fake)
+        for name, hashes in indexed.items():
+            storage.add_fragments(name, hashes)
+        for i in range(args.filler):
+            storage.add_fragments(f'filler{i}', rng.integers(0, 2 ** 63, fragments, dtype=np.uint64))
+        storage.flush()
+
+        print(f'{len(indexed)} demo images and {args.filler} filler images indexed, {len(queries)} queries\n')
+        print(f'{"radius":>6} {"latency":>9} {"recall":>7} {"vs exact":>8} {"wrong":>7} {"top 1":>6}')
+        exact_recall = None
+        for radius in args.radius:
+            seconds, recalls, wrongs, firsts = [], [], [], []
+            for name, label, hashes in queries:
+                t = time.perf_counter()
+                votes = storage.query(hashes, radius=radius)
+                seconds.append(time.perf_counter() - t)
+
+                demo = Counter({image: v for image, v in votes.items() if image in indexed})
+                expected = exact_votes(hashes, indexed, radius)
+                if demo != expected:
+                    print(f'{name} {label} radius {radius}: {dict(demo)} instead of {dict(expected)}')
+                    failed = True
+
+                recalls.append(votes[name] / len(hashes))
+                wrongs.append(max([v for image, v in demo.items() if image != name], default=0) / len(hashes))
+                firsts.append(votes.most_common(1)[0][0] == name if votes else False)
+
+            recall = np.mean(recalls)
+            if exact_recall is None:
+                exact_recall = recall if radius == 0 else None
+            relative = f'{recall / exact_recall:7.2f}x' if exact_recall else f'{"":>8}'
+            print(f'{radius:>6} {1000 * np.mean(seconds):7.1f}ms {recall:7.1%} {relative} {np.mean(wrongs):7.1%} '
+                  f'{np.mean(firsts):6.0%}')
+
+        storage.close()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
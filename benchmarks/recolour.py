@@ -0,0 +1,90 @@
+"""Speed of the recolouring of compute_keypoints on large images.
+
+Upscales a demo image to several sizes and times, best of --repeat:
+
+    split    cv2.split(recolour(img)), the three channel recolour
+    blue     recolour_blue, only the blue channel through BLUE_LUT
+    buffers  recolour_blue into the planes of a RecolourBuffers reused across calls
+
+It also prints the peak memory allocated through numpy by a call after a
+warm up, as seen by tracemalloc. That includes the arrays OpenCV returns but
+not its internal buffers. Exits with status 1 if the blue channels differ.
+
+    $ python benchmarks/recolour.py --sizes 1000 2000 4000 8000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from transformation_invariant_image_search.keypoints import (  # noqa: E402
+    GAUSS_WIDTH, RecolourBuffers, recolour, recolour_blue)
+
+
+IMAGE = os.path.join(os.path.dirname(__file__), '..', 'fullEndToEndDemo', 'inputImages', 'mona.jpg')
+
+
+def measure(fn, repeat):
+    """(best seconds, peak traced bytes, result) of `fn()`."""
+    fn()
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000, 8000], help='longest side')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    original = cv2.imread(IMAGE)
+    buffers = RecolourBuffers()
+
+    def buffered(img):
+        blurred, blue = buffers.planes(img.shape)
+        return recolour_blue(img, GAUSS_WIDTH, out=blue, blurred=blurred)
+
+    modes = {
+        'split': lambda img: cv2.split(recolour(img, GAUSS_WIDTH))[0],
+        'blue': lambda img: recolour_blue(img, GAUSS_WIDTH),
+        'buffers': buffered,
+    }
+
+    failed = False
+    print(f'{"size":>11} {"mode":<8} {"time":>8} {"speedup":>8} {"numpy MB":>9}')
+    for size in args.sizes:
+        scale = size / max(original.shape[:2])
+        img = cv2.resize(original, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+        label = f'{img.shape[1]}x{img.shape[0]}'
+
+        results, seconds = {}, {}
+        for mode, fn in modes.items():
+            seconds[mode], peak, results[mode] = measure(lambda: fn(img), args.repeat)
+            speedup = seconds['split'] / seconds[mode]
+            print(f'{label:>11} {mode:<8} {seconds[mode]:7.3f}s {speedup:7.1f}x {peak / 2 ** 20:9.1f}')
+
+        if not all(np.array_equal(results['split'], result) for result in results.values()):
+            print(f'{label}: blue channels differ')
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Round trips and wall time per image of the redis storage.
+
+Inserts the hashes of the demo images into a redis database and looks them
+up again, for several pipeline chunk sizes and numbers of chunks in flight.
+The hashes are computed once up front, only the storage is timed. Every
+setting starts from an empty database, so don't point it at a database that
+holds anything else.
+
+    $ python benchmarks/redis_roundtrips.py --storage redis://localhost:6379/15
+    $ python benchmarks/redis_roundtrips.py --fake   # fakeredis, no server needed
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import connect, features  # noqa: E402
+from transformation_invariant_image_search.storage import RedisStorage  # noqa: E402
+
+
+INDEXED = ['cat1.png', 'cat2.png', 'cat3.png', 'mona.jpg', 'van_gogh.jpg']
+QUERIES = ['cat_original.png', 'monaComposite.jpg']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storage', default='redis://localhost:6379/15', metavar='URL')
+    parser.add_argument('--fake', action='store_true', help='use fakeredis instead of a server')
+    parser.add_argument('--max-triangles', type=int, default=10000)
+    parser.add_argument('--chunk-size', type=int, nargs='+', default=[100000, 10000])
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--radius', type=int, default=0)
+    args = parser.parse_args()
+
+    indexed = {name: features(name, args.max_triangles) for name in INDEXED}
+    queries = {name: features(name, args.max_triangles)[0] for name in QUERIES}
+
+    print(f'{"chunk":>8} {"flight":>6} {"insert/img":>11} {"trips/img":>9} {"lookup/img":>11} {"trips/img":>9}')
+    for chunk_size in args.chunk_size:
+        for in_flight in args.in_flight:
+            r = connect(None if args.fake else args.storage)
+            r.flushdb()
+            storage = RedisStorage(r, chunk_size=chunk_size, in_flight=in_flight)
+
+            t = time.perf_counter()
+            for name, (hashes, vertices) in indexed.items():
+                storage.add_fragments(name, hashes, vertices)
+            insert_time = (time.perf_counter() - t) / len(indexed)
+            insert_trips = storage.round_trips / len(indexed)
+
+            storage.round_trips = 0
+            t = time.perf_counter()
+            for hashes in queries.values():
+                storage.query(hashes, radius=args.radius)
+            lookup_time = (time.perf_counter() - t) / len(queries)
+            lookup_trips = storage.round_trips / len(queries)
+
+            print(f'{chunk_size:8d} {in_flight:6d} {insert_time:10.3f}s {insert_trips:9.1f} '
+                  f'{lookup_time:10.3f}s {lookup_trips:9.1f}')
+
+            r.flushdb()
+            storage.close()
+
+
+if __name__ == '__main__':
+    main()
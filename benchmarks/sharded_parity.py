@@ -0,0 +1,148 @@
+"""Parity of a sharded index with a single redis holding the same images.
+
+Indexes the demo images both in one RedisStorage and in a ShardedStorage of
+--shards minus one shards, then adds the last shard and runs reshard, and
+finally deletes some of the images from both. After every step it looks up
+the composites and the indexed images in both, exactly and with --radius,
+and compares the votes and the stored vertices of the right image. After
+reshard it also checks that every fragment is on the shard that owns it.
+It prints the time of each step for both and exits with status 1 on any
+difference.
+
+Every shard and the single index are fakeredis servers of their own by
+default. --urls uses real redis servers for the shards and --single one for
+the single index, their databases are flushed.
+
+    $ python benchmarks/sharded_parity.py --shards 4
+    $ python benchmarks/sharded_parity.py --urls redis://localhost:6380/0,redis://localhost:6381/0 \
+          --single redis://localhost:6379/15
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import connect, features  # noqa: E402
+from transformation_invariant_image_search.storage import RedisStorage, ShardedStorage  # noqa: E402
+
+
+INDEXED = ['mona.jpg', 'van_gogh.jpg', 'cat1.png', 'cat2.png', 'cat3.png']
+QUERIES = ['monaComposite.jpg', 'cat_original.png']
+DELETED = ['van_gogh.jpg', 'cat2.png']
+
+
+def differences(single, sharded, queries, radius):
+    """Descriptions of the lookups whose votes or vertices differ between the two storages."""
+    found = []
+    for r in sorted({0, radius}):
+        for name, (hashes, _) in queries.items():
+            expected, votes = single.query(hashes, radius=r), sharded.query(hashes, radius=r)
+            if votes != expected:
+                found.append(f'{name} radius {r}: {dict(votes.most_common(3))} '
+                             f'instead of {dict(expected.most_common(3))}')
+
+        batch = list(queries)
+        expected = single.query_many([queries[name][0] for name in batch], radius=r)
+        votes = sharded.query_many([queries[name][0] for name in batch], radius=r)
+        found += [f'{name} radius {r}: query_many differs' for name, a, b in zip(batch, votes, expected) if a != b]
+
+    for name in INDEXED:
+        hashes = queries[name][0]
+        if not np.array_equal(sharded.geometry(name, hashes), single.geometry(name, hashes), equal_nan=True):
+            found.append(f'{name}: vertices differ')
+        if sharded.has_image(name) != single.has_image(name):
+            found.append(f'{name}: has_image differs')
+
+    return found
+
+
+def misplaced(sharded):
+    """Number of fragments that are not on the shard that owns them."""
+    n = 0
+    for node, shard in enumerate(sharded.shards):
+        keys = [k for k in shard.r.scan_iter(count=1000, _type='set') if len(k) == 8]
+        if keys:
+            hashes = np.frombuffer(b''.join(keys), dtype='>u8').astype(np.uint64)
+            n += int(np.sum(sharded.ring.owners(hashes) != node))
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--urls', help='comma separated redis urls of scratch databases, defaults to fakeredis')
+    parser.add_argument('--single', metavar='URL', help='redis url of a scratch database, defaults to fakeredis')
+    parser.add_argument('--max-triangles', type=int, default=2000)
+    parser.add_argument('--radius', type=int, default=2)
+    args = parser.parse_args()
+
+    urls = args.urls.split(',') if args.urls else [None] * args.shards
+    names = args.urls.split(',') if args.urls else [f'redis://shard{i}:6379/0' for i in range(args.shards)]
+    if len(urls) < 2:
+        parser.error('reshard needs at least 2 shards')
+
+    shards = []
+    for url in urls:
+        r = connect(url)
+        r.flushdb()
+        shards.append(RedisStorage(r))
+    single = RedisStorage(connect(args.single))
+    single.r.flushdb()
+
+    queries = {name: features(name, args.max_triangles) for name in INDEXED + QUERIES}
+    sharded = ShardedStorage(shards[:-1], names[:-1])
+    failed = False
+
+    def step(label, fn):
+        nonlocal failed
+        t = time.perf_counter()
+        fn(single)
+        one = time.perf_counter() - t
+        t = time.perf_counter()
+        fn(sharded)
+        many = time.perf_counter() - t
+
+        found = differences(single, sharded, queries, args.radius)
+        print(f'{label:<24} {one:8.2f}s {many:8.2f}s {len(found):>12}')
+        for line in found:
+            print(f'  {line}')
+        failed |= bool(found)
+
+    def insert(storage):
+        for name in INDEXED:
+            storage.add_fragments(name, *queries[name])
+
+    def delete(storage):
+        for name in DELETED:
+            storage.delete(name)
+
+    print(f'{"step":<24} {"single":>9} {"sharded":>9} {"differences":>12}')
+    step(f'insert, {len(shards) - 1} shards', insert)
+
+    t = time.perf_counter()
+    sharded.executor.shutdown()
+    sharded = ShardedStorage(shards, names)
+    moved = sharded.reshard()
+    print(f'reshard moved {moved} fragments to the new shard in {time.perf_counter() - t:.2f}s')
+    step(f'reshard, {len(shards)} shards', lambda storage: None)
+
+    left = misplaced(sharded)
+    if left:
+        print(f'  {left} fragments are not on the shard that owns them')
+        failed = True
+
+    step('delete', delete)
+
+    sharded.close()
+    single.close()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Lookup cost with and without stop-fragment filtering.
+
+Builds a synthetic index where every image has its own fragments plus some
+from a small pool of common ones, like the flat colour and border fragments
+of real images, and looks up half of the fragments of some of the images.
+Prints the lookup time, the image ids transferred from redis and whether the
+right image still ranks first, with no filtering, with --max-df and with idf
+weighting.
+
+    $ python benchmarks/stop_fragments.py --fake
+    $ python benchmarks/stop_fragments.py --storage redis://localhost:6379/15
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import connect  # noqa: E402
+from transformation_invariant_image_search.storage import RedisStorage  # noqa: E402
+
+
+def corpus(images, unique, common, pool, seed=0):
+    rng = np.random.default_rng(seed)
+    shared = rng.integers(0, 2 ** 63, pool, dtype=np.uint64)
+    return [
+        np.concatenate([rng.integers(0, 2 ** 63, unique, dtype=np.uint64), rng.choice(shared, common, replace=False)])
+        for _ in range(images)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storage', default='redis://localhost:6379/15', metavar='URL')
+    parser.add_argument('--fake', action='store_true', help='use fakeredis instead of a server')
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--unique', type=int, default=2000, help='fragments only found in one image')
+    parser.add_argument('--common', type=int, default=500, help='fragments of each image from the common pool')
+    parser.add_argument('--pool', type=int, default=1000, help='size of the pool of common fragments')
+    parser.add_argument('--max-df', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=20)
+    args = parser.parse_args()
+
+    images = corpus(args.images, args.unique, args.common, args.pool)
+    r = connect(None if args.fake else args.storage)
+    r.flushdb()
+
+    storage = RedisStorage(r)
+    for i, hashes in enumerate(images):
+        storage.add_fragments(f'image{i}', hashes)
+
+    # the ids sent by redis are what the filtering saves
+    transferred = [0]
+    members = storage.members
+
+    def counting_members(pipe, keys, max_df=None):
+        lengths, ids = members(pipe, keys, max_df)
+        transferred[0] += len(ids)
+        return lengths, ids
+
+    storage.members = counting_members
+
+    rng = np.random.default_rng(1)
+    queries = []
+    for i in rng.choice(args.images, args.queries, replace=False).tolist():
+        hashes = images[i]
+        queries.append((f'image{i}', rng.choice(hashes, len(hashes) // 2, replace=False)))
+
+    print(f'{"mode":<14} {"ms/lookup":>10} {"ids/lookup":>11} {"top-1":>6} {"margin":>7}')
+    for mode, kwargs in [('all', {}), (f'max-df {args.max_df}', dict(max_df=args.max_df)), ('idf', dict(idf=True)),
+                         ('max-df + idf', dict(max_df=args.max_df, idf=True))]:
+        transferred[0] = 0
+        correct, margins = 0, []
+        t = time.perf_counter()
+        for name, hashes in queries:
+            ranked = storage.query(hashes, **kwargs).most_common(2)
+            correct += ranked[0][0] == name
+            margins.append(ranked[0][1] / ranked[1][1] if len(ranked) > 1 else float('inf'))
+        elapsed = (time.perf_counter() - t) / len(queries)
+
+        print(f'{mode:<14} {elapsed * 1000:10.1f} {transferred[0] / len(queries):11.0f} '
+              f'{correct / len(queries):6.0%} {np.median(margins):7.2f}')
+
+    r.flushdb()
+    storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Peak memory of a lookup against the number of triangles, hashed at once and in chunks.
+
+Every run is a fresh process looking up a synthetic image with random
+keypoints, more keypoints mean more triangles. The chunked runs use the
+functions behind --max-memory, and the script exits with status 1 if one of
+them ends with a peak over --max-memory or if their peaks grow with the
+number of triangles by more than --tolerance.
+
+    $ python benchmarks/stream_memory.py --keypoints 400 800 1600 --max-memory 400
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from transformation_invariant_image_search.phash import hash_triangles, triangles_from_keypoints  # noqa: E402
+from transformation_invariant_image_search.storage import DiskStorage  # noqa: E402
+from transformation_invariant_image_search.stream import (  # noqa: E402
+    chunk_size_for, hash_chunks, peak_memory, query_chunks, triangle_chunks)
+
+
+SIZE = 2000
+
+
+def run(args):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (SIZE, SIZE, 3), dtype=np.uint8)
+    keypoints = rng.uniform(0, SIZE, (args.child, 2))
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = DiskStorage(directory)
+        storage.add_fragments('noise', rng.integers(0, 2 ** 63, 100000, dtype=np.uint64))
+        storage.flush()
+
+        before = peak_memory()
+        t = time.perf_counter()
+        if args.chunked:
+            max_memory = args.max_memory << 20
+            triangles = 0
+
+            def counted(img, chunk):
+                nonlocal triangles
+                triangles += len(chunk)
+                return hash_triangles(img, chunk)
+
+            chunks = triangle_chunks(keypoints, chunk_size_for(max_memory))
+            query_chunks(storage, hash_chunks(img, chunks, counted, max_memory))
+        else:
+            all_triangles = triangles_from_keypoints(keypoints)
+            triangles = len(all_triangles)
+            storage.query(hash_triangles(img, all_triangles))
+
+        print(json.dumps(dict(
+            triangles=triangles, seconds=time.perf_counter() - t, before=before, peak=peak_memory())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keypoints', type=int, nargs='+', default=[400, 800, 1600])
+    parser.add_argument('--max-memory', type=int, default=400, metavar='MB')
+    parser.add_argument('--tolerance', type=int, default=32, metavar='MB')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--chunked', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run(args)
+        return
+
+    failed = False
+    print(f'{"mode":<8} {"keypoints":>9} {"triangles":>10} {"time":>8} {"start MB":>9} {"peak MB":>8}')
+    for chunked in (False, True):
+        peaks = []
+        for keypoints in args.keypoints:
+            command = [sys.executable, __file__, '--child', str(keypoints), '--max-memory', str(args.max_memory)]
+            output = subprocess.run(command + ['--chunked'] * chunked, capture_output=True, check=True, text=True)
+            result = json.loads(output.stdout)
+            peaks.append(result['peak'] >> 20)
+            print(f'{"chunked" if chunked else "whole":<8} {keypoints:9d} {result["triangles"]:10d} '
+                  f'{result["seconds"]:7.1f}s {result["before"] >> 20:9d} {result["peak"] >> 20:8d}')
+
+        if chunked and (max(peaks) > args.max_memory or max(peaks) - min(peaks) > args.tolerance):
+            failed = True
+
+    if failed:
+        print(f'chunked peak memory is not bounded by {args.max_memory} MB')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
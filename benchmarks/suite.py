@@ -0,0 +1,237 @@
+"""Benchmark suite and regression check of every stage of the pipeline.
+
+Indexes the demo images, then looks up the cat and mona composites and
+affine transformed copies of some of the indexed images. For every stage it
+records the wall time, the fragments per second where that applies and the
+peak memory allocated by the stage as seen by tracemalloc, which doesn't see
+OpenCV's own buffers. It also records whether the right image ranks first for
+every lookup. The stages are, for every image:
+
+    recolour    keypoints.recolour_blue
+    keypoints   keypoints.compute_keypoints_internal on the blue channel
+    curvature   the part of keypoints spent finding curvature maxima
+    triangles   phash.triangles_from_keypoints
+    hashing     phash.hash_triangles
+    insert      add_fragments of the indexed images and the final flush
+    lookup      query of the composite and transformed images
+
+Memory is measured in a second pass, as tracing slows the python heavy
+stages down. The index lives in a temporary DiskStorage, so no server is
+needed. --fake uses a RedisStorage on fakeredis instead, --storage a redis
+server whose database is flushed. --save writes the results as json.
+--baseline compares them against such a file and exits with status 1 when
+a stage got more than --threshold slower or a lookup stopped ranking the
+right image first. Timings only compare on the same machine.
+
+    $ python benchmarks/suite.py --save benchmarks/baseline.json
+    $ python benchmarks/suite.py --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, scratch_storage  # noqa: E402
+from transformation_invariant_image_search import curvature  # noqa: E402
+from transformation_invariant_image_search.keypoints import (  # noqa: E402
+    GAUSS_WIDTH, compute_keypoints_internal, recolour_blue)
+from transformation_invariant_image_search.phash import (  # noqa: E402
+    fragment_vertices, hash_triangles, triangles_from_keypoints)
+
+
+CATS = [f'cat{i}.png' for i in range(1, 9)]
+INDEXED = CATS + ['mona.jpg', 'van_gogh.jpg']
+
+# (query, images that may rank first)
+CASES = [('cat_original.png', CATS), ('monaComposite.jpg', ['van_gogh.jpg', 'mona.jpg'])]
+
+# (indexed image, rotation in degrees, scale, shear) of the transformed copies
+VARIANTS = [('mona.jpg', 20, 0.8, 0.0), ('van_gogh.jpg', -35, 1.2, 0.2), ('cat1.png', 90, 1.0, 0.1)]
+
+STAGES = ['recolour', 'keypoints', 'curvature', 'triangles', 'hashing', 'insert', 'lookup']
+
+# stages whose speed is reported in fragments per second
+FRAGMENT_STAGES = ['hashing', 'insert', 'lookup']
+
+# slowdowns of less than this many seconds are noise, not regressions
+MIN_REGRESSION = 0.05
+
+
+class Recorder:
+    """Wall time, fragments and peak traced memory of every stage."""
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.fragments = dict.fromkeys(STAGES, 0)
+        self.peak = dict.fromkeys(STAGES, 0)
+
+    def run(self, stage, fn, *args, **kwargs):
+        if self.trace:
+            tracemalloc.start()
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.seconds[stage] += time.perf_counter() - t
+            if self.trace:
+                self.peak[stage] = max(self.peak[stage], tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+    def timed(self, stage, fn):
+        """`fn` adding its wall time to `stage`, for stages nested in another one."""
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - t
+        return wrapper
+
+
+def affine_variant(img, angle, scale, shear):
+    """`img` sheared, rotated and scaled, on a canvas large enough to hold all of it."""
+    h, w = img.shape[:2]
+    m = cv2.getRotationMatrix2D((w / 2, h / 2), angle, scale)
+    m[:, :2] = m[:, :2] @ np.array([[1, shear], [0, 1]])
+
+    corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]]) @ m.T
+    m[:, 2] -= corners.min(axis=0)
+    size = np.ceil(corners.max(axis=0) - corners.min(axis=0)).astype(int)
+    return cv2.warpAffine(img, m, tuple(size.tolist()))
+
+
+def features(recorder, img, args):
+    b = recorder.run('recolour', recolour_blue, img, GAUSS_WIDTH)
+    keypoints = recorder.run('keypoints', compute_keypoints_internal, b, fast=args.fast_curvature)
+    triangles = recorder.run('triangles', triangles_from_keypoints, keypoints, max_triangles=args.max_triangles)
+    hashes = recorder.run('hashing', hash_triangles, img, triangles)
+    recorder.fragments['hashing'] += len(hashes)
+    return hashes, fragment_vertices(triangles)
+
+
+def run(args, recorder):
+    """Index and look up the demo images, returns whether each lookup ranked a right image first."""
+    originals = [curvature.local_maxima_of_curvature, curvature.local_maxima_of_curvature_batch]
+    curvature.local_maxima_of_curvature, curvature.local_maxima_of_curvature_batch = [
+        recorder.timed('curvature', fn) for fn in originals]
+
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            storage = scratch_storage(path, args.fake, args.storage)
+
+            for name in INDEXED:
+                hashes, vertices = features(recorder, cv2.imread(os.path.join(IMAGES, name)), args)
+                recorder.run('insert', storage.add_fragments, name, hashes, vertices)
+                recorder.fragments['insert'] += len(hashes)
+            recorder.run('insert', storage.flush)
+
+            queries = [(name, cv2.imread(os.path.join(IMAGES, name)), expected) for name, expected in CASES]
+            for name, angle, scale, shear in VARIANTS:
+                img = affine_variant(cv2.imread(os.path.join(IMAGES, name)), angle, scale, shear)
+                # the cats are all copies of one picture
+                expected = CATS if name in CATS else [name]
+                queries.append((f'{name} {angle:+d}deg x{scale} shear {shear}', img, expected))
+
+            top1 = {}
+            for label, img, expected in queries:
+                hashes, _ = features(recorder, img, args)
+                count = recorder.run('lookup', storage.query, hashes)
+                recorder.fragments['lookup'] += len(hashes)
+                ranked = count.most_common(1)
+                top1[label] = bool(ranked) and ranked[0][0] in expected
+
+            storage.close()
+    finally:
+        curvature.local_maxima_of_curvature, curvature.local_maxima_of_curvature_batch = originals
+
+    return top1
+
+
+def compare(results, baseline, threshold):
+    """Print the changes against `baseline`, returns whether anything regressed."""
+    if results['settings'] != baseline['settings']:
+        print(f'baseline settings {baseline["settings"]} differ from {results["settings"]}')
+
+    regressed = False
+    print(f'\n{"stage":<10} {"baseline":>9} {"now":>9} {"change":>8}')
+    for stage in STAGES:
+        before, now = baseline['stages'][stage]['seconds'], results['stages'][stage]['seconds']
+        slower = now > before * (1 + threshold) and now - before > MIN_REGRESSION
+        regressed |= slower
+        change = f'{now / before - 1:+8.0%}' if before else f'{"":>8}'
+        print(f'{stage:<10} {before:8.2f}s {now:8.2f}s {change}{"  REGRESSION" if slower else ""}')
+
+    for label, ok in results['top1'].items():
+        if baseline['top1'].get(label) and not ok:
+            print(f'top-1 lost: {label}')
+            regressed = True
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-triangles', type=int, default=10000)
+    parser.add_argument('--fast-curvature', action='store_true')
+    parser.add_argument('--fake', action='store_true', help='index into fakeredis instead of a temporary directory')
+    parser.add_argument('--storage', metavar='URL', help='index into this redis database, it is flushed')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--save', metavar='FILE', help='write the results as json')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against results written by --save')
+    parser.add_argument('--threshold', type=float, default=0.25, help='slowdown of a stage that is a regression')
+    args = parser.parse_args()
+
+    # scipy and sklearn are imported by the first call that needs them, not
+    # by the stage that happens to make it
+    features(Recorder(), cv2.imread(os.path.join(IMAGES, CATS[0])), args)
+
+    recorder = Recorder()
+    top1 = run(args, recorder)
+    if not args.no_memory:
+        traced = Recorder(trace=True)
+        run(args, traced)
+        recorder.peak = traced.peak
+
+    stages = {}
+    print(f'{"stage":<10} {"time":>9} {"fragments/s":>12} {"peak MB":>8}')
+    for stage in STAGES:
+        seconds = recorder.seconds[stage]
+        rate = recorder.fragments[stage] / seconds if stage in FRAGMENT_STAGES and seconds else None
+        peak = recorder.peak[stage] if not args.no_memory and stage != 'curvature' else None
+        stages[stage] = dict(seconds=seconds, fragments_per_second=rate, peak_bytes=peak)
+        print(f'{stage:<10} {seconds:8.2f}s {f"{rate:,.0f}" if rate else "":>12} '
+              f'{f"{peak / 2 ** 20:.1f}" if peak is not None else "":>8}')
+
+    print(f'\ntop-1 {sum(top1.values())}/{len(top1)}')
+    for label, ok in top1.items():
+        print(f'  {"ok  " if ok else "MISS"} {label}')
+
+    results = dict(
+        settings=dict(
+            max_triangles=args.max_triangles, fast_curvature=args.fast_curvature,
+            storage='fakeredis' if args.fake else 'redis' if args.storage else 'disk'),
+        stages=stages, top1=top1)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Lookup recall of the demo queries under triangle budgets, to check the default budget.
+
+Indexes cat1 to cat8, mona and van_gogh, then looks up the images that show
+some of them: 8cats.png (the 8 cats), monaComposite.jpg (mona and van_gogh)
+and mona.jpg recompressed as a JPEG of --quality. Every image is hashed once
+with all its triangles, each budget keeps the triangles select_triangles
+picks, as triangles_from_keypoints does with the same budget on insert and
+lookup.
+
+For the unlimited budget, every --max-triangles and every --max-degree it
+prints the fragments indexed, and for each query how many of the images it
+shows rank among its top results (as many as it shows) and their votes. Then
+the share of queries whose first result is one they show (top-1) and the
+mean over the queries of the share of their images found (recall). Hashing
+every triangle of the demo images takes a few minutes.
+
+    $ python benchmarks/triangle_budget.py --max-triangles 20000 5000 2000 --max-degree 100 30
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES, scratch_storage  # noqa: E402
+from transformation_invariant_image_search.keypoints import compute_keypoints  # noqa: E402
+from transformation_invariant_image_search.phash import hash_triangles, iter_triangles, select_triangles  # noqa: E402
+
+
+INDEXED = [f'cat{i}.png' for i in range(1, 9)] + ['mona.jpg', 'van_gogh.jpg']
+QUERIES = {
+    '8cats.png': [f'cat{i}.png' for i in range(1, 9)],
+    'monaComposite.jpg': ['mona.jpg', 'van_gogh.jpg'],
+    'mona.jpg jpeg': ['mona.jpg'],
+}
+
+
+def all_triangles(img):
+    """Hashes (n, 3) of the fragments, keypoint indexes (n, 3) and areas of every triangle of `img`."""
+    keypoints = np.asarray(compute_keypoints(img), dtype=float).reshape(-1, 2)
+    triangles, areas = [np.empty((0, 3), dtype=int)], [np.empty(0)]
+    for chunk, area in iter_triangles(keypoints):
+        triangles.append(chunk)
+        areas.append(area)
+
+    triangles = np.concatenate(triangles)
+    return hash_triangles(img, keypoints[triangles]).reshape(-1, 3), triangles, np.concatenate(areas)
+
+
+def budget_hashes(features, max_triangles=None, max_degree=None):
+    """Hashes of the fragments of the triangles kept under the budget."""
+    hashes, triangles, areas = features
+    if max_triangles is None and max_degree is None:
+        return hashes.ravel()
+    return hashes[select_triangles(triangles, areas, max_triangles, max_degree)].ravel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-triangles', type=int, nargs='*', default=[20000, 10000, 5000, 2000])
+    parser.add_argument('--max-degree', type=int, nargs='*', default=[100, 30])
+    parser.add_argument('--quality', type=int, default=30)
+    parser.add_argument('--fake', action='store_true', help='index into fakeredis instead of a temporary directory')
+    args = parser.parse_args()
+
+    images = {name: cv2.imread(os.path.join(IMAGES, name)) for name in INDEXED + list(QUERIES)[:2]}
+    mona = images['mona.jpg']
+    images['mona.jpg jpeg'] = cv2.imdecode(
+        cv2.imencode('.jpg', mona, [cv2.IMWRITE_JPEG_QUALITY, args.quality])[1], cv2.IMREAD_COLOR)
+
+    t = time.perf_counter()
+    features = {name: all_triangles(img) for name, img in images.items()}
+    print(f'hashed every triangle of {len(features)} images in {time.perf_counter() - t:.1f}s\n')
+
+    budgets = [('none', {})]
+    budgets += [(f'max-triangles {n}', dict(max_triangles=n)) for n in args.max_triangles]
+    budgets += [(f'max-degree {n}', dict(max_degree=n)) for n in args.max_degree]
+
+    header = ''.join(f' {name:>18}' for name in QUERIES)
+    print(f'{"budget":<20} {"fragments":>10}{header} {"top-1":>6} {"recall":>7}')
+    for label, budget in budgets:
+        with tempfile.TemporaryDirectory() as path:
+            storage = scratch_storage(path, fake=args.fake)
+            fragments = 0
+            for name in INDEXED:
+                hashes = budget_hashes(features[name], **budget)
+                storage.add_fragments(name, hashes)
+                fragments += len(hashes)
+            storage.flush()
+
+            cells, top1, recall = [], 0, 0
+            for query, expected in QUERIES.items():
+                ranked = storage.query(budget_hashes(features[query], **budget)).most_common()
+                top = [image for image, _ in ranked[:len(expected)] if image in expected]
+                votes = sum(v for image, v in ranked if image in expected)
+                cells.append(f'{len(top)}/{len(expected)} {votes:>8}')
+                top1 += bool(ranked) and ranked[0][0] in expected
+                recall += len(top) / len(expected)
+            storage.close()
+
+        print(f'{label:<20} {fragments:>10}' + ''.join(f' {cell:>18}' for cell in cells)
+              + f' {top1 / len(QUERIES):6.0%} {recall / len(QUERIES):7.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Speed and parity of triangles_from_keypoints against the set based version it replaced.
+
+The reference is triangles_from_keypoints as it was before triangles were
+enumerated from the annulus graph, with per keypoint python sets, nested
+loops and one np.cross per pair of keypoints. It returns the triangles as
+tuples of vertices in the order its sets happen to iterate, so both results
+are compared as sorted lists of triangles with sorted vertices.
+
+The keypoints are those of the demo images, then --keypoints random points
+spread at the keypoint density of mona.jpg. For each set the script prints
+the triangles found and the time of both versions, the reference is skipped
+above --max-reference keypoints. It exits with status 1 if the triangles of
+any set differ. Both run without a triangle budget.
+
+    $ python benchmarks/triangles.py --keypoints 100 500 2000 5000 20000
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import cv2
+import numpy as np
+from sklearn.neighbors import BallTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import IMAGES  # noqa: E402
+from transformation_invariant_image_search.keypoints import compute_keypoints  # noqa: E402
+from transformation_invariant_image_search.phash import triangles_from_keypoints  # noqa: E402
+
+
+NAMES = ['mona.jpg', 'cat1.png', 'monaComposite.jpg', 'van_gogh.jpg']
+
+
+def reference_triangles(keypoints, lower=50, upper=400):
+    keypoints = np.asarray(keypoints, dtype=float)
+
+    tree = BallTree(keypoints, leaf_size=10)
+    i_lower = tree.query_radius(keypoints, r=lower)
+    i_upper = tree.query_radius(keypoints, r=upper)
+    in_range = [set(u) - set(l) for l, u in zip(i_lower, i_upper)]
+
+    seen = set()
+    result = []
+
+    for i, center in enumerate(keypoints):
+        seen.add(i)
+
+        in_range_of_center = in_range[i] - seen
+        if not in_range_of_center:
+            continue
+
+        processed = set()
+
+        for j in in_range_of_center:
+            if j < i + 1:
+                continue
+
+            points_idx = in_range[j] & in_range_of_center - processed
+            if not points_idx:
+                continue
+
+            keypoint = keypoints[j]
+            points = keypoints[list(points_idx)]
+            area = np.absolute(np.cross(points - center, points - keypoint)) / 2
+            result += [(center, keypoint, p) for p in points[area > 1300]]
+
+            processed.add(j)
+
+    return result
+
+
+def canonical(triangles):
+    """The triangles (n, 3, 2) with their vertices sorted, in sorted order."""
+    triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 2)
+    order = np.lexsort((triangles[:, :, 1], triangles[:, :, 0]), axis=1)
+    rows = np.take_along_axis(triangles, order[:, :, None], axis=1).reshape(-1, 6)
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def random_keypoints(n, density, rng):
+    """`n` uniformly random keypoints in a square holding `density` keypoints per pixel."""
+    side = np.sqrt(n / density)
+    return rng.uniform(0, side, (n, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keypoints', type=int, nargs='+', default=[100, 500, 2000, 5000, 20000])
+    parser.add_argument('--max-reference', type=int, default=5000, help='most keypoints the reference is run on')
+    args = parser.parse_args()
+
+    # numpy 2 deprecates the np.cross of 2D vectors of the reference
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    sets = []
+    for name in NAMES:
+        img = cv2.imread(os.path.join(IMAGES, name))
+        sets.append((name, np.asarray(compute_keypoints(img), dtype=float).reshape(-1, 2)))
+
+    mona = cv2.imread(os.path.join(IMAGES, 'mona.jpg'))
+    density = len(sets[0][1]) / (mona.shape[0] * mona.shape[1])
+    rng = np.random.default_rng(0)
+    sets += [(f'random {n}', random_keypoints(n, density, rng)) for n in args.keypoints]
+
+    # scipy and sklearn are imported by the first call
+    triangles_from_keypoints(sets[0][1][:10])
+
+    failed = False
+    print(f'{"keypoints":<18} {"n":>6} {"triangles":>10} {"reference":>10} {"graph":>8} {"speedup":>8}')
+    for label, keypoints in sets:
+        t = time.perf_counter()
+        triangles = triangles_from_keypoints(keypoints)
+        graph = time.perf_counter() - t
+
+        if len(keypoints) > args.max_reference:
+            print(f'{label:<18} {len(keypoints):>6} {len(triangles):>10} {"-":>10} {graph:7.2f}s {"-":>8}')
+            continue
+
+        t = time.perf_counter()
+        expected = reference_triangles(keypoints)
+        reference = time.perf_counter() - t
+
+        same = np.array_equal(canonical(triangles), canonical(expected))
+        print(f'{label:<18} {len(keypoints):>6} {len(triangles):>10} {reference:9.2f}s {graph:7.2f}s '
+              f'{reference / graph:7.1f}x' + ('' if same else f'  differ, {len(expected)} triangles expected'))
+        failed |= not same
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,15 +27,17 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=[
         'hiredis',
         'numpy',
-        'redis',
+        'redis>=3.5',
         'scikit-learn',
         'scipy',
-        'tqdm>=4.29.1',
     ],
+    extras_require={
+        'progress': ['tqdm>=4.29.1'],
+    },
     entry_points={
         'console_scripts': [
             'transformation-invariant-image-search = transformation_invariant_image_search.main:main']
@@ -51,8 +53,7 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Internet :: WWW/HTTP :: Indexing/Search',
         'Topic :: Utilities'
     ]
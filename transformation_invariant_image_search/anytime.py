@@ -0,0 +1,88 @@
+"""Lookups that stop as soon as the best matches are settled.
+
+The triangles of the query are hashed and looked up in chunks, in a random
+order, so every chunk read is a sample of the fragments of the query without
+replacement. After each chunk the votes read so far rank the images, and the
+lookup stops when the top K are separated from the rest:
+
+- for certain, when the K-th image leads the next one by more votes than the
+  fragments left to read could give it,
+- or with the requested confidence by a sign test: if both images had as
+  many votes over all the fragments, each vote read for either would be a
+  fair coin flip, and the Hoeffding bound on a binomial says how unlikely the
+  lead is. Sampling without replacement only makes the bound safer,
+- or when the deadline has passed, with whatever confidence was reached.
+
+Easy queries, with one image far ahead, stop after a small share of their
+fragments; queries without a clear winner read all of them, which gives the
+same votes as a plain lookup.
+"""
+import math
+import time
+from collections import Counter
+
+import numpy as np
+
+from . import metrics
+
+
+# triangles of the first chunk, or this share of them when that is more,
+# later chunks double in size
+FIRST_CHUNK = 1 << 10
+FIRST_SHARE = 0.05
+
+
+def chunk_slices(n):
+    """Slices of range(n), each one twice the size of the one before."""
+    start, size = 0, max(FIRST_CHUNK, int(n * FIRST_SHARE))
+    while start < n:
+        yield slice(start, start + size)
+        start += size
+        size *= 2
+
+
+def confidence(votes, read, total, top=1):
+    """Confidence that the top `top` of the sorted `votes` after reading `read` of `total` fragments is final."""
+    if read >= total:
+        return 1.0
+    if read == 0:
+        return 0.0
+
+    kth = votes[top - 1] if len(votes) >= top else 0
+    next_ = votes[top] if len(votes) > top else 0
+    if kth - next_ > total - read:
+        return 1.0
+
+    if kth <= next_:
+        return 0.0
+    return 1 - math.exp(-(kth - next_) ** 2 / (2 * (kth + next_)))
+
+
+def query_anytime(storage, chunks, total, top=1, min_confidence=0.99, deadline=None, radius=0, max_df=None):
+    """(Counter, fragments read, confidence) of the chunks of hashes of a query with `total` fragments.
+
+    `chunks` yields the hashes of random samples of the fragments, see
+    chunk_slices. They are read until the `top` best images are settled with
+    `min_confidence` or time.perf_counter() passes `deadline`.
+    """
+    count = Counter()
+    read = 0
+    settled = 0.0
+
+    for hashes in chunks:
+        with metrics.timer('storage'):
+            count.update(storage.query(hashes, radius=radius, max_df=max_df))
+        read += len(hashes)
+
+        votes = sorted(count.values(), reverse=True)
+        settled = confidence(votes, read, total, top)
+        if settled >= min_confidence or (deadline is not None and time.perf_counter() > deadline):
+            break
+
+    metrics.count('fragments_read', read)
+    return count, read, settled
+
+
+def shuffled(n, seed=0):
+    """A fixed random order of range(n), so the same query reads the same fragments first."""
+    return np.random.default_rng(seed).permutation(n)
@@ -0,0 +1,120 @@
+"""On-disk cache of the keypoints, triangles and hashes of images.
+
+Entries are keyed by a digest of the decoded pixels and of every parameter
+that changes the features, so a renamed or re-encoded copy of an image hits
+the cache while a change of parameters or of the algorithm misses it. Each
+entry is one uncompressed .npz file; when the cache grows over `max_bytes`
+the least recently used entries are removed.
+
+Several processes can share a cache directory, entries are written to a
+temporary file and renamed into place.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from .keypoints import GAUSS_WIDTH
+from .phash import FRAGMENT_SIZE, HASH_SIZE, HASH_IMG_SIZE
+
+
+# bump when a change of the code changes the features
+VERSION = 6
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def open_cache(directory=None, max_bytes=DEFAULT_MAX_BYTES):
+    """The FeatureCache in `directory`, defaults to $IMAGE_SEARCH_CACHE. None when neither is set."""
+    directory = directory or os.environ.get('IMAGE_SEARCH_CACHE')
+    return FeatureCache(directory, max_bytes) if directory else None
+
+
+class FeatureCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, img, **params):
+        """Hex digest of the pixels of `img` and of the feature parameters."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr((VERSION, GAUSS_WIDTH, HASH_SIZE, HASH_IMG_SIZE, FRAGMENT_SIZE)).encode())
+        h.update(repr(sorted(params.items())).encode())
+        h.update(repr((img.shape, img.dtype.str)).encode())
+        h.update(np.ascontiguousarray(img).data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.npz')
+
+    def get(self, key):
+        """(keypoints, triangles, hashes) stored under `key`, or None."""
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                features = entry['keypoints'], entry['triangles'], entry['hashes']
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+
+        # the modification time is the last use for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return features
+
+    def put(self, key, keypoints, triangles, hashes):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(
+                    f, keypoints=np.asarray(keypoints, dtype=np.float64).reshape(-1, 2),
+                    triangles=np.asarray(triangles), hashes=np.asarray(hashes, dtype=np.uint64))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def entries(self):
+        for sub in os.scandir(self.directory):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    if entry.name.endswith('.npz'):
+                        yield entry
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_bytes`, returns how many."""
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(s for _, s, _ in entries)
+        removed = 0
+        for _, s, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= s
+            removed += 1
+
+        return removed
+
+    def report(self):
+        return f'feature cache: {self.hits} hits, {self.misses} misses'
@@ -0,0 +1,91 @@
+"""The features of an image: keypoints, triangles and the hashes of their fragments.
+
+insert, lookup, the lookup server and the bulk ingest all go through
+features_many, which reads the features from the FeatureCache when one is
+given, and finds and hashes them and stores them in it otherwise.
+"""
+from . import metrics
+from .keypoints import compute_keypoints
+from .phash import hash_triangles, triangles_from_keypoints
+from .pyramid import pyramid_hashes, pyramid_jobs, working_image
+
+
+# annulus radii and smallest area of the triangles, triangles_from_keypoints
+# takes them and the budget as keyword arguments
+TRIANGLE_OPTIONS = dict(lower=50, upper=400, min_area=1300)
+
+
+def triangle_options(max_triangles=None, max_degree=None):
+    """Keyword arguments of triangles_from_keypoints with the budget."""
+    return dict(TRIANGLE_OPTIONS, max_triangles=max_triangles, max_degree=max_degree)
+
+
+def find_triangles(img, options, fast_curvature=False, working_size=None, buffers=None):
+    """Keypoints and triangles of `img`, found on its working image with `working_size`, in `img` coordinates."""
+    work, scale = working_image(img, working_size) if working_size else (img, 1)
+    keypoints = compute_keypoints(work, fast=fast_curvature, buffers=buffers)
+    return keypoints, triangles_from_keypoints(keypoints, **options) / scale
+
+
+def hash_images(jobs, hash_many=None, working_size=None):
+    """Packed hashes of the triangles of every (img, triangles) job, from pyramid levels with `working_size`.
+
+    `hash_many` hashes a list of (img, triangles) jobs, like HashPool.hash_many,
+    all the jobs go to one call of it. They are hashed one by one in this
+    process without it.
+    """
+    if not jobs:
+        return []
+
+    levels = [pyramid_jobs(img, triangles) if working_size else [(img, triangles, None)] for img, triangles in jobs]
+    flat = [(img, triangles) for job in levels for img, triangles, _ in job]
+
+    with metrics.timer('hashing'):
+        results = iter(hash_many(flat) if hash_many is not None else [hash_triangles(img, t) for img, t in flat])
+
+    hashes = []
+    for (_, triangles), job in zip(jobs, levels):
+        job_hashes = [next(results) for _ in job]
+        hashes.append(pyramid_hashes(job, job_hashes, len(triangles)) if working_size else job_hashes[0])
+    return hashes
+
+
+def features(img, options, cache=None, hash_many=None, fast_curvature=False, working_size=None, buffers=None):
+    """Triangles and packed hashes of `img`, see features_many."""
+    return features_many([img], options, cache, hash_many, fast_curvature, working_size, buffers)[0]
+
+
+def features_many(images, options, cache=None, hash_many=None, fast_curvature=False, working_size=None,
+                  buffers=None):
+    """Triangles and packed hashes of every image, the triangles of all of them hashed in one call of `hash_many`.
+
+    `options` are the keyword arguments of triangles_from_keypoints, see
+    triangle_options, `fast_curvature` and `buffers` are passed on to
+    compute_keypoints and `working_size` turns on the pyramid mode of
+    pyramid.py. Images found in the FeatureCache `cache` aren't hashed, the
+    others are stored in it.
+    """
+    results = [None] * len(images)
+    pending = []
+    for i, img in enumerate(images):
+        key = None
+        if cache is not None:
+            with metrics.timer('cache'):
+                key = cache.key(img, fast_curvature=fast_curvature, working_size=working_size, **options)
+                cached = cache.get(key)
+            if cached is not None:
+                metrics.count('cache_hits')
+                results[i] = cached[1:]
+                continue
+
+        keypoints, triangles = find_triangles(img, options, fast_curvature, working_size, buffers)
+        pending.append((i, key, keypoints, triangles))
+
+    hashes = hash_images([(images[i], triangles) for i, _, _, triangles in pending], hash_many, working_size)
+    for (i, key, keypoints, triangles), h in zip(pending, hashes):
+        results[i] = triangles, h
+        if cache is not None:
+            with metrics.timer('cache'):
+                cache.put(key, keypoints, triangles, h)
+
+    return results
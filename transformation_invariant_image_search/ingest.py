@@ -0,0 +1,192 @@
+"""Bulk insert of many images.
+
+Worker processes decode, keypoint, triangulate and hash whole images in
+parallel while a writer thread stores the finished ones, so the storage
+connection is busy while the next images are processed. At most
+`max_in_flight` images are being processed or waiting to be written at any
+time, which keeps memory bounded when the storage is slower than the
+workers. Every `checkpoint` images the storage is checkpointed, images the
+storage already has are skipped, so an interrupted ingest can simply be run
+again and loses at most the images since the last checkpoint, or re-indexed
+with `replace`.
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from os import cpu_count
+
+import cv2
+
+from . import metrics
+from .features import features, triangle_options
+from .keypoints import RecolourBuffers
+from .phash import fragment_vertices
+from .storage import pack_vertices
+
+
+IMAGE_EXTENSIONS = {'.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'}
+
+
+def iter_directory(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, name)
+
+
+def iter_list(path):
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+# every worker process recolours one image at a time into the same planes
+_buffers = RecolourBuffers()
+
+
+def _hash_image(filename, max_triangles=None, max_degree=None, fast_curvature=False, working_size=None, cache=None):
+    options = triangle_options(max_triangles, max_degree)
+    record = metrics.Record(filename)
+
+    with metrics.collect(record):
+        with metrics.timer('decode'):
+            img = cv2.imread(filename)
+        if img is None:
+            return filename, None, None, record
+
+        triangles, hashes = features(
+            img, options, cache, fast_curvature=fast_curvature, working_size=working_size, buffers=_buffers)
+        metrics.count('fragments', len(hashes))
+
+    return filename, hashes, pack_vertices(fragment_vertices(triangles), len(hashes)), record
+
+
+class IngestStats:
+    def __init__(self):
+        self.seconds = Counter()
+        self.images = Counter()
+        self.fragments = 0
+        self.added = 0
+        self.skipped = 0
+        self.cache_hits = 0
+        self.failed = []
+        self.start = time.perf_counter()
+
+    def add(self, record):
+        self.seconds.update(record.seconds)
+        self.images.update(record.seconds.keys())
+
+    def report(self):
+        wall = time.perf_counter() - self.start
+        done = self.images['storage']
+        lines = [
+            f'indexed {done} images, skipped {self.skipped}, failed {len(self.failed)} '
+            f'in {wall:.1f}s ({done / wall:.2f} images/s)',
+            f'{self.fragments} fragments hashed, {self.added} new fragments stored',
+        ]
+
+        if self.cache_hits:
+            lines.append(f'  {self.cache_hits} images loaded from the feature cache')
+
+        for stage in metrics.STAGES:
+            n, seconds = self.images[stage], self.seconds[stage]
+            if n:
+                lines.append(f'  {stage:<10} {seconds:8.1f}s busy {n / seconds if seconds else 0:8.2f} images/s')
+
+        for filename, error in self.failed:
+            lines.append(f'  failed {filename}: {error}')
+
+        return '\n'.join(lines)
+
+
+def ingest(storage, filenames, processes=None, max_in_flight=None, checkpoint=100, log=print,
+           max_triangles=None, max_degree=None, fast_curvature=False, working_size=None, cache=None,
+           metrics_file=None, replace=False):
+    """Insert every image of `filenames` into `storage`, returns the IngestStats.
+
+    `max_triangles` and `max_degree` are passed on to triangles_from_keypoints,
+    `fast_curvature` to compute_keypoints, `working_size` turns on the pyramid
+    mode of pyramid.py. Features are read from and written
+    to the FeatureCache `cache` when one is given. The metrics.Record of every
+    stored image is written to `metrics_file` when one is given. With `replace`
+    images already in the storage are deleted and stored again.
+    """
+    processes = processes or cpu_count()
+    slots = threading.BoundedSemaphore(max_in_flight or 2 * processes)
+    done = queue.Queue()
+    stats = IngestStats()
+
+    def write():
+        while True:
+            item = done.get()
+            if item is None:
+                return
+
+            filename, hashes, vertices, record = item
+            try:
+                if hashes is None:
+                    stats.failed.append((filename, record if isinstance(record, str) else 'could not read image'))
+                    continue
+
+                with metrics.collect(record):
+                    with metrics.timer('storage'):
+                        if replace:
+                            storage.delete(filename)
+                        n = storage.add_fragments(filename, hashes, vertices)
+                    metrics.count('new_fragments', n)
+
+                stats.add(record)
+                stats.fragments += len(hashes)
+                stats.added += n
+                stats.cache_hits += record.counts['cache_hits']
+                log(f'added {n} fragments for {filename}')
+                if metrics_file is not None:
+                    metrics.dump(record, metrics_file)
+
+                if stats.images['storage'] % checkpoint == 0:
+                    storage.checkpoint()
+                    if cache is not None:
+                        cache.evict()
+            except Exception as e:
+                stats.failed.append((filename, repr(e)))
+            finally:
+                slots.release()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+
+    with multiprocessing.Pool(processes=processes) as pool:
+        for filename in filenames:
+            if not replace and storage.has_image(filename):
+                stats.skipped += 1
+                continue
+
+            # wait for a slot, this is what stops the workers from running
+            # ahead of the writer
+            slots.acquire()
+            pool.apply_async(
+                _hash_image, (filename, max_triangles, max_degree, fast_curvature, working_size, cache),
+                callback=done.put,
+                error_callback=lambda e, filename=filename: done.put((filename, None, None, repr(e))))
+
+        pool.close()
+        pool.join()
+
+    done.put(None)
+    writer.join()
+    storage.flush()
+    if cache is not None:
+        cache.evict()
+
+    return stats
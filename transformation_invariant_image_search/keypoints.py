@@ -10,7 +10,7 @@ import json
 import cv2
 import numpy as np
 
-from . import curvature
+from . import curvature, metrics
 
 
 PIXEL_VALS = [
@@ -32,16 +32,44 @@ PIXEL_VALS = [
     14, 162, 85, 39, 172, 104, 9, 200, 220, 139, 168, 95, 243, 197, 148, 102
 ]
 
+GAUSS_WIDTH = 21
 
-def recolour(img, gauss_width=41):
-    pixel_vals = np.array(PIXEL_VALS, dtype=img.dtype)
-    div = 40
+
+def banded_pixel_vals(div=40):
+    """PIXEL_VALS with each run of `div` values set to its first value, and the rest to the one after the last run."""
+    pixel_vals = np.array(PIXEL_VALS, dtype=np.uint8)
     size = div * (len(pixel_vals) // div)
 
     for i in range(0, size, div):
         pixel_vals[i:i + div] = pixel_vals[i]
 
     pixel_vals[size:] = pixel_vals[size]
+    return pixel_vals
+
+
+# the colour recolour gives a gray value v is RECOLOUR_LUT[v] in channel
+# 2 - RECOLOUR_LUT[v] % 3, so the blue channel is BLUE_LUT[v]
+RECOLOUR_LUT = banded_pixel_vals()
+BLUE_LUT = np.where(RECOLOUR_LUT % 3 == 2, RECOLOUR_LUT, 0).astype(np.uint8)
+
+
+class RecolourBuffers:
+    """Planes of recolour_blue reused across images of one size, by one thread at a time."""
+
+    def __init__(self):
+        self.blurred = None
+        self.blue = None
+
+    def planes(self, shape):
+        """(blurred, blue) planes for an image of `shape`, reallocated when the shape changes."""
+        if self.blurred is None or self.blurred.shape != shape:
+            self.blurred = np.empty(shape, dtype=np.uint8)
+            self.blue = np.empty(shape[:2], dtype=np.uint8)
+        return self.blurred, self.blue
+
+
+def recolour(img, gauss_width=41):
+    pixel_vals = RECOLOUR_LUT.astype(img.dtype)
 
     img = cv2.GaussianBlur(img, (gauss_width, gauss_width), 0)
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -55,12 +83,24 @@ def recolour(img, gauss_width=41):
     return img
 
 
-def compute_keypoints(img):
-    gauss_width = 21
-    img = recolour(img, gauss_width)
-    b, _, _ = cv2.split(img)
+def recolour_blue(img, gauss_width=41, out=None, blurred=None):
+    """The blue channel of recolour(img, gauss_width) of an 8 bit BGR image, without the other two.
+
+    The blurred image is written to `blurred` and the result to `out` when
+    they are given, see RecolourBuffers.
+    """
+    blurred = cv2.GaussianBlur(img, (gauss_width, gauss_width), 0, dst=blurred)
+    gray = cv2.cvtColor(blurred, cv2.COLOR_BGR2GRAY, dst=out)
+    return cv2.LUT(gray, BLUE_LUT, dst=gray)
 
-    points = compute_keypoints_internal(b)
+
+def compute_keypoints(img, fast=False, buffers=None):
+    """Keypoints of `img`, the planes of the RecolourBuffers `buffers` are reused when given."""
+    with metrics.timer('recolour'):
+        blurred, blue = buffers.planes(img.shape) if buffers is not None else (None, None)
+        b = recolour_blue(img, GAUSS_WIDTH, out=blue, blurred=blurred)
+
+    points = compute_keypoints_internal(b, fast=fast)
     # points.extend(compute_keypoints_internal(g))
     # points.extend(compute_keypoints_internal(r))
 
@@ -76,26 +116,37 @@ def find_contours(*args, **kwargs):
     return r['4' > cv2.__version__ >= '3']
 
 
-def compute_keypoints_internal(single_channel_image):
+def keypoint_contours(single_channel_image, area_here=400):
+    """Contours larger than `area_here` of the thresholded image, the keypoints are found on them."""
     ret, img = cv2.threshold(single_channel_image, 127, 255, cv2.THRESH_BINARY)
     contours = find_contours(img, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    return [c for c in contours if cv2.contourArea(c) > area_here]
+
+
+def compute_keypoints_internal(single_channel_image, fast=False):
+    with metrics.timer('contours'):
+        contours = keypoint_contours(single_channel_image)
 
-    area_here = 400
-    contours = [c for c in contours if cv2.contourArea(c) > area_here]
+        fin_contours = []
 
-    fin_contours = []
+        for cnt in contours:
+            M = cv2.moments(cnt)
+            c_x = int(M["m10"] / M["m00"])
+            c_y = int(M["m01"] / M["m00"])
+            fin_contours.append((c_x, c_y))
 
-    for cnt in contours:
-        M = cv2.moments(cnt)
-        c_x = int(M["m10"] / M["m00"])
-        c_y = int(M["m01"] / M["m00"])
-        fin_contours.append((c_x, c_y))
+    metrics.count('contours', len(contours))
 
-    for cnt in contours:
-        ret = np.array([(pt[0][0], pt[0][1]) for pt in cnt])
-        xcoords, ycoords = curvature.local_maxima_of_curvature(ret)
-        fin_contours += zip(xcoords, ycoords)
+    with metrics.timer('curvature'):
+        if fast:
+            xcoords, ycoords = curvature.local_maxima_of_curvature_batch(contours)
+            fin_contours += zip(xcoords, ycoords)
+        else:
+            for cnt in contours:
+                xcoords, ycoords = curvature.local_maxima_of_curvature(cnt.reshape(-1, 2))
+                fin_contours += zip(xcoords, ycoords)
 
+    metrics.count('keypoints', len(fin_contours))
     return fin_contours
 
 
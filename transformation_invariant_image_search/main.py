@@ -1,100 +1,520 @@
 """
-Usage: main.py lookup <image>...
-       main.py insert <image>...
+Usage: main.py lookup [--storage URL] [--max-triangles N] [--max-degree N] [--fast-curvature]
+                      [--working-size N] [--max-memory MB] [--radius N] [--verify K] [--idf]
+                      [--from-list FILE] [<image>...]
+       main.py lookup [--storage URL] [--max-triangles N] [--max-degree N] [--fast-curvature]
+                      [--working-size N] [--radius N] [--idf] --batch N [--from-list FILE] [<image>...]
+       main.py lookup [--storage URL] [--max-triangles N] [--max-degree N] [--fast-curvature]
+                      [--working-size N] [--radius N] --anytime K [--confidence P] [--deadline MS]
+                      [--from-list FILE] [<image>...]
+       main.py insert [--storage URL] [--max-triangles N] [--max-degree N] [--fast-curvature]
+                      [--working-size N] [--max-memory MB] [--replace] <image>...
+       main.py insert [--storage URL] [--max-triangles N] [--max-degree N] [--fast-curvature]
+                      [--working-size N] [--processes N] [--replace] [--recursive DIR] [--from-list FILE]
+                      [<image>...]
+       main.py delete [--storage URL] [--from-list FILE] [<image>...]
+       main.py serve [--storage URL] [--max-triangles N] [--max-degree N] [--fast-curvature]
+                     [--working-size N] [--processes N] [--radius N] [--listen ADDRESS]
+       main.py migrate [--storage URL]
+       main.py compact [--storage URL]
+       main.py reshard --storage URL,URL...
+
+insert, lookup and serve also take [--cache DIR] [--cache-size MB] to keep the
+features of every image in an on-disk cache, and every command takes
+[--max-df N] to treat fragments of N or more images as stop-fragments.
+insert, lookup and serve take [--metrics FILE] to log the time spent in every
+stage of every image as json lines and [--profile FILE] to write cProfile
+stats, insert and lookup take [--progress] to show a progress bar.
 """
+import argparse
+import cProfile
+import itertools
 import sys
-import multiprocessing
-from collections import Counter
-from os import cpu_count
 
-import cv2
-import redis
-import numpy as np
+# only the standard library is imported up front so that the command line is
+# parsed before numpy, OpenCV and scipy load, the functions below import the
+# rest of the package on the paths that need it
+from . import metrics
 
-from .keypoints import compute_keypoints
-from .phash import triangles_from_keypoints, hash_triangles
+# cache.DEFAULT_MAX_BYTES, server.DEFAULT_LISTEN and mih.MAX_RADIUS, without importing them
+DEFAULT_CACHE_MB = 1024
+DEFAULT_LISTEN = '127.0.0.1:8080'
+MAX_RADIUS = 11
 
 
-def phash_triangles(img, triangles, batch_size=None):
-    n = len(triangles)
+def insert(storage, hashes, filename, vertices=None, replace=False):
+    with metrics.timer('storage'):
+        if replace:
+            storage.delete(filename)
+        n = storage.add_fragments(filename, hashes, vertices)
+    metrics.count('new_fragments', n)
+    print(f'added {n} fragments for {filename}')
 
-    if batch_size is None:
-        batch_size = n // cpu_count()
 
-    array = np.asarray(triangles, dtype='d')
-    tasks = [(img, array[i:i + batch_size]) for i in range(0, n, batch_size)]
-    results = []
+def print_matches(count, filename):
+    print(f'matches for {filename}:')
+    for key, num in count.most_common():
+        print(f'{num:<10} {key}')
 
-    with multiprocessing.Pool(processes=cpu_count()) as p:
-        for result in p.starmap(hash_triangles, tasks):
-            results += result
 
-    return results
+def lookup(storage, hashes, filename, radius=0, vertices=None, top=0, idf=False):
+    from .verify import verify
 
+    with metrics.timer('storage'):
+        count = storage.query(hashes, radius=radius, idf=idf)
 
-def pipeline(r, data, chunk_size):
-    npartitions = len(data) // chunk_size
-    pipe = r.pipeline()
+    if not top:
+        print_matches(count, filename)
+        return
 
-    for chunk in np.array_split(data, npartitions or 1):
-        yield pipe, chunk
+    print(f'matches for {filename}:')
+    print(f'{"inliers":<10} {"votes":<10} image')
+    for key, num, inliers, transform in verify(storage, hashes, vertices, count, top=top):
+        print(f'{inliers:<10d} {num:<10} {key}')
+        if transform is not None:
+            print(' ' * 22 + 'transform ' + ' '.join(f'{x:.3f}' for x in transform.ravel()))
 
 
-def insert(chunks, filename):
-    n = 0
+def stream(storage, img, filename, args, options, pool, buffers=None):
+    """Insert or look up `img` a chunk of triangles at a time, within args.max_memory."""
+    import numpy as np
 
-    for pipe, keys in chunks:
-        for key in keys:
-            pipe.sadd(key, filename)
+    from .keypoints import compute_keypoints
+    from .pyramid import hash_triangles_pyramid, working_image
+    from .stream import chunk_size_for, hash_chunks, insert_chunks, query_chunks, triangle_chunks
 
-        n += sum(pipe.execute())
+    max_memory = args.max_memory << 20
+    work, scale = working_image(img, args.working_size) if args.working_size else (img, 1)
+    keypoints = compute_keypoints(work, fast=args.fast_curvature, buffers=buffers)
 
-    print(f'added {n} fragments for {filename}')
+    if args.working_size:
+        def hash_triangles(img, triangles):
+            return hash_triangles_pyramid(img, triangles, pool.hash_many)
+    else:
+        hash_triangles = pool.hash_triangles
 
+    triangles = (t / scale for t in triangle_chunks(keypoints, chunk_size_for(max_memory), **options))
+    chunks = hash_chunks(img, triangles, hash_triangles, max_memory)
 
-def lookup(chunks, filename):
-    count = Counter()
+    print()
+    if args.command == 'insert':
+        if args.replace:
+            storage.delete(filename)
+        print(f'added {insert_chunks(storage, filename, chunks)} fragments for {filename}')
+    elif args.verify:
+        # verification needs every fragment of the query at once
+        hashes, vertices = [np.empty(0, dtype=np.uint64)], [np.empty((0, 3, 2))]
+        for h, v in chunks:
+            hashes.append(h)
+            vertices.append(v)
+        lookup(
+            storage, np.concatenate(hashes), filename, radius=args.radius,
+            vertices=np.concatenate(vertices), top=args.verify, idf=args.idf)
+    else:
+        print_matches(query_chunks(storage, chunks, radius=args.radius, idf=args.idf), filename)
 
-    for pipe, keys in chunks:
-        for key in keys:
-            pipe.smembers(key)
 
-        for result in pipe.execute():
-            count.update(result)
+def anytime(storage, img, filename, args, options, cache, pool, start, buffers=None):
+    """Look up `img` reading its fragments in a random order until the top args.anytime matches are settled.
 
-    print(f'matches for {filename}:')
+    With a cache every triangle is hashed up front, so the next lookup of the
+    image reads them all from the cache, without one only the chunks read are.
+    """
+    from .anytime import chunk_slices, query_anytime, shuffled
+    from .features import features, find_triangles, hash_images
 
-    for key, num in count.most_common():
-        print(f'{num:<10d} {key.decode("utf-8")}')
+    if cache is not None:
+        triangles, hashes = features(
+            img, options, cache, pool.hash_many, args.fast_curvature, args.working_size, buffers)
+        hashes = hashes.reshape(-1, 3)[shuffled(len(triangles))]
+        chunks = (hashes[s].reshape(-1) for s in chunk_slices(len(triangles)))
+    else:
+        _, triangles = find_triangles(img, options, args.fast_curvature, args.working_size, buffers)
+        triangles = triangles[shuffled(len(triangles))]
+        chunks = (
+            hash_images([(img, triangles[s])], pool.hash_many, args.working_size)[0]
+            for s in chunk_slices(len(triangles)))
 
+    total = 3 * len(triangles)
+    count, read, settled = query_anytime(
+        storage, chunks, total, top=args.anytime, min_confidence=args.confidence, radius=args.radius,
+        deadline=start + args.deadline / 1000 if args.deadline else None)
+    metrics.count('fragments', read)
 
-def main():
-    if len(sys.argv) < 3:
-        print(__doc__)
-        exit(1)
+    print()
+    print_matches(count, filename)
+    print(f'read {read} of {total} fragments, top {args.anytime} settled with confidence {settled:.4f}')
 
-    command, *filenames = sys.argv[1:]
-    command = insert if command == 'insert' else lookup
 
-    r = redis.StrictRedis(host='localhost', port=6379, db=0)
+def progress(iterable, enabled, total=None):
+    """`iterable` with a progress bar on stderr when `enabled` and tqdm is installed."""
+    if not enabled:
+        return iterable
+
     try:
-        r.ping
-    except redis.ConnectionError:
-        print('You need to install redis.')
-        return
+        from tqdm import tqdm
+    except ImportError:
+        print('--progress needs tqdm, pip install tqdm', file=sys.stderr)
+        return iterable
 
-    for filename in filenames:
-        print('loading', filename)
-        img = cv2.imread(filename)
+    return tqdm(iterable, total=total, unit='image')
+
+
+def open_metrics(path):
+    if path is None:
+        return None
+    return sys.stdout if path == '-' else open(path, 'a')
+
+
+def process(storage, filename, args, options, cache, pool, buffers=None):
+    """Insert or look up the image `filename`."""
+    import time
 
-        keypoints = compute_keypoints(img)
-        triangles = triangles_from_keypoints(keypoints, lower=50, upper=400)
-        hashes = phash_triangles(img, triangles)
-        chunks = pipeline(r, hashes, chunk_size=1e5)
+    import cv2
 
+    from .features import features
+    from .phash import fragment_vertices
+
+    start = time.perf_counter()
+    with metrics.timer('decode'):
+        img = cv2.imread(filename)
+
+    if img is None:
         print()
-        command(chunks, filename)
+        print(f'could not read {filename}')
+        return
+
+    if args.max_memory is not None:
+        stream(storage, img, filename, args, options, pool, buffers)
+        return
+
+    if args.command == 'lookup' and args.anytime:
+        anytime(storage, img, filename, args, options, cache, pool, start, buffers)
+        return
+
+    triangles, hashes = features(img, options, cache, pool.hash_many, args.fast_curvature, args.working_size, buffers)
+    metrics.count('fragments', len(hashes))
+
+    print()
+    if args.command == 'insert':
+        insert(storage, hashes, filename, fragment_vertices(triangles), replace=args.replace)
+    else:
+        lookup(
+            storage, hashes, filename, radius=args.radius,
+            vertices=fragment_vertices(triangles), top=args.verify, idf=args.idf)
+
+
+def lookup_batches(storage, filenames, args, options, cache, pool, metrics_file=None):
+    """Look up `filenames` args.batch images at a time, see LookupService.lookup_many."""
+    import cv2
+
+    from .server import LookupService
+
+    service = LookupService(
+        storage, pool, radius=args.radius, fast_curvature=args.fast_curvature, working_size=args.working_size,
+        cache=cache, metrics_file=metrics_file, **options)
+
+    filenames = iter(filenames)
+    while True:
+        batch = list(itertools.islice(filenames, args.batch))
+        if not batch:
+            return
+
+        with metrics.collect(metrics.Record(batch)):
+            images = []
+            with metrics.timer('decode'):
+                for filename in batch:
+                    images.append(cv2.imread(filename))
+
+            counts = iter(service.lookup_many([img for img in images if img is not None], idf=args.idf))
+
+        for filename, img in zip(batch, images):
+            print()
+            if img is None:
+                print(f'could not read {filename}')
+            else:
+                print_matches(next(counts), filename)
+        sys.stdout.flush()
+
+
+def serve(storage, args, cache, options, metrics_file=None):
+    from .pool import HashPool
+    from .server import HashBatcher, LookupService, make_server
+
+    with HashPool(args.processes) as pool:
+        batcher = HashBatcher(pool)
+        service = LookupService(
+            storage, batcher, radius=args.radius, fast_curvature=args.fast_curvature,
+            working_size=args.working_size, cache=cache, metrics_file=metrics_file, **options)
+        server = make_server(service, args.listen)
+
+        print(f'listening on {args.listen}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            batcher.close()
+            storage.close()
+            if cache is not None:
+                cache.evict()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    storage = argparse.ArgumentParser(add_help=False)
+    storage.add_argument(
+        '--storage', metavar='URL',
+        help='redis:// url or index directory, defaults to $IMAGE_SEARCH_STORAGE or a local redis')
+    storage.add_argument(
+        '--max-df', type=int, metavar='N',
+        help='stop storing fragments once N images have them, and skip those in lookups')
+
+    budget = argparse.ArgumentParser(add_help=False)
+    budget.add_argument(
+        '--max-triangles', type=int, metavar='N', help='hash at most the N smallest triangles of each image')
+    budget.add_argument(
+        '--max-degree', type=int, metavar='N',
+        help='only hash triangles that are one of the N smallest triangles of one of their keypoints')
+    budget.add_argument(
+        '--fast-curvature', action='store_true',
+        help='find keypoints with a vectorised curvature estimate instead of spline fits, '
+             'use the same setting for insert and lookup')
+    budget.add_argument(
+        '--working-size', type=int, metavar='N',
+        help='find keypoints on a copy of the image downscaled to at most N pixels a side and sample every '
+             'fragment from a matching level of an image pyramid, use the same setting for insert and lookup')
+
+    budget.add_argument(
+        '--cache', metavar='DIR',
+        help='keep the keypoints, triangles and hashes of every image in DIR, defaults to $IMAGE_SEARCH_CACHE')
+    budget.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_MB, metavar='MB',
+        help='remove the least recently used cache entries above MB megabytes')
+
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument(
+        '--metrics', metavar='FILE',
+        help='append the time spent in every stage and the counts of every image to FILE as json lines, - for stdout')
+    output.add_argument(
+        '--profile', metavar='FILE', help='write cProfile stats of the main process to FILE, read them with pstats')
+
+    images = argparse.ArgumentParser(add_help=False)
+    images.add_argument(
+        '--progress', action='store_true', help='show a progress bar over the images, needs tqdm')
+    images.add_argument(
+        '--max-memory', type=int, metavar='MB',
+        help='find, hash and store or look up the triangles of each image in chunks that fit in MB megabytes, '
+             'and stop if the process and its workers use more, these images skip the cache, '
+             'not used by --recursive and --from-list')
+
+    insert_parser = commands.add_parser('insert', parents=[storage, budget, images, output])
+    insert_parser.add_argument('images', nargs='*')
+    insert_parser.add_argument(
+        '--recursive', metavar='DIR', action='append', default=[],
+        help='insert every image under DIR, processing several images in parallel')
+    insert_parser.add_argument(
+        '--from-list', metavar='FILE', action='append', default=[],
+        help='insert every image listed in FILE (one path per line, - for stdin) in parallel')
+    insert_parser.add_argument(
+        '--processes', type=int, metavar='N', help='worker processes for --recursive and --from-list')
+    insert_parser.add_argument(
+        '--replace', action='store_true',
+        help='remove the fragments of images that are already indexed before adding the new ones, '
+             'instead of adding to them or skipping them')
+
+    delete_parser = commands.add_parser('delete', parents=[storage], help='remove images from the index')
+    delete_parser.add_argument('images', nargs='*')
+    delete_parser.add_argument(
+        '--from-list', metavar='FILE', action='append', default=[],
+        help='delete every image listed in FILE (one path per line, - for stdin)')
+
+    commands.add_parser(
+        'migrate', parents=[storage], help='convert an index written by an older version, not lossless',
+        description='Convert the keys of an index written by an older version in place. The older versions hashed '
+                    'the fragments differently and about one hash in eight no longer matches exactly, lookups with '
+                    '--radius 4 still find them. Re-index the images with insert --replace for the full recall.')
+    commands.add_parser(
+        'compact', parents=[storage],
+        help='rewrite the index without what deleted images left behind, while nothing else uses it')
+    commands.add_parser(
+        'reshard', parents=[storage], help='move fragments to their shard after redis urls were added to --storage')
+
+    lookup_parser = commands.add_parser('lookup', parents=[storage, budget, images, output])
+    lookup_parser.add_argument('images', nargs='*')
+    lookup_parser.add_argument(
+        '--from-list', metavar='FILE', action='append', default=[],
+        help='look up every image listed in FILE (one path per line, - for stdin) as it is read, in one process')
+    lookup_parser.add_argument(
+        '--radius', type=int, default=0, metavar='N',
+        help=f'also match fragments whose hashes differ in up to N bits, at most {MAX_RADIUS}')
+    lookup_parser.add_argument(
+        '--verify', type=int, default=0, metavar='K',
+        help='re-rank the K best matches by how many exactly matching fragments agree on one affine transform')
+    lookup_parser.add_argument(
+        '--idf', action='store_true', help='weigh the votes of fragments by how few images have them')
+    lookup_parser.add_argument(
+        '--anytime', type=int, metavar='K',
+        help='read the fragments in a random order and stop once the K best matches are settled, '
+             'not with --verify, --idf, --batch or --max-memory')
+    lookup_parser.add_argument(
+        '--confidence', type=float, default=0.99, metavar='P',
+        help='confidence that the --anytime top K is final to stop at, defaults to 0.99')
+    lookup_parser.add_argument(
+        '--deadline', type=float, metavar='MS', help='stop an --anytime lookup after MS milliseconds per image')
+    lookup_parser.add_argument(
+        '--batch', type=int, metavar='N',
+        help='look up N images at a time, hashing them together and reading each distinct fragment once, '
+             'not with --verify or --max-memory')
+
+    serve_parser = commands.add_parser(
+        'serve', parents=[storage, budget, output], help='answer lookups over http with warm workers')
+    serve_parser.add_argument(
+        '--listen', default=DEFAULT_LISTEN, metavar='ADDRESS',
+        help=f'host:port or unix:/path/to/socket to listen on, defaults to {DEFAULT_LISTEN}')
+    serve_parser.add_argument('--processes', type=int, metavar='N', help='hashing worker processes')
+    serve_parser.add_argument(
+        '--radius', type=int, default=0, metavar='N', help=f'default hamming radius of lookups, at most {MAX_RADIUS}')
+
+    args = parser.parse_args(argv)
+    if args.command in ('lookup', 'serve') and not 0 <= args.radius <= MAX_RADIUS:
+        parser.error(f'--radius must be between 0 and {MAX_RADIUS}')
+    if args.command == 'insert' and not (args.images or args.recursive or args.from_list):
+        insert_parser.error('nothing to insert, pass images, --recursive or --from-list')
+    if args.command == 'lookup' and not (args.images or args.from_list):
+        lookup_parser.error('nothing to look up, pass images or --from-list')
+    if args.command == 'delete' and not (args.images or args.from_list):
+        delete_parser.error('nothing to delete, pass images or --from-list')
+    if args.command == 'lookup' and args.batch and (args.verify or args.max_memory is not None):
+        lookup_parser.error('--batch cannot be combined with --verify or --max-memory')
+    if args.command == 'lookup' and args.anytime and (
+            args.verify or args.idf or args.batch or args.max_memory is not None):
+        lookup_parser.error('--anytime cannot be combined with --verify, --idf, --batch or --max-memory')
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics_file = open_metrics(getattr(args, 'metrics', None))
+
+    try:
+        if getattr(args, 'profile', None):
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(run, args, metrics_file)
+            finally:
+                profiler.dump_stats(args.profile)
+        else:
+            return run(args, metrics_file)
+    finally:
+        if metrics_file not in (None, sys.stdout):
+            metrics_file.close()
+
+
+def run(args, metrics_file=None):
+    from .storage import open_storage
+
+    try:
+        storage = open_storage(args.storage, max_df=args.max_df)
+    except ConnectionError as e:
+        print(e)
+        return
+
+    if args.command == 'migrate':
+        print(f'migrated {storage.migrate()} fragments')
+        storage.close()
+        return
+
+    if args.command == 'delete':
+        from .ingest import iter_list
+
+        for filename in itertools.chain(args.images, *(iter_list(path) for path in args.from_list)):
+            n = storage.delete(filename)
+            print(f'{filename} is not indexed' if n is None else f'deleted {n} fragments of {filename}')
+        storage.close()
+        return
+
+    if args.command == 'compact':
+        postings, fragments, reclaimed = storage.compact()
+        print(f'removed {postings} postings and {fragments} empty fragments'
+              + (f', reclaimed {reclaimed / 2 ** 20:.1f} MB' if reclaimed is not None else ''))
+        storage.close()
+        return
+
+    if args.command == 'reshard':
+        if not hasattr(storage, 'reshard'):
+            print('reshard needs a sharded storage, pass comma separated redis urls to --storage')
+        else:
+            print(f'moved {storage.reshard()} fragments')
+        storage.close()
+        return
+
+    from .cache import open_cache
+    from .features import triangle_options
+    from .pool import HashPool
+
+    cache = open_cache(args.cache, args.cache_size << 20)
+    options = triangle_options(args.max_triangles, args.max_degree)
+    if args.command == 'serve':
+        serve(storage, args, cache, options, metrics_file)
+        return
+
+    if args.command == 'insert' and (args.recursive or args.from_list):
+        from .ingest import ingest, iter_directory, iter_list
+
+        sources = [args.images]
+        sources += [iter_directory(directory) for directory in args.recursive]
+        sources += [iter_list(path) for path in args.from_list]
+
+        stats = ingest(
+            storage, progress(itertools.chain.from_iterable(sources), args.progress), processes=args.processes,
+            log=(lambda message: None) if args.progress else print,
+            max_triangles=args.max_triangles, max_degree=args.max_degree,
+            fast_curvature=args.fast_curvature, working_size=args.working_size, cache=cache,
+            metrics_file=metrics_file, replace=args.replace)
+        print(stats.report())
+        storage.close()
+        return
+
+    from .ingest import iter_list
+    from .keypoints import RecolourBuffers
+
+    # with --from-list - the names are read as they arrive and every result is
+    # flushed, so a job runner can keep one warm process and pipe it names
+    filenames = itertools.chain(args.images, *(iter_list(path) for path in args.from_list))
+    buffers = RecolourBuffers()
+    status = 0
+    with HashPool() as pool:
+        if args.command == 'lookup' and args.batch:
+            lookup_batches(storage, progress(filenames, args.progress), args, options, cache, pool, metrics_file)
+        else:
+            for filename in progress(filenames, args.progress):
+                print('loading', filename)
+                record = metrics.Record(filename)
+                try:
+                    with metrics.collect(record):
+                        process(storage, filename, args, options, cache, pool, buffers)
+                except MemoryError as e:
+                    # the images after this one are not processed, fail the run
+                    print(e)
+                    status = 1
+                    break
+
+                if metrics_file is not None:
+                    metrics.dump(record, metrics_file)
+                sys.stdout.flush()
+
+    if cache is not None:
+        cache.evict()
+        print(cache.report())
+
+    storage.close()
+    return status
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
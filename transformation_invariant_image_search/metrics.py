@@ -0,0 +1,148 @@
+"""Per-image timers and counters of the pipeline stages.
+
+Code running a stage wraps it in `timer(stage)` and reports sizes with
+`count(name, n)`. Both do nothing unless a Record is being collected on the
+current thread, so the stages cost a thread local lookup when nobody is
+measuring. main.py writes the record of every image as a line of json with
+--metrics, and the lookup server adds them up and serves the totals in the
+Prometheus text format on /metrics.
+
+Stages:
+
+    decode      reading and decoding the image
+    cache       feature cache lookups
+    recolour    the blur and recolouring of compute_keypoints
+    contours    thresholding, contours and their centroids
+    curvature   the curvature maxima of the contours
+    triangles   triangles_from_keypoints
+    hashing     hashing the fragments, waiting for the workers included
+    storage     add_fragments and query calls
+
+Counters are contours, keypoints, triangles, fragments, new_fragments,
+cache_hits, fragments_read by anytime lookups, and round_trips and
+bytes_sent for redis.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+STAGES = 'decode', 'cache', 'recolour', 'contours', 'curvature', 'triangles', 'hashing', 'storage'
+
+_local = threading.local()
+
+
+class Record:
+    """Seconds spent in every stage and counters of one image."""
+
+    def __init__(self, image=None):
+        self.image = image
+        self.seconds = Counter()
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # records come back from ingest worker processes
+        return self.image, self.seconds, self.counts
+
+    def __setstate__(self, state):
+        self.image, self.seconds, self.counts = state
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def as_dict(self):
+        return dict(
+            image=self.image, seconds={stage: round(s, 6) for stage, s in self.seconds.items()},
+            counts=dict(self.counts))
+
+
+def current():
+    """The Record collected on this thread, or None."""
+    return getattr(_local, 'record', None)
+
+
+@contextmanager
+def collect(record):
+    """Collect the timers and counters of this thread into `record`."""
+    previous = current()
+    _local.record = record
+    try:
+        yield record
+    finally:
+        _local.record = previous
+
+
+def bind(fn):
+    """`fn` collecting into the record of the calling thread wherever it runs, for thread pools."""
+    record = current()
+    if record is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        with collect(record):
+            return fn(*args, **kwargs)
+
+    return bound
+
+
+@contextmanager
+def timer(stage):
+    record = current()
+    if record is None:
+        yield
+        return
+
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add(stage, time.perf_counter() - t)
+
+
+def count(name, n=1):
+    record = current()
+    if record is not None:
+        record.count(name, n)
+
+
+def dump(record, f):
+    """Write `record` to the file `f` as one line of json."""
+    f.write(json.dumps(record.as_dict()) + '\n')
+    f.flush()
+
+
+class Totals:
+    """Sums of many records, in the Prometheus text format."""
+
+    def __init__(self, prefix='image_search'):
+        self.prefix = prefix
+        self.images = 0
+        self.seconds = Counter()
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, record, images=1):
+        with self._lock:
+            self.images += images
+            self.seconds.update(record.seconds)
+            self.counts.update(record.counts)
+
+    def prometheus(self):
+        p = self.prefix
+        with self._lock:
+            lines = [f'# TYPE {p}_images_total counter', f'{p}_images_total {self.images}']
+            lines.append(f'# TYPE {p}_stage_seconds_total counter')
+            lines += [f'{p}_stage_seconds_total{{stage="{stage}"}} {self.seconds[stage]:.6f}' for stage in STAGES]
+            for name, n in sorted(self.counts.items()):
+                lines += [f'# TYPE {p}_{name}_total counter', f'{p}_{name}_total {n}']
+
+        return '\n'.join(lines) + '\n'
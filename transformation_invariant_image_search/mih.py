@@ -0,0 +1,93 @@
+"""Multi-index hashing, finds the stored hashes within a hamming radius of a
+query hash without comparing it against every hash in the database.
+
+Every 64-bit hash is split into TABLES substrings and each substring gets its
+own inverted table (bucket -> full hashes). Two hashes within radius r agree
+to within r // TABLES bits on at least one substring, so probing every table
+with the substrings of that radius finds every candidate, which is then
+verified by popcount.
+"""
+import itertools
+
+import numpy as np
+
+
+TABLES = 4
+SUBSTRING_BITS = 64 // TABLES
+
+# query hashes searched at once, bounds the (query, candidate) pairs held in memory
+SEARCH_BATCH = 4096
+
+# largest radius searched, its substrings flip at most 2 bits (137 buckets per
+# table), the buckets of larger radii grow combinatorially
+MAX_RADIUS = 3 * TABLES - 1
+
+POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+def hamming_distance(a, b):
+    x = np.ascontiguousarray(np.bitwise_xor(a, b, dtype=np.uint64))
+    return POPCOUNT[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+
+def flip_masks(radius, bits=SUBSTRING_BITS):
+    """All `bits` wide masks with at most `radius` bits set."""
+    masks = [0]
+    for r in range(1, radius + 1):
+        masks += [sum(1 << b for b in c) for c in itertools.combinations(range(bits), r)]
+    return np.array(masks, dtype=np.uint64)
+
+
+def buckets(hashes, masks=np.zeros(1, dtype=np.uint64)):
+    """Bucket ids (n, TABLES, len(masks)) of the substrings of the hashes, flipped by every mask.
+
+    The table number is stored above the substring bits, so ids of different
+    tables never collide.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    shifts = np.arange(TABLES - 1, -1, -1, dtype=np.uint64) * np.uint64(SUBSTRING_BITS)
+    substrings = (hashes[:, None] >> shifts) & np.uint64(2 ** SUBSTRING_BITS - 1)
+    tables = np.arange(TABLES, dtype=np.uint64) << np.uint64(SUBSTRING_BITS)
+    return (tables | substrings)[:, :, None] ^ masks
+
+
+def search(hashes, radius, fetch):
+    """Pairs (query index, stored hash) of every stored hash within `radius` of a query hash.
+
+    `fetch(bucket_ids)` returns the number of stored hashes in each bucket and
+    the stored hashes of all the buckets, concatenated in the same order.
+    """
+    if not 0 <= radius <= MAX_RADIUS:
+        raise ValueError(f'radius must be between 0 and {MAX_RADIUS}, got {radius}')
+
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    masks = flip_masks(radius // TABLES)
+    queries, stored = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.uint64)]
+
+    for i in range(0, len(hashes), SEARCH_BATCH):
+        query, found = _search(hashes[i:i + SEARCH_BATCH], radius, masks, fetch)
+        queries.append(query + i)
+        stored.append(found)
+
+    return np.concatenate(queries), np.concatenate(stored)
+
+
+def _search(hashes, radius, masks, fetch):
+    probes = buckets(hashes, masks)
+
+    unique, inverse = np.unique(probes, return_inverse=True)
+    lengths, candidates = fetch(unique)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+
+    # expand every (query, bucket) pair into (query, candidate) pairs
+    pair_bucket = inverse.reshape(-1)
+    pair_query = np.repeat(np.arange(len(hashes)), probes[0].size)
+    counts = lengths[pair_bucket]
+    starts = np.repeat(offsets[pair_bucket] - (np.cumsum(counts) - counts), counts)
+    query = np.repeat(pair_query, counts)
+    stored = candidates[starts + np.arange(counts.sum())]
+
+    keep = hamming_distance(hashes[query], stored) <= radius
+    pairs = np.unique(np.stack([query[keep].astype(np.uint64), stored[keep]], axis=1), axis=0)
+    return pairs[:, 0].astype(np.int64), pairs[:, 1]
@@ -1,11 +1,25 @@
-from sklearn.neighbors import BallTree
 import cv2
 import numpy as np
-import tqdm
 
+from . import metrics
 
-HEX_STRINGS = np.array([f'{x:02x}' for x in range(256)])
-BIN_POWERS = 2 ** np.arange(8)
+
+HASH_SIZE = 8
+HASH_IMG_SIZE = 32
+
+# size of the target image for affine transform
+FRAGMENT_SIZE = FRAGMENT_WIDTH, FRAGMENT_HEIGHT = int(60 * 0.86), 60
+
+# cv2.remap refuses maps with SHRT_MAX or more rows, so fragments are
+# sampled in stacks of at most this many
+FRAGMENT_BATCH = 512
+
+# candidate triangles checked at once by iter_triangles
+TRIANGLE_BATCH = 1 << 20
+
+# triangles hashed at once by hash_triangles, the transforms and the DCT
+# coefficients of a triangle take about 2.5kB
+HASH_BATCH = 1 << 12
 
 
 def phash(image, hash_size=8, highfreq_factor=4):
@@ -20,22 +34,85 @@ def phash(image, hash_size=8, highfreq_factor=4):
     return dctlowfreq > np.mean(dctlowfreq)
 
 
-def hash_to_hex(a):
-    index = np.sum(a * BIN_POWERS, axis=2)
-    return [''.join(x) for x in HEX_STRINGS[index]]
+def pack_hashes(a):
+    """Pack (n, 8, 8) boolean hashes into (n,) uint64, row 0 of the hash is the most significant byte."""
+    packed = np.packbits(a, axis=2, bitorder='little').reshape(len(a), HASH_SIZE)
+    return packed.view('>u8').reshape(len(a)).astype(np.uint64)
+
+
+def hash_to_hex(hashes):
+    """Hex strings of uint64 hashes, for debug output only."""
+    return [f'{h:016x}' for h in hashes.tolist()]
+
+
+def dct_matrix(n):
+    """Orthonormal DCT-II matrix, `dct_matrix(n) @ x @ dct_matrix(n).T == cv2.dct(x)`."""
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
 
+def resize_matrix(src, dst):
+    """Weights of a 1D `cv2.resize(..., interpolation=cv2.INTER_LINEAR)` from src to dst samples."""
+    x = np.clip((np.arange(dst) + 0.5) * src / dst - 0.5, 0, src - 1)
+    x0 = np.floor(x).astype(int)
+    x1 = np.minimum(x0 + 1, src - 1)
 
-def hash_triangles(img, triangles):
-    n = len(triangles)
-    triangles = np.asarray(triangles)
+    rows = np.arange(dst)
+    m = np.zeros((dst, src))
+    np.add.at(m, (rows, x0), 1 - (x - x0))
+    np.add.at(m, (rows, x1), x - x0)
+    return m
 
-    # basically the return value
-    hash_size = 8
-    hash_img_size = 32, 32
-    low_freq_dct = np.empty((3, n, hash_size, hash_size))
 
-    # size of the target image for affine transform
-    size = width, height = int(60 * 0.86), 60
+# resize to 32x32 followed by the low frequency rows of the DCT, folded into
+# one projection per axis: low_freq_dct = DCT_Y @ fragment @ DCT_X.T
+DCT_Y = (dct_matrix(HASH_IMG_SIZE)[:HASH_SIZE] @ resize_matrix(FRAGMENT_HEIGHT, HASH_IMG_SIZE)).astype(np.float32)
+DCT_X = (dct_matrix(HASH_IMG_SIZE)[:HASH_SIZE] @ resize_matrix(FRAGMENT_WIDTH, HASH_IMG_SIZE)).astype(np.float32)
+
+# the float32 products leave about 4e-8 of the DC coefficient in the other
+# coefficients of a flat fragment, where cv2.dct gives exact zeros, anything
+# below this share of the DC coefficient is taken as zero
+FLAT_TOLERANCE = 1e-5
+
+
+def to_gray(img):
+    img = img.astype(np.float32, copy=False)
+    if img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+
+def fragment_vertices(triangles):
+    """Vertices (3n, 3, 2) of every fragment of the triangles, in the order they are mapped to the target image.
+
+    Every triangle is rotated 3 times, one for each edge of the triangle, and
+    the last two vertices are swapped where needed so the fragment is never
+    mirrored. The result is ordered by triangle first and rotation second, so
+    the fragments of a slice of the triangles are a slice of the fragments.
+    """
+    triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 2)
+
+    # rotate triangles 3 times, one for each edge of the triangle
+    rotations = (0, 1, 2), (1, 2, 0), (2, 0, 1)
+    p = triangles[:, rotations, :]
+
+    # if p1 is to the right of p2, then switch
+    _ = np.cross(p[:, :, 1] - p[:, :, 0], p[:, :, 2] - p[:, :, 1]) > 0
+    p[_] = p[_][:, [0, 2, 1]]
+
+    return p.reshape(-1, 3, 2)
+
+
+def fragment_transforms(triangles):
+    """Affine transforms (3n, 2, 3) mapping each fragment of the triangles to the target image.
+
+    The fragments are the ones of fragment_vertices, in the same order.
+    """
+    vertices = fragment_vertices(triangles)
+    n = len(vertices)
+    width, height = FRAGMENT_SIZE
 
     # helper matrices
     empty_n_identity33 = np.empty((n, 3, 3))
@@ -48,80 +125,185 @@ def hash_triangles(img, triangles):
     input_points = empty_n_identity33.copy()
     transpose_m = empty_n_identity33
 
-    # rotate triangles 3 times, one for each edge of the triangle
-    rotations = (0, 1, 2), (1, 2, 0), (2, 0, 1)
-
-    for i, rotation in enumerate(tqdm.tqdm(rotations)):
-        p = triangles[:, rotation, :]
-
-        p0 = p[:, 0]
-        p1 = p[:, 1] - p0
-        p2 = p[:, 2] - p0
+    # calc_transformation_matrix
+    p0 = vertices[:, 0]
+    transpose_m[:, :2, 2] = -p0
+    input_points[:, :2, 0] = vertices[:, 1] - p0
+    input_points[:, :2, 1] = vertices[:, 2] - p0
 
-        # if p1 is to the right of p2, then switch
-        _ = np.cross(p1, p2 - p1) > 0
-        p1[_], p2[_] = p2[_], p1[_]
+    input_points_inverse = np.linalg.inv(input_points)
+    transform = target_points @ input_points_inverse @ transpose_m
+    return transform[:, :2, :]
 
-        # calc_transformation_matrix
-        transpose_m[:, :2, 2] = -p0
-        input_points[:, :2, 0] = p1
-        input_points[:, :2, 1] = p2
 
-        input_points_inverse = np.linalg.inv(input_points)
-        transform = target_points @ input_points_inverse @ transpose_m
-        transform = transform[:, :2, :]
+def sample_fragments(gray, transforms):
+    """Bilinear samples (len(transforms), height, width) of `gray`, like `cv2.warpAffine` for each transform."""
+    width, height = FRAGMENT_SIZE
+    n = len(transforms)
 
-        for k in tqdm.tqdm(range(n)):
-            image = cv2.warpAffine(img, transform[k], size)
+    # invert the transforms so they map target pixels back into the image
+    a = np.linalg.inv(transforms[:, :, :2])
+    b = -a @ transforms[:, :, 2:]
 
-            # calculate dct for perceptual hash
-            image = cv2.resize(image, hash_img_size)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            dct = cv2.dct(image.astype(float))
-            low_freq_dct[i, k] = dct[:hash_size, :hash_size]
+    y, x = np.mgrid[:height, :width]
+    grid = np.stack([x.ravel(), y.ravel(), np.ones(x.size)]).astype(np.float32)
+    maps = np.concatenate([a, b], axis=2).astype(np.float32).transpose(1, 0, 2) @ grid
+    map_x, map_y = maps.reshape(2, n * height, width)
 
-    # calculate perceptual hash for every triangle
-    low_freq_dct = low_freq_dct.reshape(3 * n, hash_size, hash_size)
-    low_freq_dct[:, 0, 0] = 0
-    mean = np.mean(low_freq_dct, axis=(1, 2))
-    hashes = low_freq_dct > mean[:, None, None]
+    fragments = cv2.remap(gray, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    return fragments.reshape(n, height, width)
 
-    return hash_to_hex(hashes)
 
+def hash_fragments(gray, transforms):
+    """Perceptual hashes (len(transforms), 8, 8) of the fragments of a grayscale float32 image.
 
-def triangles_from_keypoints(keypoints, lower=50, upper=400):
-    keypoints = np.asarray(keypoints, dtype=float)
-
-    tree = BallTree(keypoints, leaf_size=10)
-    i_lower = tree.query_radius(keypoints, r=lower)
-    i_upper = tree.query_radius(keypoints, r=upper)
-    in_range = [set(u) - set(l) for l, u in zip(i_lower, i_upper)]
+    All the fragments of a batch are sampled by one cv2.remap, and resized and
+    transformed by two matrix products instead of cv2.resize and cv2.dct, so
+    the rounding differs from phash of each fragment and a few hashes differ
+    in a bit or two, see benchmarks/hash_parity.py.
+    """
+    low_freq_dct = np.empty((len(transforms), HASH_SIZE, HASH_SIZE), dtype=np.float32)
 
-    seen = set()
-    result = []
+    for i in range(0, len(transforms), FRAGMENT_BATCH):
+        fragments = sample_fragments(gray, transforms[i:i + FRAGMENT_BATCH])
+        dct = DCT_Y @ fragments @ DCT_X.T
+        dct[np.abs(dct) < FLAT_TOLERANCE * np.abs(dct[:, :1, :1])] = 0
+        low_freq_dct[i:i + FRAGMENT_BATCH] = dct
 
-    for i, center in enumerate(keypoints):
-        seen.add(i)
+    # calculate perceptual hash for every triangle
+    low_freq_dct[:, 0, 0] = 0
+    mean = np.mean(low_freq_dct, axis=(1, 2))
+    return low_freq_dct > mean[:, None, None]
 
-        in_range_of_center = in_range[i] - seen
-        if not in_range_of_center:
-            continue
 
-        processed = set()
+def hash_triangles(img, triangles, batch_size=HASH_BATCH):
+    """Packed hashes (3n,) of the fragments of the triangles, `batch_size` triangles at a time."""
+    gray = to_gray(img)
+    triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 2)
+    hashes = np.empty(3 * len(triangles), dtype=np.uint64)
 
-        for j in in_range_of_center:
-            if j < i + 1:
-                continue
+    for i in range(0, len(triangles), batch_size):
+        batch = hash_fragments(gray, fragment_transforms(triangles[i:i + batch_size]))
+        hashes[3 * i:3 * i + len(batch)] = pack_hashes(batch)
 
-            points_idx = in_range[j] & in_range_of_center - processed
-            if not points_idx:
-                continue
+    return hashes
 
-            keypoint = keypoints[j]
-            points = keypoints[list(points_idx)]
-            area = np.absolute(np.cross(points - center, points - keypoint)) / 2
-            result += [(center, keypoint, p) for p in points[area > 1300]]
 
-            processed.add(j)
+def annulus_graph(keypoints, lower=50, upper=400):
+    """Upper triangular CSR adjacency (i < j) of the keypoints with lower < distance <= upper."""
+    # scipy and sklearn take most of the import time, the hashing workers never need them
+    from scipy import sparse
+    from sklearn.neighbors import BallTree
 
-    return result
+    n = len(keypoints)
+    tree = BallTree(keypoints, leaf_size=10)
+    neighbours, distances = tree.query_radius(keypoints, r=upper, return_distance=True)
+
+    rows = np.repeat(np.arange(n), [len(x) for x in neighbours])
+    cols = np.concatenate(neighbours)
+    keep = (np.concatenate(distances) > lower) & (cols > rows)
+
+    graph = sparse.csr_matrix((np.ones(keep.sum(), dtype=bool), (rows[keep], cols[keep])), shape=(n, n))
+    graph.sort_indices()
+    return graph
+
+
+def select_triangles(triangles, areas, max_triangles=None, max_degree=None):
+    """Sorted indexes of the triangles (n, 3) of keypoint indexes to keep under a budget.
+
+    Smaller triangles come first, they are the most likely to lie entirely
+    inside the part of an image that shows up in another image, and ordering
+    by area survives any affine transformation of the image. With `max_degree`
+    a triangle is kept if it's one of the `max_degree` smallest triangles of
+    any of its keypoints, which keeps triangles spread over the whole image.
+    With `max_triangles` only that many of the smallest remaining triangles
+    are kept. Ties are broken by keypoint index, so the selection is
+    deterministic.
+    """
+    order = np.lexsort((triangles[:, 2], triangles[:, 1], triangles[:, 0], areas))
+
+    if max_degree is not None:
+        # rank of every triangle among the triangles of each of its keypoints,
+        # the stable sort keeps the smallest first within a keypoint
+        vertices = triangles[order].ravel()
+        by_vertex = np.argsort(vertices, kind='stable')
+        sorted_vertices = vertices[by_vertex]
+        rank = np.arange(len(vertices)) - np.searchsorted(sorted_vertices, sorted_vertices)
+
+        keep = np.zeros(len(order), dtype=bool)
+        keep[by_vertex[rank < max_degree] // 3] = True
+        order = order[keep]
+
+    if max_triangles is not None:
+        order = order[:max_triangles]
+
+    return np.sort(order)
+
+
+def iter_triangles(keypoints, lower=50, upper=400, min_area=1300, batch_size=TRIANGLE_BATCH):
+    """Chunks (triangles (n, 3) of keypoint indexes, areas (n,)) of every triangle of triangles_from_keypoints.
+
+    Triangles are found by intersecting neighbourhoods in the annulus graph,
+    about `batch_size` candidates are checked for each chunk, so no chunk
+    holds more triangles than that.
+    """
+    keypoints = np.asarray(keypoints, dtype=float).reshape(-1, 2)
+    if len(keypoints) < 3:
+        return
+
+    graph = annulus_graph(keypoints, lower, upper)
+    n, indptr, indices = len(keypoints), graph.indptr, graph.indices
+
+    # edges (i, j), as sorted keys i * n + j for membership tests
+    degree = np.diff(indptr)
+    edge_i = np.repeat(np.arange(n), degree)
+    edge_j = indices
+    edge_keys = edge_i * n + edge_j
+
+    # every edge (i, j) with every neighbour k > j of j is a candidate, done in
+    # chunks of edges to bound the number of candidates held at once
+    wedges = np.cumsum(degree[edge_j])
+    start = 0
+
+    while start < len(edge_j):
+        stop = max(start + 1, np.searchsorted(wedges, wedges[start] + batch_size))
+        i, j = edge_i[start:stop], edge_j[start:stop]
+        counts = degree[j]
+
+        k_pos = np.repeat(indptr[j] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        i, j, k = np.repeat(i, counts), np.repeat(j, counts), indices[k_pos]
+
+        # keep wedges closed by an edge (i, k)
+        keys = i * n + k
+        pos = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+        closed = edge_keys[pos] == keys
+        i, j, k = i[closed], j[closed], k[closed]
+
+        center, keypoint, points = keypoints[i], keypoints[j], keypoints[k]
+        area = np.absolute(np.cross(points - center, points - keypoint)) / 2
+        large = area > min_area
+        yield np.stack([i[large], j[large], k[large]], axis=1), area[large]
+        start = stop
+
+
+def triangles_from_keypoints(keypoints, lower=50, upper=400, min_area=1300, max_triangles=None, max_degree=None):
+    """Every triangle (n, 3, 2) of keypoints that are pairwise within the annulus and has area > min_area.
+
+    Vertices are ordered by keypoint index, the triangles are the chunks of
+    iter_triangles in order. `max_triangles` and `max_degree` cap the number
+    of triangles, see select_triangles.
+    """
+    with metrics.timer('triangles'):
+        keypoints = np.asarray(keypoints, dtype=float).reshape(-1, 2)
+        triangles, areas = [np.empty((0, 3), dtype=int)], [np.empty(0)]
+        for chunk, area in iter_triangles(keypoints, lower, upper, min_area):
+            triangles.append(chunk)
+            areas.append(area)
+
+        triangles = np.concatenate(triangles)
+
+        if max_triangles is not None or max_degree is not None:
+            triangles = triangles[select_triangles(triangles, np.concatenate(areas), max_triangles, max_degree)]
+
+    metrics.count('triangles', len(triangles))
+    return keypoints[triangles]
@@ -0,0 +1,100 @@
+"""A long lived pool of hashing workers.
+
+Each image is converted to grayscale and copied into shared memory once, the
+workers only receive the name of the shared memory block and their slice of
+the triangles, and send back the packed hashes of their fragments.
+"""
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from os import cpu_count
+
+import numpy as np
+
+from .phash import hash_triangles, to_gray
+
+
+# smallest slice of triangles worth sending to a worker, anything less than
+# this is hashed in the calling process
+MIN_BATCH_SIZE = 256
+
+# slices per worker, so a slow slice doesn't leave the other workers idle
+TASKS_PER_PROCESS = 4
+
+
+def _hash_shared(name, shape, triangles):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        gray = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        hashes = hash_triangles(gray, triangles)
+        del gray
+    finally:
+        shm.close()
+
+    return hashes
+
+
+def batch_sizes(n, processes, batch_size=None):
+    if batch_size is None:
+        batch_size = max(MIN_BATCH_SIZE, -(-n // (processes * TASKS_PER_PROCESS)))
+    return range(0, n, batch_size), batch_size
+
+
+class HashPool:
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        # workers attaching to a block register it with the resource tracker,
+        # start it first so they share the tracker of the process that unlinks
+        resource_tracker.ensure_running()
+        self._pool = multiprocessing.Pool(processes=self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def hash_triangles(self, img, triangles, batch_size=None):
+        return self.hash_many([(img, triangles)], batch_size)[0]
+
+    def hash_many(self, jobs, batch_size=None):
+        """Hash the triangles of several (img, triangles) jobs in one round of tasks.
+
+        The triangles of all the jobs are split into slices together, so many
+        small jobs keep the workers as busy as one large one. Returns the packed
+        hashes of each job.
+        """
+        jobs = [(to_gray(img), np.asarray(triangles, dtype='d').reshape(-1, 3, 2)) for img, triangles in jobs]
+
+        starts, batch_size = batch_sizes(sum(len(t) for _, t in jobs), self.processes, batch_size)
+        if len(starts) < 2:
+            return [hash_triangles(gray, t) for gray, t in jobs]
+
+        blocks, tasks, owners = [], [], []
+        try:
+            for job, (gray, triangles) in enumerate(jobs):
+                shm = shared_memory.SharedMemory(create=True, size=gray.nbytes)
+                blocks.append(shm)
+
+                shared = np.ndarray(gray.shape, dtype=np.float32, buffer=shm.buf)
+                shared[:] = gray
+                del shared
+
+                for i in range(0, len(triangles), batch_size):
+                    tasks.append((shm.name, gray.shape, triangles[i:i + batch_size]))
+                    owners.append(job)
+
+            results = self._pool.starmap(_hash_shared, tasks)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        hashes = [[np.empty(0, dtype=np.uint64)] for _ in jobs]
+        for job, result in zip(owners, results):
+            hashes[job].append(result)
+
+        return [np.concatenate(h) for h in hashes]
@@ -0,0 +1,80 @@
+"""Image pyramid mode for large images.
+
+Keypoints and triangles are found on a copy of the image downscaled to a
+working size, so the blur, the contour and the annulus thresholds mean the
+same whatever the resolution of the input and their cost is bounded. The
+triangles are scaled back to the input and every fragment is sampled from
+the level of a gaussian pyramid of the input where its triangle is about the
+size of the fragment, so large triangles are averaged instead of aliased.
+"""
+import cv2
+import numpy as np
+
+from .phash import FRAGMENT_SIZE, hash_triangles, to_gray
+
+
+DEFAULT_WORKING_SIZE = 1024
+
+
+def working_image(img, working_size=DEFAULT_WORKING_SIZE):
+    """`img` downscaled so its longest side fits in `working_size`, and the scale factor.
+
+    Keypoints and triangles found on it are divided by the factor to get them
+    in the coordinates of `img`. Images are never upscaled.
+    """
+    scale = min(1.0, working_size / max(img.shape[:2]))
+    if scale == 1:
+        return img, scale
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+
+def triangle_levels(triangles):
+    """Pyramid level of each triangle, where its area is closest to the area of a fragment from above."""
+    p0, p1, p2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    area = np.abs(np.cross(p1 - p0, p2 - p0)) / 2
+    width, height = FRAGMENT_SIZE
+    with np.errstate(divide='ignore'):
+        ratio = np.sqrt(area / (width * height / 2))
+        return np.maximum(np.floor(np.log2(ratio)), 0).astype(int)
+
+
+def pyramid_jobs(img, triangles):
+    """(gray level, triangles in level coordinates, indexes of the triangles) of every level used."""
+    triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 2)
+    levels = triangle_levels(triangles)
+    gray = to_gray(img)
+    jobs = []
+
+    # a triangle inside the image is never larger than the image, so its
+    # level is never smaller than a fragment
+    for level in range(levels.max() + 1 if len(levels) else 0):
+        selected = np.flatnonzero(levels == level)
+        if len(selected):
+            jobs.append((gray, triangles[selected] / 2 ** level, selected))
+        gray = cv2.pyrDown(gray)
+
+    return jobs
+
+
+def hash_triangles_pyramid(img, triangles, hash_many=None):
+    """Packed hashes of the triangles of `img`, in the order of hash_triangles, each from its pyramid level.
+
+    `hash_many` hashes a list of (img, triangles) jobs, like HashPool.hash_many,
+    the jobs are hashed one by one in this process without it.
+    """
+    jobs = pyramid_jobs(img, triangles)
+    if hash_many is None:
+        results = [hash_triangles(gray, t) for gray, t, _ in jobs]
+    else:
+        results = hash_many([(gray, t) for gray, t, _ in jobs])
+
+    return pyramid_hashes(jobs, results, len(triangles))
+
+
+def pyramid_hashes(jobs, results, n):
+    """Packed hashes of the `n` triangles of pyramid_jobs `jobs` from the hashes of each job, in triangle order."""
+    hashes = np.empty((n, 3), dtype=np.uint64)
+    for (_, _, selected), result in zip(jobs, results):
+        hashes[selected] = result.reshape(-1, 3)
+
+    return hashes.reshape(-1)
@@ -0,0 +1,233 @@
+"""Long running lookup server.
+
+Keeps the imports, the storage connection and a pool of hashing workers warm
+between queries. Images are POSTed as encoded bytes and the matches come back
+as json:
+
+    $ curl --data-binary @monaComposite.jpg 'http://localhost:8080/lookup?radius=2'
+    {"matches": [["van_gogh.jpg", 136], ["mona.jpg", 10]]}
+
+GET /metrics returns the time spent in every stage and the counters of all
+the lookups so far in the Prometheus text format.
+
+Concurrent requests are coalesced: while the workers hash one round of
+triangles the next requests queue up, and all of them are hashed together in
+the next round. LookupService.lookup_many does the same for a batch of images
+from python, and also reads every distinct fragment of the batch only once.
+"""
+import json
+import os
+import queue
+import socketserver
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+from . import metrics
+from .features import TRIANGLE_OPTIONS, features_many
+from .mih import MAX_RADIUS
+
+
+DEFAULT_LISTEN = '127.0.0.1:8080'
+
+# most requests hashed in one round
+MAX_COALESCED = 32
+
+
+class HashBatcher:
+    """Hashes triangles for many threads, coalescing concurrent calls into HashPool.hash_many rounds."""
+
+    def __init__(self, pool, max_jobs=MAX_COALESCED):
+        self.pool = pool
+        self.max_jobs = max_jobs
+        self.jobs = queue.Queue()
+        self.rounds = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def hash_triangles(self, img, triangles):
+        return self.hash_many([(img, triangles)])[0]
+
+    def hash_many(self, jobs):
+        futures = []
+        for img, triangles in jobs:
+            futures.append(Future())
+            self.jobs.put((img, triangles, futures[-1]))
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _next_round(self):
+        batch = [self.jobs.get()]
+        while batch[-1] is not None and len(batch) < self.max_jobs:
+            try:
+                batch.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_round()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+
+            if batch:
+                self.rounds += 1
+                try:
+                    results = self.pool.hash_many([(img, triangles) for img, triangles, _ in batch])
+                except Exception as e:
+                    for _, _, future in batch:
+                        future.set_exception(e)
+                else:
+                    for (_, _, future), hashes in zip(batch, results):
+                        future.set_result(hashes)
+
+            if stop:
+                return
+
+
+class LookupService:
+    """The lookup pipeline, from encoded image bytes to the matching images."""
+
+    def __init__(self, storage, batcher, radius=0, fast_curvature=False, working_size=None, cache=None,
+                 metrics_file=None, **options):
+        self.storage = storage
+        self.batcher = batcher
+        self.radius = radius
+        self.fast_curvature = fast_curvature
+        self.working_size = working_size
+        self.cache = cache
+        self.options = dict(TRIANGLE_OPTIONS, **options)
+        self.totals = metrics.Totals()
+        self.metrics_file = metrics_file
+        self.metrics_lock = threading.Lock()
+
+    def hashes(self, img):
+        return self.hashes_many([img])[0]
+
+    def hashes_many(self, images):
+        """Packed hashes of every image, the triangles of all of them are hashed in one round of the workers."""
+        features = features_many(
+            images, self.options, self.cache, self.batcher.hash_many, self.fast_curvature, self.working_size)
+        return [hashes for _, hashes in features]
+
+    def lookup(self, data, radius=None):
+        """Counter of the images matching the encoded image `data`, None if it can't be decoded."""
+        with metrics.collect(metrics.Record()):
+            with metrics.timer('decode'):
+                img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                return None
+
+            return self.lookup_many([img], radius)[0]
+
+    def lookup_many(self, images, radius=None, idf=False):
+        """Counters of the images matching each of the decoded `images`, best first with most_common().
+
+        The images are hashed in one round of the workers and every distinct
+        fragment of all of them is read from the storage once. The metrics of
+        the batch go into the record being collected, or a new one.
+        """
+        record = metrics.current() or metrics.Record()
+        with metrics.collect(record):
+            hashes = self.hashes_many(images)
+            metrics.count('fragments', sum(len(h) for h in hashes))
+            with metrics.timer('storage'):
+                counts = self.storage.query_many(hashes, radius=self.radius if radius is None else radius, idf=idf)
+
+        self.totals.add(record, len(images))
+        if self.metrics_file is not None:
+            with self.metrics_lock:
+                metrics.dump(record, self.metrics_file)
+
+        return counts
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def respond(self, status, body, content_type='application/json'):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self.respond(200, {'status': 'ok'})
+        elif path == '/metrics':
+            self.respond(200, self.server.service.totals.prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self.respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/lookup':
+            self.respond(404, {'error': 'not found'})
+            return
+
+        try:
+            params = parse_qs(url.query)
+            radius = int(params['radius'][0]) if 'radius' in params else None
+            if radius is not None and not 0 <= radius <= MAX_RADIUS:
+                raise ValueError(f'radius must be between 0 and {MAX_RADIUS}')
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+            return
+
+        try:
+            count = self.server.service.lookup(data, radius)
+        except Exception as e:
+            self.respond(500, {'error': repr(e)})
+            return
+
+        if count is None:
+            self.respond(400, {'error': 'could not decode image'})
+            return
+
+        self.respond(200, {'matches': count.most_common()})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def make_server(service, listen=DEFAULT_LISTEN, quiet=False):
+    """HTTP server for `service` on `listen`, host:port or unix:/path/to/socket."""
+    if listen.startswith('unix:'):
+        server = UnixHTTPServer(listen[len('unix:'):], LookupHandler)
+    else:
+        host, _, port = listen.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), LookupHandler)
+
+    server.service = service
+    server.quiet = quiet
+    return server
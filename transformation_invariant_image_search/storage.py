@@ -0,0 +1,1325 @@
+"""Storage backends for the fragment index.
+
+Every backend maps fragment hashes to the images they were found in:
+
+    add_fragments(image_id, hashes, vertices=None, complete=True) -> number of new fragments
+    mark_indexed(image_id) -> after the last add_fragments(..., complete=False) of an image
+    query(hashes, radius=0, max_df=None, idf=False) -> Counter of image ids, one vote per matching fragment
+    query_many(hash_lists, radius=0, max_df=None, idf=False) -> the query of every list, reading each distinct hash once
+    geometry(image_id, hashes) -> the stored fragment vertices of the image for each hash
+    has_image(image_id) -> whether all the fragments of the image were stored
+    delete(image_id) -> number of fragments the image is removed from, None if it is not in the index
+    compact() -> (postings removed, empty fragments removed, bytes reclaimed or None)
+    checkpoint() -> make what was added so far survive a crash, cheaply
+    flush()
+    close()
+
+Hashes found in `max_df` or more images are stop-fragments, they say little
+about which image matches. With `max_df` given to a backend their sets stop
+growing at `max_df` images and lookups skip them without fetching their
+images. With `idf` lookups weigh every vote by the inverse document frequency
+of the matching fragment.
+
+Deleted images stop matching at once, lookups skip the ids of images that
+have no name any more. compact() rewrites the index without what deletes left
+behind, with the image ids numbered densely again, and is meant to run while
+nothing else uses the index.
+
+RedisStorage keeps the index in a redis server, ShardedStorage spreads it
+over several. DiskStorage keeps it in a directory of sorted, memory mapped
+arrays, so it needs no server and lookups are served straight from the page
+cache.
+"""
+import fcntl
+import glob
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import metrics, mih
+
+
+DEFAULT_STORAGE = 'redis://localhost:6379/0'
+
+# fragment vertices are stored as rounded uint16 pixel coordinates, MISSING
+# marks fragments stored without them
+MISSING = np.iinfo(np.uint16).max
+MISSING_VERTICES = np.full(6, MISSING, dtype='<u2').tobytes()
+
+# points of every shard on the consistent hashing ring
+REPLICAS = 64
+
+
+def hash_keys(hashes):
+    """Redis keys for uint64 hashes, the 8 big-endian bytes of each hash."""
+    data = np.asarray(hashes, dtype='>u8').tobytes()
+    return [data[i:i + 8] for i in range(0, len(data), 8)]
+
+
+def bucket_keys(buckets):
+    """Redis keys for multi-index hashing buckets, 7 bytes so they never collide with hash keys."""
+    data = np.asarray(buckets, dtype='>u4').tobytes()
+    return [b'mih' + data[i:i + 4] for i in range(0, len(data), 4)]
+
+
+def pack_vertices(vertices, n):
+    """(n, 3, 2) uint16 vertices, all MISSING when `vertices` is None."""
+    if vertices is None:
+        return np.full((n, 3, 2), MISSING, dtype=np.uint16)
+    return np.clip(np.rint(vertices), 0, MISSING - 1).astype(np.uint16).reshape(n, 3, 2)
+
+
+def unpack_vertices(packed):
+    """Float vertices of uint16 `packed`, nan where they are MISSING."""
+    vertices = packed.astype(float)
+    vertices[(packed == MISSING).any(axis=(1, 2))] = np.nan
+    return vertices
+
+
+def idf_weights(df, n):
+    """Inverse document frequency of fragments found in `df` of `n` images."""
+    return np.log((n + 1) / np.maximum(df, 1))
+
+
+def unique_matches(query, ids, df):
+    """Keep one of the matches (query, image id, df) per query and image, the one with the smallest df."""
+    order = np.lexsort((df, ids, query))
+    query, ids, df = query[order], ids[order], df[order]
+    first = np.ones(len(query), dtype=bool)
+    first[1:] = (query[1:] != query[:-1]) | (ids[1:] != ids[:-1])
+    return query[first], ids[first], df[first]
+
+
+def tally(counts, query, ids, df, n=None):
+    """Votes for each image id of the matches, `counts` is the number of occurrences of each query hash.
+
+    With the number of images `n` the votes are weighed by idf_weights.
+    """
+    if n is None:
+        return np.bincount(ids, weights=counts[query]).astype(np.int64)
+    return np.bincount(ids, weights=counts[query] * idf_weights(df, n))
+
+
+def batch_hashes(hash_lists):
+    """The distinct hashes of several queries, and (query, index into them, occurrences) of the hashes of each."""
+    hash_lists = [np.asarray(hashes, dtype=np.uint64).reshape(-1) for hashes in hash_lists]
+    owners = np.repeat(np.arange(len(hash_lists)), [len(hashes) for hashes in hash_lists])
+    unique, inverse = np.unique(np.concatenate([np.empty(0, dtype=np.uint64)] + hash_lists), return_inverse=True)
+
+    width = max(len(unique), 1)
+    pairs, counts = np.unique(owners * width + inverse.reshape(-1), return_counts=True)
+    return unique, (pairs // width, pairs % width, counts)
+
+
+def tally_batch(pairs, query, ids, df, n=None):
+    """Votes (query, image id, votes) of the matches (index into the distinct hashes, image id, df) of batch_hashes.
+
+    Every match votes in each query that has its hash, as often as it occurs
+    there, weighed by idf_weights with the number of images `n`.
+    """
+    owners, hash_index, counts = pairs
+    order = np.argsort(hash_index, kind='stable')
+    sorted_hashes = hash_index[order]
+
+    # the pairs of the hash of every match
+    starts = np.searchsorted(sorted_hashes, query, 'left')
+    k = np.searchsorted(sorted_hashes, query, 'right') - starts
+    positions = order[np.repeat(starts - (np.cumsum(k) - k), k) + np.arange(k.sum())]
+
+    weights = counts[positions] if n is None else counts[positions] * np.repeat(idf_weights(df, n), k)
+    images = np.repeat(ids, k)
+    width = int(images.max()) + 1 if len(images) else 1
+    keys, inverse = np.unique(owners[positions] * width + images, return_inverse=True)
+    votes = np.bincount(inverse.reshape(-1), weights=weights)
+    return keys // width, keys % width, votes if n is not None else votes.astype(np.int64)
+
+
+def batch_counters(n, owners, ids, votes, names):
+    """Counters of the image names of the votes (query, image id, votes) of `n` queries, like votes_counter."""
+    unique, inverse = np.unique(ids, return_inverse=True)
+    named = names(unique.tolist())
+    if votes.dtype.kind == 'f':
+        votes = votes.round(3)
+
+    counters = [Counter() for _ in range(n)]
+    for owner, i, v in zip(owners.tolist(), inverse.reshape(-1).tolist(), votes.tolist()):
+        if v and named[i] is not None:
+            counters[owner][named[i]] = v
+    return counters
+
+
+def votes_counter(votes, names):
+    """Counter of the image names of the non zero votes, names of None are deleted images."""
+    indexes = np.flatnonzero(votes)
+    values = votes[indexes]
+    if values.dtype.kind == 'f':
+        values = values.round(3)
+    return Counter({name: v for name, v in zip(names(indexes.tolist()), values.tolist()) if name is not None})
+
+
+def mix64(hashes):
+    """splitmix64 finalizer of uint64 hashes, perceptual hashes are far from uniformly spread."""
+    h = np.array(hashes, dtype=np.uint64)
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+    return h
+
+
+class HashRing:
+    """Consistent hashing of fragment hashes onto named nodes.
+
+    Every node owns `replicas` points of the ring and a hash belongs to the
+    node of the first point after it, so adding a node only moves the hashes
+    that now fall before one of its points.
+    """
+
+    def __init__(self, names, replicas=REPLICAS):
+        points = sorted(
+            (int.from_bytes(hashlib.blake2b(f'{name}#{i}'.encode(), digest_size=8).digest(), 'big'), node)
+            for node, name in enumerate(names) for i in range(replicas))
+        self.points = np.array([point for point, _ in points], dtype=np.uint64)
+        self.nodes = np.array([node for _, node in points])
+
+    def owners(self, hashes):
+        """Index of the node of each of the hashes."""
+        i = np.searchsorted(self.points, mix64(hashes), side='right') % len(self.points)
+        return self.nodes[i]
+
+
+def open_storage(url=None, max_df=None):
+    """Open the storage at `url`, a redis:// url, comma separated redis:// urls of shards or the
+    directory of a DiskStorage.
+
+    Defaults to $IMAGE_SEARCH_STORAGE, or a redis server on localhost.
+    """
+    url = url or os.environ.get('IMAGE_SEARCH_STORAGE') or DEFAULT_STORAGE
+
+    if ',' in url:
+        return ShardedStorage.from_urls(url.split(','), max_df=max_df)
+
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStorage.from_url(url, max_df=max_df)
+
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+
+    return DiskStorage(url, max_df=max_df)
+
+
+class RedisStorage:
+    """Fragment index in redis.
+
+    Keys:
+
+        <8 byte hash>      set of the integer ids of the images with that fragment
+        mih<4 byte bucket> set of the hash keys in a multi-index hashing bucket
+        image:ids          hash of image name -> id
+        image:names        hash of id -> image name
+        image:next         the next unused image id
+        image:indexed      set of the ids of the images whose fragments were all stored
+        image:<id>:vertices hash of hash key -> the 12 byte vertices of the fragment in image <id>,
+                           all MISSING when unknown
+
+    Image ids are small dense integers, so the fragment sets use redis' compact
+    intset encoding and lookups count votes with np.bincount.
+
+    The vertices hash of an image lists every fragment it was stored in, so
+    delete() only visits those sets instead of scanning the index.
+    """
+
+    def __init__(self, r, chunk_size=100000, in_flight=4, max_df=None):
+        self.r = r
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight
+        self.max_df = max_df
+        self.round_trips = 0
+        self._executor = None
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        r = redis.StrictRedis.from_url(url)
+        try:
+            r.ping()
+        except redis.ConnectionError as e:
+            raise ConnectionError(f'could not connect to redis at {url}, is redis-server running?') from e
+
+        return cls(r, **kwargs)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.r.close()
+
+    def checkpoint(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def execute(self, pipe):
+        self.round_trips += 1
+        metrics.count('round_trips')
+        if metrics.current() is not None:
+            metrics.count('bytes_sent', sum(
+                len(arg) if isinstance(arg, bytes) else len(str(arg))
+                for args, _ in pipe.command_stack for arg in args))
+        return pipe.execute()
+
+    def map_chunks(self, fn, n):
+        """[fn(pipe, chunk) for every chunk of range(n)], each chunk on its own non transactional pipeline.
+
+        Up to `in_flight` chunks run at once on the connections of the client's
+        pool, so one chunk is serialized while the replies of others are on
+        the way.
+        """
+        chunks = np.array_split(np.arange(n), max(1, -(-n // self.chunk_size)))
+
+        def run(chunk):
+            return fn(self.r.pipeline(transaction=False), chunk)
+
+        if len(chunks) == 1 or self.in_flight < 2:
+            return [run(chunk) for chunk in chunks]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.in_flight)
+
+        return list(self._executor.map(metrics.bind(run), chunks))
+
+    def image_index(self, image_id):
+        """Integer id of `image_id`, registering the image if it's new."""
+        index = self.r.hget('image:ids', image_id)
+        if index is not None:
+            return int(index)
+
+        index = self.r.incr('image:next') - 1
+        if not self.r.hsetnx('image:ids', image_id, index):
+            # registered concurrently by another client
+            return int(self.r.hget('image:ids', image_id))
+
+        self.r.hset('image:names', index, image_id)
+        return index
+
+    def image_names(self, indexes):
+        names = self.r.hmget('image:names', indexes) if len(indexes) else []
+        return [name.decode('utf-8') if name is not None else None for name in names]
+
+    def image_count(self):
+        return self.r.hlen('image:ids')
+
+    def add_fragments(self, image_id, hashes, vertices=None, complete=True):
+        """Add fragments of the image, it counts as indexed with `complete`, or once mark_indexed is called."""
+        index = self.image_index(image_id)
+        n = self.add_postings(index, hashes, vertices)
+        if complete:
+            self.r.sadd('image:indexed', index)
+        return n
+
+    def mark_indexed(self, image_id):
+        self.r.sadd('image:indexed', self.image_index(image_id))
+
+    def add_postings(self, index, hashes, vertices=None):
+        """Add the image with integer id `index` to the sets of the hashes, returns how many were new."""
+        # duplicates of a hash in one image add nothing to its set
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        packed = pack_vertices(vertices, len(hashes))
+        hashes, first = np.unique(hashes, return_index=True)
+        packed = packed[first]
+
+        def write(pipe, chunk):
+            keys = hash_keys(hashes[chunk])
+
+            for key in keys:
+                pipe.sadd(key, index)
+            if self.max_df is not None:
+                for key in keys:
+                    pipe.scard(key)
+
+            # also the list of the fragments of the image for delete
+            if len(chunk):
+                values = packed[chunk].reshape(len(chunk), -1).astype('<u2')
+                pipe.hset(f'image:{index}:vertices', mapping=dict(zip(keys, map(bytes, values))))
+
+            # the inverted tables used by lookups with a radius
+            for key, buckets in zip(keys, mih.buckets(hashes[chunk]).reshape(len(keys), mih.TABLES)):
+                for bucket in bucket_keys(buckets):
+                    pipe.sadd(bucket, key)
+
+            results = self.execute(pipe)
+            added = results[:len(keys)]
+            if self.max_df is None:
+                return sum(added)
+
+            # stop-fragments keep the first max_df images
+            sizes = results[len(keys):2 * len(keys)]
+            over = [key for key, a, size in zip(keys, added, sizes) if a and size > self.max_df]
+            for key in over:
+                pipe.srem(key, index)
+                pipe.hdel(f'image:{index}:vertices', key)
+            if over:
+                self.execute(pipe)
+            return sum(added) - len(over)
+
+        return sum(self.map_chunks(write, len(hashes)))
+
+    def has_image(self, image_id):
+        index = self.r.hget('image:ids', image_id)
+        return index is not None and bool(self.r.sismember('image:indexed', index))
+
+    def delete(self, image_id):
+        """Remove the image from the index, returns the number of fragments it was removed from or None.
+
+        The image stops counting as indexed first and loses its name last, so
+        lookups running meanwhile see fewer of its votes and then none.
+        """
+        index = self.r.hget('image:ids', image_id)
+        if index is None:
+            return None
+
+        index = int(index)
+        self.r.srem('image:indexed', index)
+        n = self.remove_postings(index)
+        self.forget(image_id, index)
+        return n
+
+    def remove_postings(self, index, batch_size=None):
+        """Remove the image with integer id `index` from the sets of its fragments, returns how many it was in.
+
+        The fragments are read from the image's vertices hash and removed
+        `batch_size` (chunk_size) at a time, an image without one has no
+        fragments here. Redis drops the sets left empty, their hash keys are
+        removed from the buckets as well.
+        """
+        vertices = f'image:{index}:vertices'
+        batch_size = batch_size or self.chunk_size
+        if not self.r.exists(vertices):
+            return 0
+
+        keys = (key for key, _ in self.r.hscan_iter(vertices, count=batch_size))
+        pipe = self.r.pipeline(transaction=False)
+        n = 0
+
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                break
+
+            for key in batch:
+                pipe.srem(key, index)
+            for key in batch:
+                pipe.exists(key)
+            results = self.execute(pipe)
+            n += sum(results[:len(batch)])
+
+            empty = [key for key, exists in zip(batch, results[len(batch):]) if not exists]
+            if empty:
+                buckets = mih.buckets(np.frombuffer(b''.join(empty), dtype='>u8').astype(np.uint64))
+                for key, bucket in zip(empty, buckets.reshape(len(empty), mih.TABLES)):
+                    for b in bucket_keys(bucket):
+                        pipe.srem(b, key)
+                self.execute(pipe)
+
+        # unlink frees a large hash without blocking the server
+        self.r.unlink(vertices)
+        return n
+
+    def forget(self, image_id, index):
+        """Remove the name of the image with integer id `index`."""
+        pipe = self.r.pipeline()
+        pipe.hdel('image:ids', image_id)
+        pipe.hdel('image:names', index)
+        pipe.execute()
+
+    def geometry(self, image_id, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = self.r.hget('image:ids', image_id)
+        if index is None:
+            return unpack_vertices(np.full((len(hashes), 3, 2), MISSING, dtype=np.uint16))
+
+        return unpack_vertices(self.vertices_of(int(index), hashes))
+
+    def vertices_of(self, index, hashes):
+        """(len(hashes), 3, 2) packed vertices of the fragments of image `index`, MISSING where there are none."""
+        packed = np.full((len(hashes), 3, 2), MISSING, dtype=np.uint16)
+
+        def read(pipe, chunk):
+            pipe.hmget(f'image:{index}:vertices', hash_keys(hashes[chunk]))
+            values, = self.execute(pipe)
+            found = [i for i, v in enumerate(values) if v is not None]
+            if found:
+                data = b''.join(values[i] for i in found)
+                packed[chunk[found]] = np.frombuffer(data, dtype='<u2').reshape(-1, 3, 2)
+
+        if len(hashes):
+            self.map_chunks(read, len(hashes))
+        return packed
+
+    def members(self, pipe, keys, max_df=None):
+        """Integer image ids of the fragment sets `keys`, empty for the sets of stop-fragments."""
+        keep = [True] * len(keys)
+        if max_df is not None:
+            # check the sizes first, so the images of stop-fragments are never sent
+            for key in keys:
+                pipe.scard(key)
+            keep = [df < max_df for df in self.execute(pipe)]
+
+        for key, k in zip(keys, keep):
+            if k:
+                pipe.smembers(key)
+
+        fetched = iter(self.execute(pipe))
+        members = [next(fetched) if k else () for k in keep]
+        lengths = np.array([len(m) for m in members], dtype=np.int64)
+        ids = np.fromiter(map(int, itertools.chain.from_iterable(members)), dtype=np.int64, count=lengths.sum())
+        return lengths, ids
+
+    def near_matches(self, pipe, hashes, radius, max_df=None):
+        """Matches (index into hashes, image id, df) of the stored hashes within `radius` of the hashes."""
+        def fetch(buckets):
+            for key in bucket_keys(buckets):
+                pipe.smembers(key)
+
+            found = self.execute(pipe)
+            lengths = [len(m) for m in found]
+            return lengths, np.frombuffer(b''.join(itertools.chain.from_iterable(found)), dtype='>u8').astype(np.uint64)
+
+        query, stored = mih.search(hashes, radius, fetch)
+        unique, inverse = np.unique(stored, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        lengths, ids = self.members(pipe, hash_keys(unique), max_df)
+
+        # the images of the stored hash of every pair
+        counts = lengths[inverse]
+        starts = (np.cumsum(lengths) - lengths)[inverse]
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return unique_matches(np.repeat(query, counts), ids[positions], np.repeat(counts, counts))
+
+    def query(self, hashes, radius=0, max_df=None, idf=False):
+        return votes_counter(self.votes(hashes, radius, max_df, idf), self.image_names)
+
+    def query_many(self, hash_lists, radius=0, max_df=None, idf=False):
+        hashes, pairs = batch_hashes(hash_lists)
+        votes = tally_batch(pairs, *self.matches(hashes, radius, max_df), self.image_count() if idf else None)
+        return batch_counters(len(hash_lists), *votes, self.image_names)
+
+    def votes(self, hashes, radius=0, max_df=None, idf=False):
+        """Votes for each integer image id, as an array indexed by id."""
+        # every hash is fetched once and votes as often as it occurs
+        hashes, counts = np.unique(np.asarray(hashes, dtype=np.uint64), return_counts=True)
+        query, ids, df = self.matches(hashes, radius, max_df)
+        return tally(counts, query, ids, df, self.image_count() if idf else None)
+
+    def matches(self, hashes, radius=0, max_df=None):
+        """Matches (index into hashes, image id, df), once for every image matching each of the hashes.
+
+        df is the number of images of the stored hash that matched, the sets
+        of stop-fragments (`max_df` defaults to the one of the storage) are
+        skipped.
+        """
+        max_df = self.max_df if max_df is None else max_df
+
+        def read(pipe, chunk):
+            if radius:
+                query, ids, df = self.near_matches(pipe, hashes[chunk], radius, max_df)
+                return chunk[query], ids, df
+
+            lengths, ids = self.members(pipe, hash_keys(hashes[chunk]), max_df)
+            return np.repeat(chunk, lengths), ids, np.repeat(lengths, lengths)
+
+        results = self.map_chunks(read, len(hashes))
+        return tuple(np.concatenate([np.empty(0, dtype=np.int64)] + [r[i] for r in results]) for i in range(3))
+
+    def migrate(self, batch_size=1000, registry=None):
+        """Rewrite an index written by older versions in the current layout.
+
+        Converts the fragment sets under keys of 16 hex characters, which hold
+        image names, to sets of integer image ids under the 8 byte keys, adds
+        them to their multi-index hashing buckets and lists them in the
+        vertices hash of their images with MISSING vertices. Sets written
+        since the upgrade are kept, a converted set is merged into one of the
+        same hash. Images are named and registered in the `registry` storage,
+        defaults to this one. Returns the number of rewritten fragment keys.
+        Don't run it while other clients are inserting, it can be run again
+        after it was interrupted.
+
+        The hashes are kept as they are, the older versions hashed each
+        fragment on its own and about one hash in eight differs from what
+        hash_triangles gives now, so only a re-index matches them all exactly.
+        """
+        registry = registry or self
+        n = 0
+        keys = (k for k in self.r.scan_iter(count=batch_size, _type='set') if len(k) == 16)
+
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                # indexes from before image:indexed only had complete images
+                ids = self.r.hvals('image:ids')
+                if ids:
+                    self.r.sadd('image:indexed', *ids)
+                return n
+
+            pipe = self.r.pipeline()
+            for key in batch:
+                pipe.smembers(key)
+            members = pipe.execute()
+
+            for key, names in zip(batch, members):
+                ids = [registry.image_index(name.decode('utf-8')) for name in names]
+                new_key = bytes.fromhex(key.decode('ascii'))
+
+                pipe.delete(key)
+                pipe.sadd(new_key, *ids)
+                for bucket in bucket_keys(mih.buckets(np.frombuffer(new_key, dtype='>u8')).ravel()):
+                    pipe.sadd(bucket, new_key)
+                for index in ids:
+                    pipe.hsetnx(f'image:{index}:vertices', new_key, MISSING_VERTICES)
+                n += 1
+
+            pipe.execute()
+
+    def compact(self, batch_size=1000):
+        """Rewrite the index with the image ids numbered densely again, see rewrite_postings.
+
+        Returns (postings removed, empty fragments removed, bytes reclaimed),
+        the bytes as reported by redis INFO or None where it has no INFO.
+        Don't run it while other clients use the index.
+        """
+        before = self.used_memory()
+        ids = self.dense_ids()
+        postings, fragments = self.rewrite_postings(ids, batch_size)
+        self.write_ids(ids)
+        after = self.used_memory()
+        return postings, fragments, None if before is None or after is None else before - after
+
+    def used_memory(self):
+        import redis
+
+        try:
+            return self.r.info('memory')['used_memory']
+        except redis.ResponseError:
+            return None
+
+    def dense_ids(self):
+        """{integer id: new id} of every named image, the new ids count up from 0 in the order of the old ones."""
+        old = sorted(int(index) for index in self.r.hvals('image:ids'))
+        return dict(zip(old, range(len(old))))
+
+    def rewrite_postings(self, ids, batch_size=1000):
+        """Renumber the fragment sets and vertices of the images with the {old id: new id} `ids`.
+
+        Ids missing from `ids`, of deleted images whose postings were left
+        behind, are removed, along with the sets and buckets left empty. Returns (postings
+        removed, fragments removed).
+        """
+        removed = fragments = 0
+        renumbered = set()
+        keys = (k for k in self.r.scan_iter(count=batch_size, _type='set') if len(k) == 8)
+        pipe = self.r.pipeline(transaction=False)
+
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                break
+
+            # scan can return a key twice, don't renumber a set twice
+            batch = [key for key in batch if key not in renumbered]
+            for key in batch:
+                pipe.smembers(key)
+
+            for key, members in zip(batch, pipe.execute()):
+                old = [int(m) for m in members]
+                changed = [i for i in old if ids.get(i) != i]
+                if not changed:
+                    continue
+
+                new = [ids[i] for i in changed if i in ids]
+                removed += len(changed) - len(new)
+                pipe.srem(key, *changed)
+                if new:
+                    # ids only ever go down, so a new id never collides with an unchanged one
+                    pipe.sadd(key, *new)
+                    renumbered.add(key)
+                elif len(changed) == len(old):
+                    fragments += 1
+                    for bucket in bucket_keys(mih.buckets(np.frombuffer(key, dtype='>u8')).ravel()):
+                        pipe.srem(bucket, key)
+            pipe.execute()
+
+        vertices = sorted(
+            (int(key.split(b':')[1]), key) for key in self.r.scan_iter('image:*:vertices', count=batch_size))
+        for index, key in vertices:
+            if index not in ids:
+                pipe.unlink(key)
+            elif ids[index] != index:
+                # in increasing order, the key of a new id was already moved away
+                pipe.rename(key, f'image:{ids[index]}:vertices')
+        pipe.execute()
+
+        return removed, fragments
+
+    def write_ids(self, ids):
+        """Rewrite the image keys with the {old id: new id} `ids`."""
+        names = {name: ids[int(index)] for name, index in self.r.hgetall('image:ids').items() if int(index) in ids}
+        indexed = [ids[int(index)] for index in self.r.smembers('image:indexed') if int(index) in ids]
+
+        pipe = self.r.pipeline()
+        pipe.delete('image:ids', 'image:names', 'image:indexed')
+        if names:
+            pipe.hset('image:ids', mapping=names)
+            pipe.hset('image:names', mapping={index: name for name, index in names.items()})
+        if indexed:
+            pipe.sadd('image:indexed', *indexed)
+        pipe.set('image:next', len(ids))
+        pipe.execute()
+
+
+class ShardedStorage:
+    """Fragment index spread over several redis servers.
+
+    Every fragment hash lives on the shard picked for it by a HashRing, along
+    with its multi-index hashing buckets and vertices, in the layout of
+    RedisStorage. The image keys are only kept on the first shard, so it has
+    to stay first when shards are added. Lookups send each shard the hashes it
+    owns in parallel, or every hash with a radius as near hashes can be
+    anywhere, and add up the votes.
+    """
+
+    def __init__(self, shards, names):
+        self.shards = shards
+        self.primary = shards[0]
+        self.ring = HashRing(names)
+        self.executor = ThreadPoolExecutor(len(shards))
+
+    @classmethod
+    def from_urls(cls, urls, **kwargs):
+        return cls([RedisStorage.from_url(url, **kwargs) for url in urls], urls)
+
+    def close(self):
+        self.executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+    def checkpoint(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def migrate(self, batch_size=1000):
+        """Migrate every shard, see RedisStorage.migrate. Images get their ids on the first shard.
+
+        Converted keys stay on the shard they were found on, reshard() moves them to their owners.
+        """
+        # the first shard last, it marks every image the others registered as indexed
+        shards = self.shards[1:] + [self.primary]
+        return sum(shard.migrate(batch_size, self.primary) for shard in shards)
+
+    def has_image(self, image_id):
+        return self.primary.has_image(image_id)
+
+    def delete(self, image_id):
+        """Remove the image from every shard, see RedisStorage.delete."""
+        index = self.primary.r.hget('image:ids', image_id)
+        if index is None:
+            return None
+
+        index = int(index)
+        self.primary.r.srem('image:indexed', index)
+        n = sum(self.executor.map(metrics.bind(lambda shard: shard.remove_postings(index)), self.shards))
+        self.primary.forget(image_id, index)
+        return n
+
+    def compact(self, batch_size=1000):
+        """Renumber the image ids densely on every shard, see RedisStorage.compact."""
+        before = [shard.used_memory() for shard in self.shards]
+        ids = self.primary.dense_ids()
+        removed = [shard.rewrite_postings(ids, batch_size) for shard in self.shards]
+        self.primary.write_ids(ids)
+        after = [shard.used_memory() for shard in self.shards]
+
+        reclaimed = None if None in before + after else sum(before) - sum(after)
+        return sum(postings for postings, _ in removed), sum(fragments for _, fragments in removed), reclaimed
+
+    def fan_out(self, fn, hashes):
+        """[fn(shard, mine) for every shard] in parallel, `mine` are the indexes of the hashes the shard owns."""
+        owners = self.ring.owners(hashes)
+        return list(self.executor.map(
+            metrics.bind(lambda node: fn(self.shards[node], np.flatnonzero(owners == node))), range(len(self.shards))))
+
+    def add_fragments(self, image_id, hashes, vertices=None, complete=True):
+        index = self.primary.image_index(image_id)
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        packed = pack_vertices(vertices, len(hashes)) if vertices is not None else None
+
+        def add(shard, mine):
+            return shard.add_postings(index, hashes[mine], None if packed is None else packed[mine])
+
+        n = sum(self.fan_out(add, hashes))
+        if complete:
+            self.primary.r.sadd('image:indexed', index)
+        return n
+
+    def mark_indexed(self, image_id):
+        self.primary.mark_indexed(image_id)
+
+    def geometry(self, image_id, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        packed = np.full((len(hashes), 3, 2), MISSING, dtype=np.uint16)
+        index = self.primary.r.hget('image:ids', image_id)
+
+        if index is not None:
+            def read(shard, mine):
+                packed[mine] = shard.vertices_of(int(index), hashes[mine])
+
+            self.fan_out(read, hashes)
+
+        return unpack_vertices(packed)
+
+    def matches(self, hashes, radius=0, max_df=None):
+        """Matches (index into hashes, image id, df) of the distinct `hashes` on every shard, see RedisStorage."""
+        if radius:
+            # a query fragment votes once per image, even when the image has
+            # near fragments on several shards
+            results = self.executor.map(metrics.bind(lambda shard: shard.matches(hashes, radius, max_df)), self.shards)
+            return unique_matches(*(np.concatenate(r) for r in zip(*results)))
+
+        def read(shard, mine):
+            query, ids, df = shard.matches(hashes[mine], max_df=max_df)
+            return mine[query], ids, df
+
+        return tuple(np.concatenate(r) for r in zip(*self.fan_out(read, hashes)))
+
+    def query(self, hashes, radius=0, max_df=None, idf=False):
+        hashes, counts = np.unique(np.asarray(hashes, dtype=np.uint64), return_counts=True)
+        query, ids, df = self.matches(hashes, radius, max_df)
+        votes = tally(counts, query, ids, df, self.primary.image_count() if idf else None)
+        return votes_counter(votes, self.primary.image_names)
+
+    def query_many(self, hash_lists, radius=0, max_df=None, idf=False):
+        hashes, pairs = batch_hashes(hash_lists)
+        votes = tally_batch(pairs, *self.matches(hashes, radius, max_df), self.primary.image_count() if idf else None)
+        return batch_counters(len(hash_lists), *votes, self.primary.image_names)
+
+    def reshard(self, batch_size=1000):
+        """Move every fragment to the shard that owns it, after shards were added. Returns how many moved.
+
+        Don't run it while other clients are inserting.
+        """
+        moved = 0
+
+        for node, shard in enumerate(self.shards):
+            keys = (k for k in shard.r.scan_iter(count=batch_size, _type='set') if len(k) == 8)
+
+            while True:
+                batch = list(itertools.islice(keys, batch_size))
+                if not batch:
+                    break
+
+                hashes = np.frombuffer(b''.join(batch), dtype='>u8').astype(np.uint64)
+                owners = self.ring.owners(hashes)
+
+                for target in np.unique(owners[owners != node]).tolist():
+                    mine = np.flatnonzero(owners == target)
+                    self.move(shard, self.shards[target], [batch[i] for i in mine], hashes[mine])
+                    moved += len(mine)
+
+        return moved
+
+    def move(self, source, target, keys, hashes):
+        """Move the fragments `keys` with their buckets and vertices from the shard `source` to `target`."""
+        pipe = source.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(key)
+        members = [sorted(int(m) for m in ids) for ids in pipe.execute()]
+
+        for key, ids in zip(keys, members):
+            for index in ids:
+                pipe.hget(f'image:{index}:vertices', key)
+        vertices = iter(pipe.execute())
+
+        buckets = [bucket_keys(b) for b in mih.buckets(hashes).reshape(len(keys), mih.TABLES)]
+        out = target.r.pipeline(transaction=False)
+        for key, ids, bucket in zip(keys, members, buckets):
+            out.sadd(key, *ids)
+            for b in bucket:
+                out.sadd(b, key)
+            for index in ids:
+                value = next(vertices)
+                if value is not None:
+                    out.hset(f'image:{index}:vertices', key, value)
+        out.execute()
+
+        # only remove them once the target has them
+        for key, ids, bucket in zip(keys, members, buckets):
+            pipe.delete(key)
+            for b in bucket:
+                pipe.srem(b, key)
+            for index in ids:
+                pipe.hdel(f'image:{index}:vertices', key)
+        pipe.execute()
+
+
+class DiskStorage:
+    """Fragment index in a directory of memory mapped numpy arrays.
+
+    Each generation of the index is a subdirectory holding:
+
+        hashes.npy         sorted unique uint64 hashes
+        offsets.npy        postings of hashes[i] are postings[offsets[i]:offsets[i + 1]]
+        postings.npy       indexes into images.json
+        vertices.npy       (len(postings), 3, 2) uint16 vertices of the fragment of each posting
+        mih_values.npy     (TABLES, n) sorted substrings of the hashes, one row per table
+        mih_order.npy      (TABLES, n) index into hashes of every entry of mih_values
+        images.json        list of image ids, null for deleted images
+        image_postings.npy number of postings of every image of images.json
+
+    New fragments are buffered and merged into a new generation on close(),
+    which is then switched to by atomically replacing the CURRENT file, so
+    readers never see a half written index. The generation switched from is
+    kept until the next switch, so readers opening it can finish, and lookups
+    switch to a generation another instance flushed meanwhile. With `max_df`
+    the merge keeps the postings of the first `max_df` images of every hash,
+    add_fragments counts the new fragments before that. Deleted images are
+    dropped by the merge too, compact() also renumbers the images that are
+    left.
+
+    The merge rewrites the whole index, checkpoint() instead writes the
+    fragments added since the last one next to the generation as
+    pending-<generation>-<n>.npz, which an instance opened later reads back
+    and the next merge folds in. Once the checkpoints hold as many postings as
+    the generation they are merged too, so a long ingest rewrites the index a
+    logarithmic number of times.
+
+    The first change takes an exclusive flock on the LOCK file, which is held
+    until close(), another instance changing the index waits for it. Only the
+    instance holding it writes checkpoints and generations, one that only
+    looks up writes nothing.
+    """
+
+    def __init__(self, path, max_df=None):
+        self.path = path
+        self.max_df = max_df
+        self.lock = threading.RLock()
+        self.writer = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def current(self):
+        """The generation named by the CURRENT file, None before the first flush."""
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        while True:
+            generation = self.current()
+            try:
+                self.open(generation)
+                return
+            except FileNotFoundError:
+                # a writer switched twice while the generation was opened and removed it, open the new one
+                if self.current() == generation:
+                    raise
+
+    def refresh(self):
+        """Switch to the generation another instance flushed since this one was opened.
+
+        The instance holding the writer lock has nothing to reload.
+        """
+        with self.lock:
+            if self.writer is None and self.current() != self.generation:
+                self.load()
+
+    def lock_for_writing(self):
+        """Take the writer lock, waiting for the instance that holds it, and reload what it wrote."""
+        with self.lock:
+            if self.writer is not None:
+                return
+            self.writer = open(os.path.join(self.path, 'LOCK'), 'a')
+            fcntl.flock(self.writer, fcntl.LOCK_EX)
+            self.load()
+
+    def open(self, generation):
+        self.generation = generation
+        if self.generation is None:
+            self.hashes = np.empty(0, dtype=np.uint64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.postings = np.empty(0, dtype=np.int32)
+            self.vertices = np.empty((0, 3, 2), dtype=np.uint16)
+            self.mih_values = np.empty((mih.TABLES, 0), dtype=np.uint16)
+            self.mih_order = np.empty((mih.TABLES, 0), dtype=np.uint32)
+            self.images = []
+            self.image_postings = np.empty(0, dtype=np.int64)
+        else:
+            directory = os.path.join(self.path, self.generation)
+            for name in ('hashes', 'offsets', 'postings', 'mih_values', 'mih_order'):
+                setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+
+            # generations from before vertices were stored
+            path = os.path.join(directory, 'vertices.npy')
+            if os.path.exists(path):
+                self.vertices = np.load(path, mmap_mode='r')
+            else:
+                self.vertices = np.full((len(self.postings), 3, 2), MISSING, dtype=np.uint16)
+
+            with open(os.path.join(directory, 'images.json')) as f:
+                self.images = json.load(f)
+
+            # counted on the first delete for generations from before they were stored
+            path = os.path.join(directory, 'image_postings.npy')
+            self.image_postings = np.load(path) if os.path.exists(path) else None
+
+        self.pending = []
+        self.pending_postings = Counter()
+        self.deleted = set()
+        self.incomplete = set()
+        self.checkpoints = sorted(glob.glob(os.path.join(self.path, f'pending-{self.generation or "000000"}-*.npz')))
+        for path in self.checkpoints:
+            with np.load(path) as checkpoint:
+                self.images.extend(json.loads(str(checkpoint['images'])))
+                for index in checkpoint['deleted'].tolist():
+                    self.images[index] = None
+                    self.deleted.add(index)
+                indexes, counts = np.unique(checkpoint['postings'], return_counts=True)
+                self.pending_postings.update(dict(zip(indexes.tolist(), counts.tolist())))
+        for index in self.deleted:
+            self.pending_postings.pop(index, None)
+
+        # images of the checkpoints are already written, later ones are not
+        self.checkpointed = len(self.images)
+        self.image_index = {image_id: i for i, image_id in enumerate(self.images) if image_id is not None}
+
+    def close(self):
+        if self.writer is None:
+            return
+
+        self.flush()
+        fcntl.flock(self.writer, fcntl.LOCK_UN)
+        self.writer.close()
+        self.writer = None
+
+    def migrate(self):
+        # this index has always used integer image ids
+        return 0
+
+    def has_image(self, image_id):
+        return image_id in self.image_index and self.image_index[image_id] not in self.incomplete
+
+    def register(self, image_id):
+        """Index of the image in images, appending it if it's new."""
+        if image_id not in self.image_index:
+            self.image_index[image_id] = len(self.images)
+            self.images.append(image_id)
+        return self.image_index[image_id]
+
+    def add_fragments(self, image_id, hashes, vertices=None, complete=True):
+        """Buffer fragments of the image, without `complete` the next flush drops it unless mark_indexed is called.
+
+        An image that is already indexed stays indexed, a chunked re-insert of
+        it only adds fragments.
+        """
+        self.lock_for_writing()
+        complete = complete or self.has_image(image_id)
+        index = self.register(image_id)
+        if complete:
+            self.incomplete.discard(index)
+        else:
+            self.incomplete.add(index)
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        packed = pack_vertices(vertices, len(hashes))
+        hashes, first = np.unique(hashes, return_index=True)
+        packed = packed[first]
+
+        # don't count fragments this image already has in the index
+        query, images = self.postings_of(hashes)
+        new = np.ones(len(hashes), dtype=bool)
+        new[query[images == index]] = False
+
+        self.pending.append((hashes[new], np.full(new.sum(), index, dtype=np.int32), packed[new]))
+        self.pending_postings[index] += int(new.sum())
+        return int(new.sum())
+
+    def mark_indexed(self, image_id):
+        self.lock_for_writing()
+        self.incomplete.discard(self.register(image_id))
+
+    def delete(self, image_id):
+        """Forget the image, its postings are dropped by the next flush. Returns how many it has or None."""
+        self.lock_for_writing()
+        index = self.image_index.pop(image_id, None)
+        if index is None:
+            return None
+
+        self.images[index] = None
+        self.deleted.add(index)
+        self.incomplete.discard(index)
+        if self.image_postings is None:
+            self.image_postings = np.bincount(self.postings, minlength=len(self.images))
+
+        stored = int(self.image_postings[index]) if index < len(self.image_postings) else 0
+        return stored + self.pending_postings.pop(index, 0)
+
+    def compact(self):
+        """Flush and rewrite the index without deleted images, numbering the rest densely.
+
+        Returns (postings removed, empty fragments removed, bytes reclaimed) like RedisStorage.compact.
+        """
+        self.lock_for_writing()
+        postings = len(self.postings) + sum(self.pending_postings.values())
+        fragments = len(self.fragments())
+        before = self.size()
+        self.flush()
+
+        live = [i for i, image_id in enumerate(self.images) if image_id is not None]
+        if len(live) < len(self.images):
+            renumber = np.full(len(self.images), -1, dtype=np.int32)
+            renumber[live] = np.arange(len(live), dtype=np.int32)
+            self.images = [self.images[i] for i in live]
+            self.write(np.repeat(self.hashes, np.diff(self.offsets)), renumber[self.postings], self.vertices)
+
+        return postings - len(self.postings), max(fragments - len(self.hashes), 0), before - self.size()
+
+    def fragments(self):
+        """Distinct hashes of the index, with those added since the last flush but not those of images deleted since."""
+        added = [(hashes, postings) for hashes, postings, _ in self.pending]
+        for path in self.checkpoints:
+            with np.load(path) as checkpoint:
+                added.append((checkpoint['hashes'], checkpoint['postings']))
+
+        deleted = np.fromiter(self.deleted, dtype=np.int32)
+        added = [hashes[~np.isin(postings, deleted)] for hashes, postings in added]
+        return np.union1d(self.hashes, np.concatenate([np.empty(0, dtype=np.uint64)] + added))
+
+    def size(self):
+        """Bytes of the files of the current generation."""
+        if self.generation is None:
+            return 0
+        directory = os.path.join(self.path, self.generation)
+        return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+    def checkpoint(self):
+        """Write the fragments added since the last checkpoint, or merge them all when they outgrew the index."""
+        # an image being added in chunks is written once it is complete
+        if self.writer is None or self.incomplete:
+            return
+
+        if sum(self.pending_postings.values()) >= len(self.postings):
+            self.flush()
+            return
+
+        if not self.pending and not self.deleted and self.checkpointed == len(self.images):
+            return
+
+        path = os.path.join(self.path, f'pending-{self.generation or "000000"}-{len(self.checkpoints):06d}.npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(
+                f, hashes=np.concatenate([np.empty(0, dtype=np.uint64)] + [h for h, _, _ in self.pending]),
+                postings=np.concatenate([np.empty(0, dtype=np.int32)] + [p for _, p, _ in self.pending]),
+                vertices=np.concatenate([np.empty((0, 3, 2), dtype=np.uint16)] + [v for _, _, v in self.pending]),
+                images=np.array(json.dumps(self.images[self.checkpointed:])),
+                deleted=np.fromiter(self.deleted, dtype=np.int64))
+        os.replace(path + '.tmp', path)
+
+        self.checkpoints.append(path)
+        self.checkpointed = len(self.images)
+        self.pending = []
+
+    def flush(self):
+        # without the writer lock the checkpoints are another instance's and there is nothing of this one
+        if self.writer is None:
+            return
+
+        # images added in chunks that never got their last one, they were not
+        # indexed before so their fragments are all in pending
+        if self.incomplete:
+            incomplete = np.fromiter(self.incomplete, dtype=np.int32)
+            pending, self.pending = self.pending, []
+            for hashes, postings, vertices in pending:
+                keep = ~np.isin(postings, incomplete)
+                self.pending.append((hashes[keep], postings[keep], vertices[keep]))
+            for index in self.incomplete:
+                del self.image_index[self.images[index]]
+                self.images[index] = None
+                self.pending_postings.pop(index, None)
+            self.incomplete = set()
+
+        if not (self.pending or self.deleted or self.checkpoints):
+            return
+
+        checkpoints = []
+        for path in self.checkpoints:
+            with np.load(path) as checkpoint:
+                checkpoints.append((checkpoint['hashes'], checkpoint['postings'], checkpoint['vertices']))
+        self.pending = checkpoints + self.pending
+
+        lengths = np.diff(self.offsets)
+        hashes = np.concatenate([np.repeat(self.hashes, lengths)] + [h for h, _, _ in self.pending])
+        postings = np.concatenate([self.postings] + [p for _, p, _ in self.pending])
+        vertices = np.concatenate([self.vertices] + [v for _, _, v in self.pending])
+        self.pending = []
+        self.pending_postings = Counter()
+
+        order = np.lexsort((postings, hashes))
+        hashes, postings, vertices = hashes[order], postings[order], vertices[order]
+
+        # an image added in several calls between flushes can repeat a fragment
+        first = np.ones(len(hashes), dtype=bool)
+        first[1:] = (hashes[1:] != hashes[:-1]) | (postings[1:] != postings[:-1])
+        hashes, postings, vertices = hashes[first], postings[first], vertices[first]
+
+        if self.deleted:
+            keep = ~np.isin(postings, np.fromiter(self.deleted, dtype=np.int32))
+            hashes, postings, vertices = hashes[keep], postings[keep], vertices[keep]
+            self.deleted = set()
+
+        if self.max_df is not None and len(hashes):
+            # rank of every posting among the postings of its hash
+            starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+            rank = np.arange(len(hashes)) - np.repeat(starts, np.diff(np.r_[starts, len(hashes)]))
+            keep = rank < self.max_df
+            hashes, postings, vertices = hashes[keep], postings[keep], vertices[keep]
+
+        self.write(hashes, postings, vertices)
+
+    def write(self, hashes, postings, vertices):
+        """Write the postings, sorted by hash and image, as a new generation and switch to it."""
+        unique, offsets = np.unique(hashes, return_index=True)
+        offsets = np.append(offsets, len(hashes)).astype(np.int64)
+
+        substrings = mih.buckets(unique)[:, :, 0].T & np.uint64(2 ** mih.SUBSTRING_BITS - 1)
+        mih_order = np.argsort(substrings, axis=1, kind='stable').astype(np.uint32)
+        mih_values = np.take_along_axis(substrings, mih_order, axis=1).astype(np.uint16)
+
+        generation = f'{int(self.generation or 0) + 1:06d}'
+        directory = os.path.join(self.path, generation)
+        os.makedirs(directory, exist_ok=True)
+
+        arrays = dict(
+            hashes=unique, offsets=offsets, postings=postings, vertices=vertices,
+            mih_values=mih_values, mih_order=mih_order,
+            image_postings=np.bincount(postings, minlength=len(self.images)))
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f'{name}.npy'), array)
+
+        with open(os.path.join(directory, 'images.json'), 'w') as f:
+            json.dump(self.images, f)
+
+        current = os.path.join(self.path, 'CURRENT')
+        with open(current + '.tmp', 'w') as f:
+            f.write(generation)
+        os.replace(current + '.tmp', current)
+
+        # keep the generation switched from for readers that are opening it,
+        # open mappings of the older ones stay valid after they are removed
+        for entry in os.scandir(self.path):
+            if entry.is_dir() and entry.name.isdigit() and entry.name not in (generation, self.generation):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        # the checkpoints are merged, including any a crash left behind at this point before
+        for path in glob.glob(os.path.join(self.path, 'pending-*.npz')):
+            os.remove(path)
+
+        self.load()
+
+    def positions_of(self, hashes):
+        """Pairs (index into hashes, index into postings) for every posting of each of the hashes."""
+        idx = np.searchsorted(self.hashes, hashes)
+        idx[idx == len(self.hashes)] = 0
+        found = np.flatnonzero(self.hashes[idx] == hashes) if len(self.hashes) else np.empty(0, dtype=int)
+
+        starts = self.offsets[idx[found]]
+        counts = self.offsets[idx[found] + 1] - starts
+        query = np.repeat(found, counts)
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return query, positions
+
+    def postings_of(self, hashes):
+        """Pairs (index into hashes, image index) for every stored image of each of the hashes."""
+        query, positions = self.positions_of(hashes)
+        return query, np.asarray(self.postings[positions])
+
+    def geometry(self, image_id, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        packed = np.full((len(hashes), 3, 2), MISSING, dtype=np.uint16)
+
+        with self.lock:
+            self.refresh()
+            if image_id in self.image_index:
+                query, positions = self.positions_of(hashes)
+                mine = np.asarray(self.postings[positions]) == self.image_index[image_id]
+                packed[query[mine]] = self.vertices[positions[mine]]
+
+        return unpack_vertices(packed)
+
+    def fetch_buckets(self, buckets):
+        tables = (buckets >> np.uint64(mih.SUBSTRING_BITS)).astype(np.int64)
+        values = (buckets & np.uint64(2 ** mih.SUBSTRING_BITS - 1)).astype(np.uint16)
+        lo = np.empty(len(buckets), dtype=np.int64)
+        hi = np.empty(len(buckets), dtype=np.int64)
+
+        for table in range(mih.TABLES):
+            selected = tables == table
+            lo[selected] = np.searchsorted(self.mih_values[table], values[selected], 'left')
+            hi[selected] = np.searchsorted(self.mih_values[table], values[selected], 'right')
+
+        # positions of every entry of every bucket in the flattened mih_order
+        counts = hi - lo
+        starts = lo + tables * len(self.hashes)
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return counts, np.asarray(self.hashes[self.mih_order.reshape(-1)[positions]])
+
+    def matches(self, hashes, radius=0, max_df=None):
+        """Matches (index into hashes, image index, df), once for every image matching each of the hashes."""
+        max_df = self.max_df if max_df is None else max_df
+
+        if radius:
+            query, stored = mih.search(hashes, radius, self.fetch_buckets)
+        else:
+            query, stored = np.arange(len(hashes)), hashes
+
+        idx = np.searchsorted(self.hashes, stored)
+        idx[idx == len(self.hashes)] = 0
+        found = self.hashes[idx] == stored if len(self.hashes) else np.zeros(len(stored), dtype=bool)
+        query, idx = query[found], idx[found]
+
+        starts = self.offsets[idx]
+        df = self.offsets[idx + 1] - starts
+        if max_df is not None:
+            # stop-fragments
+            keep = df < max_df
+            query, starts, df = query[keep], starts[keep], df[keep]
+
+        positions = np.repeat(starts - (np.cumsum(df) - df), df) + np.arange(df.sum())
+        matches = np.repeat(query, df), np.asarray(self.postings[positions], dtype=np.int64), np.repeat(df, df)
+        return unique_matches(*matches) if radius else matches
+
+    def query(self, hashes, radius=0, max_df=None, idf=False):
+        hashes, counts = np.unique(np.asarray(hashes, dtype=np.uint64), return_counts=True)
+        with self.lock:
+            self.refresh()
+            query, ids, df = self.matches(hashes, radius, max_df)
+            votes = tally(counts, query, ids, df, len(self.image_index) if idf else None)
+            return votes_counter(votes, self.image_names)
+
+    def query_many(self, hash_lists, radius=0, max_df=None, idf=False):
+        hashes, pairs = batch_hashes(hash_lists)
+        with self.lock:
+            self.refresh()
+            votes = tally_batch(pairs, *self.matches(hashes, radius, max_df), len(self.image_index) if idf else None)
+            return batch_counters(len(hash_lists), *votes, self.image_names)
+
+    def image_names(self, indexes):
+        return [self.images[i] for i in indexes]
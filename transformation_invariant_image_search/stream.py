@@ -0,0 +1,148 @@
+"""Memory bounded hashing of images with very many triangles.
+
+The triangles of an image are found, hashed and sent to the storage in
+chunks, so only one chunk of triangles, hashes and vertices is held at a
+time. An image inserted chunk by chunk has the same fragments as one inserted
+at once, and the votes of a lookup are the sums of the votes of its chunks.
+"""
+import multiprocessing
+import resource
+import sys
+from collections import Counter
+
+import numpy as np
+
+from . import metrics
+from .phash import fragment_vertices, iter_triangles, triangles_from_keypoints
+
+
+# memory taken by hashing whatever the chunk size, see phash.HASH_BATCH
+HASHING_BYTES = 64 << 20
+
+# memory a triangle of a chunk takes while its candidates are checked, it is
+# hashed, sent to the storage and its matches counted
+BYTES_PER_TRIANGLE = 1024
+
+MIN_CHUNK_SIZE = 1 << 10
+MAX_CHUNK_SIZE = 1 << 16
+
+
+def peak_memory():
+    """Peak resident memory of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but macOS
+    return peak if sys.platform == 'darwin' else peak << 10
+
+
+def process_memory(pid='self'):
+    """Memory of the process `pid` in bytes, None without /proc.
+
+    The proportional set size where the kernel has it, which splits shared
+    pages such as the images in shared memory between the processes mapping
+    them, else the resident set size.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def current_memory():
+    """Memory in use by this process and its child processes, the hashing workers, in bytes.
+
+    Without /proc it falls back to the peak resident memory of this process,
+    which never goes down and leaves the workers out.
+    """
+    memory = process_memory()
+    if memory is None:
+        return peak_memory()
+    return memory + sum(process_memory(child.pid) or 0 for child in multiprocessing.active_children())
+
+
+def check_memory(max_memory):
+    if max_memory is None:
+        return
+
+    memory = current_memory()
+    if memory > max_memory:
+        raise MemoryError(f'memory of {memory >> 20} MB is over --max-memory {max_memory >> 20} MB')
+
+
+def chunk_size_for(max_memory):
+    """Triangles per chunk that fit in the memory left under `max_memory` bytes."""
+    check_memory(max_memory)
+    size = (max_memory - current_memory() - HASHING_BYTES) // BYTES_PER_TRIANGLE
+    return int(np.clip(size, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE))
+
+
+def triangle_chunks(keypoints, chunk_size, lower=50, upper=400, min_area=1300, max_triangles=None, max_degree=None):
+    """The triangles of triangles_from_keypoints, in the same order, in chunks of about `chunk_size`.
+
+    Without a budget the triangles are generated chunk by chunk, checking
+    `chunk_size` candidates at a time. A budget is picked from all the
+    triangles, which are then only held as keypoint indexes.
+    """
+    keypoints = np.asarray(keypoints, dtype=float).reshape(-1, 2)
+
+    if max_triangles is not None or max_degree is not None:
+        triangles = triangles_from_keypoints(keypoints, lower, upper, min_area, max_triangles, max_degree)
+        for i in range(0, len(triangles), chunk_size):
+            yield triangles[i:i + chunk_size]
+        return
+
+    for triangles, _ in iter_triangles(keypoints, lower, upper, min_area, batch_size=chunk_size):
+        metrics.count('triangles', len(triangles))
+        yield keypoints[triangles]
+
+
+def hash_chunks(img, chunks, hash_triangles, max_memory=None):
+    """(hashes, vertices) of the fragments of every chunk of triangles of `img`.
+
+    `hash_triangles(img, triangles)` hashes one chunk. Raises MemoryError as
+    soon as the memory in use goes over `max_memory` bytes, see current_memory.
+    """
+    for triangles in chunks:
+        with metrics.timer('hashing'):
+            hashes = hash_triangles(img, triangles)
+        metrics.count('fragments', len(hashes))
+
+        yield hashes, fragment_vertices(triangles)
+        check_memory(max_memory)
+
+
+def insert_chunks(storage, image_id, chunks):
+    """Add the (hashes, vertices) chunks of an image, returns the number of new fragments.
+
+    The image is only marked indexed after the last chunk, so one stopped by a
+    MemoryError is not skipped as complete by a later insert.
+    """
+    n = 0
+    for hashes, vertices in chunks:
+        with metrics.timer('storage'):
+            n += storage.add_fragments(image_id, hashes, vertices, complete=False)
+
+    storage.mark_indexed(image_id)
+
+    metrics.count('new_fragments', n)
+    return n
+
+
+def query_chunks(storage, chunks, radius=0, max_df=None, idf=False):
+    """Counter of the images matching the (hashes, vertices) chunks of a query."""
+    count = Counter()
+    for hashes, _ in chunks:
+        with metrics.timer('storage'):
+            count.update(storage.query(hashes, radius=radius, max_df=max_df, idf=idf))
+
+    if idf:
+        count = Counter({image_id: round(votes, 3) for image_id, votes in count.items()})
+    return count
@@ -0,0 +1,98 @@
+"""Geometric verification of lookup candidates.
+
+A fragment hash that matches pairs a triangle of the query with a triangle of
+a stored image, and the pair implies the affine transform from the stored
+image to the query. The fragments of a true match agree on that transform,
+fragments that collide by chance don't. For the best candidates of a lookup
+the transform most fragments agree on is found with RANSAC, every fragment is
+a full hypothesis so no sampling of point sets is needed, and the candidates
+are ranked by how many fragments agree with it.
+"""
+import numpy as np
+
+
+# largest distance in query pixels of a vertex from where the transform puts it
+TOLERANCE = 10.0
+
+# fragments tried as the transform of a candidate
+HYPOTHESES = 256
+
+# fragments scored against the hypotheses at once
+SCORE_BATCH = 4096
+
+
+def homogeneous(vertices):
+    """(n, 3, 3) matrices with the vertices (n, 3, 2) as columns and a row of ones."""
+    m = np.ones(vertices.shape[:1] + (3, 3))
+    m[:, :2, :] = vertices.transpose(0, 2, 1)
+    return m
+
+
+def affine_from_vertices(src, dst):
+    """Affine transforms (n, 2, 3) mapping each triangle of src (n, 3, 2) onto the one of dst."""
+    with np.errstate(all='ignore'):
+        return dst.transpose(0, 2, 1) @ np.linalg.pinv(homogeneous(src))
+
+
+def vertex_errors(transforms, src, dst):
+    """(len(transforms), len(src)) largest distance of a vertex of src moved by each transform from dst."""
+    moved = np.einsum('hij,nkj->hnki', transforms[:, :, :2], src) + transforms[:, None, None, :, 2]
+    return np.sqrt(((moved - dst) ** 2).sum(axis=-1)).max(axis=-1)
+
+
+def consensus(src, dst, tolerance=TOLERANCE, hypotheses=HYPOTHESES, seed=0):
+    """The transform (2, 3) most of the triangle pairs src -> dst agree on, and the mask of those pairs.
+
+    The transform is None when there is no pair to agree on.
+    """
+    n = len(src)
+    if not n:
+        return None, np.zeros(0, dtype=bool)
+
+    rng = np.random.default_rng(seed)
+    candidates = rng.choice(n, min(n, hypotheses), replace=False)
+    transforms = affine_from_vertices(src[candidates], dst[candidates])
+
+    # fragments are never mirrored, so neither are the transforms of real matches
+    det = np.linalg.det(transforms[:, :, :2])
+    transforms = transforms[np.isfinite(transforms).all(axis=(1, 2)) & (det > 0)]
+    if not len(transforms):
+        return None, np.zeros(n, dtype=bool)
+
+    inliers = np.zeros(len(transforms), dtype=np.int64)
+    for i in range(0, n, SCORE_BATCH):
+        inliers += (vertex_errors(transforms, src[i:i + SCORE_BATCH], dst[i:i + SCORE_BATCH]) < tolerance).sum(axis=1)
+
+    best = transforms[np.argmax(inliers)]
+    mask = vertex_errors(best[None], src, dst)[0] < tolerance
+
+    # refit to every vertex of the agreeing pairs
+    a = homogeneous(src[mask]).transpose(0, 2, 1).reshape(-1, 3)
+    refined = np.linalg.lstsq(a, dst[mask].reshape(-1, 2), rcond=None)[0].T
+    refined_mask = vertex_errors(refined[None], src, dst)[0] < tolerance
+    if refined_mask.sum() >= mask.sum():
+        best, mask = refined, refined_mask
+
+    return best, mask
+
+
+def verify(storage, hashes, vertices, count, top=10, tolerance=TOLERANCE):
+    """Re-rank the `top` candidates of the lookup Counter `count` by geometric consistency.
+
+    `hashes` and `vertices` are the fragments of the query, as returned by
+    hash_triangles and fragment_vertices. Returns (image_id, votes, inliers,
+    transform) for each candidate, most inliers first. The transform maps the
+    stored image onto the query, it is None for images stored without
+    vertices.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    results = []
+
+    for image_id, votes in count.most_common(top):
+        stored = storage.geometry(image_id, hashes)
+        found = ~np.isnan(stored).any(axis=(1, 2))
+        transform, mask = consensus(stored[found], vertices[found], tolerance)
+        results.append((image_id, votes, int(mask.sum()), transform))
+
+    results.sort(key=lambda r: (-r[2], -r[1]))
+    return results